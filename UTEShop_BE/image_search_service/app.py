@@ -1,15 +1,52 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
-from sentence_transformers import SentenceTransformer, util
+from werkzeug.exceptions import RequestEntityTooLarge
 from PIL import Image
 import io
 import base64
 import numpy as np
 import os
+import re
 from pymongo import MongoClient
-from bson import ObjectId
+from gridfs import GridFSBucket
 from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import embedding_records
+from batch_encoder import BatchEncoder
+from caption_index import caption_key, product_captions
+from embedding_storage import (
+    EmbeddingFile,
+    delete_other_gridfs_versions,
+    download_from_gridfs,
+    remove_stale_local_files,
+    upload_to_gridfs,
+    write_embedding_file,
+)
+from embedding_store import EmbeddingSnapshot, EmbeddingStore, normalize_rows
+from image_cache import ImageCache
+from image_decode import ImageTooLarge, check_payload_size, decode_image
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, StageTimer
+from model_lifecycle import ModelLoader, warmup_clip
+from onnx_encoder import encoder_tag, load_encoder
+from query_cache import TTLCache, image_cache_key, text_cache_key
+from product_filters import SearchFilters, build_attributes
+from product_ranking import POOLING_MODES, rank_products
+from product_hydration import (
+    LookupTable,
+    hydrate_product_batches,
+    hydrate_products,
+    load_brands,
+    load_categories,
+)
+from vector_index import build_index, restore_index
 
 # Background update status tracker
 update_status = {
@@ -18,26 +55,53 @@ update_status = {
     "last_completed": None,
     "last_result": None,
     "progress": "",
+    "counters": {},
     "error": None
 }
 
 app = Flask(__name__)
 CORS(app, origins=["*"])
 
-# Initialize CLIP model
-print("🚀 Loading CLIP model...")
+# Query uploads: decoded image byte limit and pixel limit (checked from the header before decoding)
+MAX_UPLOAD_BYTES = int(float(os.getenv('MAX_UPLOAD_SIZE_MB', '10')) * 1024 * 1024)
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', '40000000'))
+# Whole request body: base64 inflates the image by 4/3, plus room for form fields
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024
+# /search/batch: queries per request and total body size
+MAX_BATCH_QUERIES = int(os.getenv('MAX_BATCH_QUERIES', '256'))
+MAX_BATCH_REQUEST_BYTES = int(float(os.getenv('MAX_BATCH_REQUEST_MB', '200')) * 1024 * 1024)
+# App-wide cap is the batch one; /search lowers it to MAX_REQUEST_BYTES per request
+app.config['MAX_CONTENT_LENGTH'] = max(MAX_REQUEST_BYTES, MAX_BATCH_REQUEST_BYTES)
+
+# Initialize CLIP model: loaded and warmed up in the background at startup
 CLIP_MODEL_NAME = os.getenv('CLIP_MODEL_NAME', 'uteshop-clip')
 #img_model = SentenceTransformer('clip-ViT-B-32')
-img_model = None
+MODEL_PRELOAD = os.getenv('MODEL_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+MODEL_WARMUP_BATCH_SIZES = [int(size) for size in os.getenv('MODEL_WARMUP_BATCH_SIZES', '1,4').split(',') if size.strip()]
+# Inference backend: torch (fp32) | torch-int8 | onnx (see onnx_encoder.py)
+CLIP_BACKEND = os.getenv('CLIP_BACKEND', 'torch')
+CLIP_ONNX_DIR = os.getenv('CLIP_ONNX_DIR', 'onnx_models/uteshop-clip')
+CLIP_ONNX_QUANTIZED = os.getenv('CLIP_ONNX_QUANTIZED', 'true').lower() in ('1', 'true', 'yes')
+ENCODER_THREADS = int(os.getenv('ENCODER_THREADS', '0'))
+# Stored vectors (image records, captions, snapshots) are only reused by the same model + backend
+EMBEDDING_MODEL_TAG = encoder_tag(CLIP_BACKEND, CLIP_MODEL_NAME, CLIP_ONNX_QUANTIZED)
+model_loader = ModelLoader(
+    lambda: load_encoder(
+        CLIP_BACKEND,
+        CLIP_MODEL_NAME,
+        onnx_dir=CLIP_ONNX_DIR,
+        quantized=CLIP_ONNX_QUANTIZED,
+        threads=ENCODER_THREADS,
+    ),
+    warmup=lambda model: warmup_clip(model, MODEL_WARMUP_BATCH_SIZES),
+    name=f"CLIP model '{CLIP_MODEL_NAME}' ({CLIP_BACKEND})",
+)
 
 def get_model():
-    global img_model
-    if img_model is None:
-        print("🚀 Loading CLIP model...")
-        img_model = SentenceTransformer(CLIP_MODEL_NAME)
-        print("✅ Model loaded successfully")
-    return img_model
-print("✅ Model loaded successfully")
+    return model_loader.get()
+
+if MODEL_PRELOAD:
+    model_loader.start()
 
 # MongoDB connection
 MONGO_URI = os.getenv('MONGODB_URI') or os.getenv('MONGODBURI')
@@ -52,8 +116,10 @@ db = None
 products_collection = None
 embeddings_collection = None
 
+image_embeddings_collection = None
+
 def init_mongodb():
-    global client, db, products_collection, embeddings_collection
+    global client, db, products_collection, embeddings_collection, image_embeddings_collection
     if not MONGO_URI:
         return False
     try:
@@ -62,6 +128,7 @@ def init_mongodb():
         db = client['test']
         products_collection = db.products
         embeddings_collection = db.product_embeddings
+        image_embeddings_collection = db.product_image_embeddings
         print("✅ MongoDB connected successfully")
         return True
     except Exception as e:
@@ -70,42 +137,473 @@ def init_mongodb():
 
 init_mongodb()
 
-def get_product_embeddings():
-    """Load cached embeddings from MongoDB"""
-    if embeddings_collection is None:
-        return None, None, {}
-    
-    cached = embeddings_collection.find_one({"_id": "all_embeddings_multi"})
+EMBEDDINGS_REFRESH_SECONDS = int(os.getenv('EMBEDDINGS_REFRESH_SECONDS', '60'))
+EMBEDDING_DOC_IDS = ("all_embeddings_multi", "all_embeddings_single")
+
+
+def _fetch_embedding_version():
+    """Cheap version check: only the updated_at stamp is read"""
+    for doc_id in EMBEDDING_DOC_IDS:
+        doc = embeddings_collection.find_one({"_id": doc_id}, {"updated_at": 1})
+        if doc:
+            return doc.get("updated_at")
+    return None
+
+
+VECTOR_INDEX_BACKEND = os.getenv('VECTOR_INDEX_BACKEND', 'exact')
+IVF_NLIST = int(os.getenv('IVF_NLIST', '0'))
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', '8'))
+
+# Binary embedding storage: float32 | float16 | int8, cached locally and memory-mapped
+EMBEDDING_STORAGE_DTYPE = os.getenv('EMBEDDING_STORAGE_DTYPE', 'float16')
+EMBEDDINGS_CACHE_DIR = os.getenv('EMBEDDINGS_CACHE_DIR', 'embedding_cache')
+EMBEDDING_FILES_BUCKET = "embedding_files"
+embedding_files = GridFSBucket(db, bucket_name=EMBEDDING_FILES_BUCKET) if db is not None else None
+
+
+def _index_params():
+    params = {"nprobe": IVF_NPROBE}
+    if IVF_NLIST > 0:
+        params["nlist"] = IVF_NLIST
+    return params
+
+
+def _index_factory(state=None, backend=None):
+    """Restore the persisted index state when it matches the configured backend, otherwise build one"""
+    def factory(matrix):
+        params = _index_params()
+        if state and backend == VECTOR_INDEX_BACKEND:
+            return restore_index(VECTOR_INDEX_BACKEND, matrix, state, **params)
+        if VECTOR_INDEX_BACKEND != "exact":
+            print(f"🧭 Building {VECTOR_INDEX_BACKEND} index for {len(matrix)} vectors...")
+        return build_index(VECTOR_INDEX_BACKEND, matrix, **params)
+    return factory
+
+
+def _local_embedding_path(doc_id, updated_at):
+    stamp = re.sub(r"[^0-9A-Za-z]", "", str(updated_at))
+    return os.path.join(EMBEDDINGS_CACHE_DIR, f"{doc_id}-{stamp}.emb")
+
+
+def _snapshot_from_file(path):
+    emb_file = EmbeddingFile(path)
+    header = emb_file.header
+    return EmbeddingSnapshot(
+        emb_file.matrix,
+        emb_file.product_ids,
+        emb_file.product_info,
+        updated_at=header.get("updated_at"),
+        model_name=header.get("model_name"),
+        index_factory=_index_factory(emb_file.index_state(), header.get("index_backend")),
+        captions=emb_file.captions(),
+        attributes=emb_file.attributes(),
+    )
+
+
+def _load_embedding_snapshot():
+    """Load the published embeddings (memory-mapped binary file, or legacy nested lists)"""
+    cached = None
+    for doc_id in EMBEDDING_DOC_IDS:
+        cached = embeddings_collection.find_one({"_id": doc_id})
+        if cached:
+            break
+
     if not cached:
-        cached = embeddings_collection.find_one({"_id": "all_embeddings_single"})
-    
-    if cached and cached.get("embeddings"):
-        embeddings = np.array(cached["embeddings"], dtype=np.float32)
-        print(f"📦 Loaded {len(embeddings)} cached embeddings")
-        return embeddings, cached["product_ids"], cached.get("product_info", {})
-    
-    return None, None, {}
+        return None
 
+    storage = cached.get("storage")
+    if storage:
+        path = _local_embedding_path(cached["_id"], cached.get("updated_at"))
+        if not os.path.exists(path):
+            print(f"⬇️  Downloading embedding file ({storage.get('bytes', 0)} bytes) from GridFS...")
+            download_from_gridfs(embedding_files, storage["gridfs_id"], path)
+        snapshot = _snapshot_from_file(path)
+        remove_stale_local_files(EMBEDDINGS_CACHE_DIR, path, prefix=f"{cached['_id']}-")
+    elif cached.get("embeddings"):
+        # Documents written before binary storage keep every float as a BSON double.
+        snapshot = EmbeddingSnapshot(
+            np.array(cached["embeddings"], dtype=np.float32),
+            cached["product_ids"],
+            cached.get("product_info", {}),
+            updated_at=cached.get("updated_at"),
+            model_name=cached.get("model_name"),
+            index_factory=_index_factory(),
+        )
+    else:
+        return None
+
+    print(f"📦 Loaded {len(snapshot)} cached embeddings")
+    if snapshot.model_name and snapshot.model_name != EMBEDDING_MODEL_TAG:
+        print(f"⚠️  Embeddings were built with '{snapshot.model_name}', the encoder is '{EMBEDDING_MODEL_TAG}'. "
+              "Run /update-embeddings to re-embed the catalog.")
+    return snapshot
+
+
+def _publish_embeddings(matrix, product_ids, product_info, updated_at, captions=None, attributes=None):
+    """Write the binary embedding file with its index, upload it to GridFS and swap it in"""
+    doc_id = "all_embeddings_multi"
+    matrix = normalize_rows(matrix)
+    index = build_index(VECTOR_INDEX_BACKEND, matrix, **_index_params())
+
+    path = _local_embedding_path(doc_id, updated_at)
+    write_embedding_file(
+        path,
+        matrix,
+        product_ids,
+        product_info,
+        dtype=EMBEDDING_STORAGE_DTYPE,
+        index_state=index.to_state(),
+        meta={"updated_at": updated_at, "model_name": EMBEDDING_MODEL_TAG, "index_backend": index.name},
+        captions=captions,
+        attributes=attributes,
+    )
+    file_id = upload_to_gridfs(embedding_files, path, doc_id, metadata={"updated_at": updated_at})
+
+    embeddings_collection.replace_one({"_id": doc_id}, {
+        "_id": doc_id,
+        "storage": {
+            "format": "emb",
+            "gridfs_id": file_id,
+            "dtype": EMBEDDING_STORAGE_DTYPE,
+            "bytes": os.path.getsize(path),
+        },
+        "count": int(matrix.shape[0]),
+        "dim": int(matrix.shape[1]),
+        "model_name": EMBEDDING_MODEL_TAG,
+        "updated_at": updated_at,
+    }, upsert=True)
+    delete_other_gridfs_versions(embedding_files, doc_id, file_id)
+
+    snapshot = _snapshot_from_file(path)
+    embedding_store.publish(snapshot)
+    remove_stale_local_files(EMBEDDINGS_CACHE_DIR, path, prefix=f"{doc_id}-")
+    return snapshot
+
+
+embedding_store = EmbeddingStore(
+    _load_embedding_snapshot,
+    _fetch_embedding_version,
+    refresh_interval=EMBEDDINGS_REFRESH_SECONDS,
+)
+if embeddings_collection is not None:
+    embedding_store.start()
+
+# Product-level ranking: max | mean | top2 pooling of per-image scores
+PRODUCT_POOLING = os.getenv('PRODUCT_POOLING', 'max')
+MIN_SIMILARITY_THRESHOLD = float(os.getenv('MIN_SIMILARITY_THRESHOLD', '0.3'))
+HYDRATION_SLACK = int(os.getenv('HYDRATION_SLACK', '5'))
+# Share of text_weight scored against product captions instead of product images
+CAPTION_TEXT_SHARE = float(os.getenv('CAPTION_TEXT_SHARE', '0.5'))
+
+LOOKUP_TTL_SECONDS = int(os.getenv('LOOKUP_TTL_SECONDS', '300'))
+category_lookup = LookupTable(lambda: load_categories(db), ttl=LOOKUP_TTL_SECONDS, name="categories")
+brand_lookup = LookupTable(lambda: load_brands(db), ttl=LOOKUP_TTL_SECONDS, name="brands")
+
+
+def get_product_embeddings():
+    """Return the resident embedding snapshot (never reads MongoDB)"""
+    snapshot = embedding_store.get()
+    if snapshot is None or len(snapshot) == 0:
+        return None
+    return snapshot
+
+
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '512'))
+TEXT_QUERY_CACHE_SIZE = int(os.getenv('TEXT_QUERY_CACHE_SIZE', '2048'))
+QUERY_CACHE_TTL_SECONDS = int(os.getenv('QUERY_CACHE_TTL_SECONDS', '900'))
+image_query_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL_SECONDS)
+text_query_cache = TTLCache(maxsize=TEXT_QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL_SECONDS)
+
+# Concurrent query encodes are micro-batched into one CLIP forward pass
+ENCODER_MAX_BATCH_SIZE = int(os.getenv('ENCODER_MAX_BATCH_SIZE', '16'))
+ENCODER_MAX_WAIT_MS = float(os.getenv('ENCODER_MAX_WAIT_MS', '5'))
+batch_encoder = BatchEncoder(get_model, max_batch_size=ENCODER_MAX_BATCH_SIZE, max_wait_ms=ENCODER_MAX_WAIT_MS)
+
+
+def _cached_encode(cache, key, kind, item):
+    embedding = cache.get(key)
+    if embedding is None:
+        embedding = normalize_rows(batch_encoder.encode(kind, item))[0]
+        embedding.flags.writeable = False
+        cache.set(key, embedding)
+    return embedding
+
+
+def encode_query_image(image):
+    """Normalized CLIP embedding of a query image (cached by pixel hash)"""
+    return _cached_encode(image_query_cache, image_cache_key(image), "image", image)
+
+
+def encode_query_text(text):
+    """Normalized CLIP embedding of a query text (cached by normalized text)"""
+    return _cached_encode(text_query_cache, text_cache_key(text), "text", text)
+
+
+BATCH_SEARCH_ENCODE_SIZE = int(os.getenv('BATCH_SEARCH_ENCODE_SIZE', '64'))
+
+
+def _cached_encode_many(cache, keys, items):
+    """Cache lookups for a whole batch; misses (deduplicated) go through one model.encode call"""
+    embeddings = {}
+    missing = {}
+    for key, item in zip(keys, items):
+        if key in embeddings or key in missing:
+            continue
+        embedding = cache.get(key)
+        if embedding is None:
+            missing[key] = item
+        else:
+            embeddings[key] = embedding
+    if missing:
+        encoded = normalize_rows(get_model().encode(
+            list(missing.values()), batch_size=BATCH_SEARCH_ENCODE_SIZE, convert_to_numpy=True
+        ))
+        for key, embedding in zip(missing, encoded):
+            embedding = embedding.copy()
+            embedding.flags.writeable = False
+            cache.set(key, embedding)
+            embeddings[key] = embedding
+    return np.stack([embeddings[key] for key in keys])
+
+
+def encode_query_images(images):
+    return _cached_encode_many(image_query_cache, [image_cache_key(image) for image in images], images)
+
+
+def encode_query_texts(texts):
+    return _cached_encode_many(text_query_cache, [text_cache_key(text) for text in texts], texts)
+
+
+# Prometheus metrics (GET /metrics). Request/stage metrics are recorded per request,
+# cache, matrix and model figures are read from their owners at scrape time.
+metrics_registry = Registry()
+request_counter = metrics_registry.counter(
+    "image_search_requests_total", "HTTP requests by endpoint and status", ("endpoint", "status"))
+error_counter = metrics_registry.counter(
+    "image_search_errors_total", "HTTP responses with status >= 400", ("endpoint", "status"))
+request_seconds = metrics_registry.histogram(
+    "image_search_request_seconds", "End-to-end request latency", ("endpoint",))
+stage_seconds = metrics_registry.histogram(
+    "image_search_stage_seconds", "Search latency by stage (decode, encode, similarity, rank, hydrate, serialize)",
+    ("endpoint", "stage"))
+
+QUERY_CACHES = (("image", image_query_cache), ("text", text_query_cache))
+for _field, _type in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"), ("size", "gauge")):
+    metrics_registry.callback(
+        f"image_search_query_cache_{_field}" + ("_total" if _type == "counter" else ""),
+        f"Query embedding cache {_field}",
+        lambda field=_field: [({"cache": name}, cache.stats()[field]) for name, cache in QUERY_CACHES],
+        type=_type,
+    )
+
+
+def _snapshot_figure(read):
+    snapshot = embedding_store.get()
+    return read(snapshot) if snapshot is not None else 0
+
+
+metrics_registry.callback("image_search_embedding_vectors", "Image vectors in the resident matrix",
+                          lambda: _snapshot_figure(len))
+metrics_registry.callback("image_search_embedding_products", "Products in the resident matrix",
+                          lambda: _snapshot_figure(lambda snapshot: len(snapshot.product_keys)))
+metrics_registry.callback("image_search_embedding_dim", "Embedding dimension",
+                          lambda: _snapshot_figure(lambda snapshot: snapshot.embeddings.shape[1]))
+metrics_registry.callback("image_search_embedding_bytes", "Bytes held by the resident matrix",
+                          lambda: _snapshot_figure(lambda snapshot: snapshot.embeddings.nbytes))
+metrics_registry.callback("image_search_model_ready", "1 once the CLIP model is loaded and warmed up",
+                          lambda: int(model_loader.ready))
+metrics_registry.callback("image_search_model_load_seconds", "CLIP model load time",
+                          lambda: model_loader.load_seconds)
+metrics_registry.callback("image_search_model_warmup_seconds", "CLIP model warmup time",
+                          lambda: model_loader.warmup_seconds)
+metrics_registry.callback("image_search_encoder_batches_total", "Micro-batched encoder forward passes",
+                          lambda: batch_encoder.batches, type="counter")
+metrics_registry.callback("image_search_encoder_items_total", "Items encoded by the micro-batched encoder",
+                          lambda: batch_encoder.items, type="counter")
+
+
+def record_request(endpoint, status, timer):
+    request_counter.inc(endpoint=endpoint, status=status)
+    if status >= 400:
+        error_counter.inc(endpoint=endpoint, status=status)
+    request_seconds.observe(timer.elapsed(), endpoint=endpoint)
 
-def fetch_image_from_url(url, timeout=10):
-    try:
-        import requests
 
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
-        return Image.open(io.BytesIO(response.content)).convert("RGB")
+def debug_timing_requested(headers, args):
+    """Opt-in per request: `X-Debug-Timing: 1` header or `?debug_timing=1`"""
+    value = headers.get('X-Debug-Timing') or args.get('debug_timing') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+
+EMBED_DOWNLOAD_WORKERS = int(os.getenv('EMBED_DOWNLOAD_WORKERS', '8'))
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '32'))
+EMBED_IMAGE_MIN_SIDE = int(os.getenv('EMBED_IMAGE_MIN_SIDE', '224'))
+# full: re-download and re-encode every image; incremental: only new/changed images
+EMBEDDING_UPDATE_MODE = os.getenv('EMBEDDING_UPDATE_MODE', 'full')
+EMBEDDING_UPDATE_MODES = ("full", "incremental")
+
+http_session = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=EMBED_DOWNLOAD_WORKERS,
+    pool_maxsize=EMBED_DOWNLOAD_WORKERS,
+    max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+)
+http_session.mount("http://", _http_adapter)
+http_session.mount("https://", _http_adapter)
+
+# Catalog images are kept on local disk and revalidated with ETag / Last-Modified
+# (empty IMAGE_CACHE_DIR downloads every time)
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+image_cache = ImageCache(IMAGE_CACHE_DIR, session=http_session) if IMAGE_CACHE_DIR else None
+
+for _field, _type in (("hits", "counter"), ("revalidated", "counter"), ("misses", "counter"),
+                      ("evictions", "counter"), ("bytes", "gauge")):
+    metrics_registry.callback(
+        f"image_search_image_cache_{_field}" + ("_total" if _type == "counter" else ""),
+        f"Image download cache {_field}",
+        lambda field=_field: image_cache.stats()[field] if image_cache is not None else None,
+        type=_type,
+    )
+
+
+def download_image_bytes(url, timeout=10):
+    if image_cache is not None:
+        return image_cache.fetch(url, timeout=timeout)
+    response = http_session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_image_from_url(url, timeout=10, min_side=EMBED_IMAGE_MIN_SIDE):
+    try:
+        return decode_image(download_image_bytes(url, timeout=timeout), min_side=min_side)
     except Exception as exc:
         print(f"⚠️  Failed to load image: {url} ({exc})")
         return None
 
 
-def _update_embeddings_task():
+def _fetch_for_embedding(url, known_hash=None):
+    """Returns (image, content_hash); image is None when unchanged or failed"""
+    try:
+        data = download_image_bytes(url)
+        digest = embedding_records.content_hash(data)
+        if digest == known_hash:
+            return None, digest
+        return decode_image(data, min_side=EMBED_IMAGE_MIN_SIDE), digest
+    except Exception as exc:
+        print(f"⚠️  Failed to load image: {url} ({exc})")
+        return None, None
+
+
+def _embed_image_jobs(jobs, model, on_progress, known_hashes=None):
+    """
+    Download and decode images on a bounded thread pool while CLIP encodes
+    full batches on the calling thread.
+
+    jobs: list of (tag, image_url). known_hashes: tag -> content hash of the
+    stored vector; matching downloads are not decoded or encoded.
+    Returns ([(tag, embedding or None if unchanged, content_hash)], counters).
+    """
+    known_hashes = known_hashes or {}
+    counters = {"total": len(jobs), "processed": 0, "encoded": 0, "unchanged": 0, "skipped": 0}
+    results = []
+    batch = []
+
+    def flush():
+        if not batch:
+            return
+        vectors = model.encode([image for _, image, _ in batch], batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True)
+        for (tag, _, digest), vector in zip(batch, vectors.astype(np.float32)):
+            results.append((tag, vector, digest))
+        counters["encoded"] += len(batch)
+        batch.clear()
+
+    # Bound the number of decoded images waiting for the encoder.
+    max_in_flight = max(EMBED_BATCH_SIZE * 2, EMBED_DOWNLOAD_WORKERS * 4)
+    job_iter = iter(jobs)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=EMBED_DOWNLOAD_WORKERS, thread_name_prefix="embed-fetch") as pool:
+        def submit_next():
+            for tag, image_url in job_iter:
+                pending.append((tag, pool.submit(_fetch_for_embedding, image_url, known_hashes.get(tag))))
+                return True
+            return False
+
+        while len(pending) < max_in_flight and submit_next():
+            pass
+
+        while pending:
+            tag, future = pending.popleft()
+            submit_next()
+            image, digest = future.result()
+            counters["processed"] += 1
+            if image is not None:
+                batch.append((tag, image, digest))
+                if len(batch) >= EMBED_BATCH_SIZE:
+                    flush()
+            elif digest is not None:
+                counters["unchanged"] += 1
+                results.append((tag, None, digest))
+            else:
+                counters["skipped"] += 1
+            on_progress(counters)
+
+        flush()
+        on_progress(counters)
+
+    return results, counters
+
+
+def _encode_captions(products, product_ids, incremental):
+    """
+    Caption rows for every product in the published matrix, in matrix order.
+    Incremental updates keep the vector of captions whose text is unchanged.
+    Returns (captions dict for write_embedding_file or None, number encoded).
+    """
+    products_by_id = {str(product["_id"]): product for product in products}
+    categories, brands = category_lookup.get(), brand_lookup.get()
+    caption_product_ids, texts = [], []
+    for product_id in dict.fromkeys(product_ids):
+        for caption in product_captions(products_by_id[product_id], categories, brands):
+            caption_product_ids.append(product_id)
+            texts.append(caption)
+    if not texts:
+        return None, 0
+    keys = [caption_key(text) for text in texts]
+
+    previous = embedding_store.get()
+    reusable = {}
+    if incremental and previous is not None and previous.captions is not None and previous.model_name == EMBEDDING_MODEL_TAG:
+        reusable = previous.captions.rows_by_key()
+    missing = [position for position, key in enumerate(keys) if key not in reusable]
+    reused = [position for position, key in enumerate(keys) if key in reusable]
+
+    encoded = None
+    if missing:
+        encoded = normalize_rows(get_model().encode(
+            [texts[position] for position in missing], batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True
+        ))
+    dim = encoded.shape[1] if encoded is not None else previous.captions.embeddings.shape[1]
+    vectors = np.empty((len(texts), dim), dtype=np.float32)
+    if encoded is not None:
+        vectors[missing] = encoded
+    if reused:
+        vectors[reused] = previous.captions.embeddings[np.array([reusable[keys[position]] for position in reused])]
+
+    print(f"📝 Captions: {len(texts)} total, {len(missing)} encoded, {len(reused)} reused")
+    return {"embeddings": vectors, "product_ids": caption_product_ids, "keys": keys}, len(missing)
+
+
+def _update_embeddings_task(mode=EMBEDDING_UPDATE_MODE):
     """Background task to update embeddings - runs in a separate thread"""
     global update_status
+    incremental = mode == "incremental"
     update_status["running"] = True
     update_status["last_started"] = datetime.datetime.utcnow().isoformat() + "Z"
     update_status["error"] = None
-    update_status["progress"] = "Starting..."
+    update_status["progress"] = f"Starting ({mode})..."
+    update_status["counters"] = {}
 
     try:
         if embeddings_collection is None or products_collection is None:
@@ -128,65 +626,102 @@ def _update_embeddings_task():
             update_status["running"] = False
             return
 
-        update_status["progress"] = f"Found {len(products)} products. Loading model..."
-        model = get_model()
+        update_status["progress"] = f"Found {len(products)} products. Diffing stored image embeddings..."
+        records = embedding_records.load_records(image_embeddings_collection, EMBEDDING_MODEL_TAG)
+        plan = embedding_records.plan_update(products, records, incremental=incremental)
+        print(
+            f"🧮 Embedding update ({mode}): {len(plan.targets)} images, {len(plan.fetch)} to fetch, "
+            f"{len(plan.reuse)} reused, {len(plan.stale)} stale"
+        )
 
-        embeddings = []
-        product_ids = []
         product_info = {}
-        skipped = 0
-        total_images = sum(len(p.get("images", [])) for p in products)
-        processed = 0
-
         for product in products:
             product_id = str(product.get("_id"))
-            images = product.get("images", [])
-            if not images:
-                continue
+            if product.get("images"):
+                product_info[product_id] = {
+                    "name": product.get("name", ""),
+                    "images": product.get("images", [])
+                }
 
-            product_info[product_id] = {
-                "name": product.get("name", ""),
-                "images": images
-            }
+        update_status["progress"] = f"{len(plan.fetch)} images to fetch. Loading model..."
+        model = get_model() if plan.fetch else None
+        missing_urls = plan.missing_urls
 
-            for image_url in images:
-                processed += 1
-                if not image_url:
-                    skipped += 1
-                    continue
+        def on_progress(counters):
+            # Empty image URLs are counted as processed and skipped up front.
+            counters = dict(
+                counters,
+                total=counters["total"] + missing_urls,
+                processed=counters["processed"] + missing_urls,
+                skipped=counters["skipped"] + missing_urls,
+                reused=len(plan.reuse),
+            )
+            update_status["counters"] = counters
+            update_status["progress"] = (
+                f"Processed {counters['processed']}/{counters['total']} images "
+                f"(encoded: {counters['encoded']}, unchanged: {counters['unchanged']}, "
+                f"skipped: {counters['skipped']}, reused without download: {counters['reused']})"
+            )
 
-                update_status["progress"] = f"Encoding image {processed}/{total_images} (skipped: {skipped})"
-                image = fetch_image_from_url(image_url)
-                if image is None:
-                    skipped += 1
-                    continue
+        jobs = [(target.key, target.image_url) for target in plan.fetch]
+        fetched, counters = _embed_image_jobs(jobs, model, on_progress, plan.known_hashes)
+        skipped = counters["skipped"] + missing_urls
 
-                embedding = model.encode([image], convert_to_numpy=True)[0].astype(np.float32)
-                embeddings.append(embedding.tolist())
-                product_ids.append(product_id)
+        now = datetime.datetime.utcnow()
+        targets_by_key = {target.key: target for target in plan.targets}
+        update_status["progress"] = f"Saving {len(fetched)} image embedding records..."
+        embedding_records.save_changes(image_embeddings_collection, targets_by_key, fetched, EMBEDDING_MODEL_TAG, now)
+        deleted = embedding_records.delete_stale(image_embeddings_collection, plan.stale, EMBEDDING_MODEL_TAG)
+
+        # Assemble the published matrix in catalog order. Images that failed to
+        # download keep their previous vector when one exists.
+        new_vectors = {key: vector for key, vector, _ in fetched if vector is not None}
+        product_ids = []
+        embeddings = []
+        for target in plan.targets:
+            vector = new_vectors.get(target.key)
+            if vector is None and target.key in records:
+                vector = embedding_records.embedding_from_binary(records[target.key]["embedding"])
+            if vector is None:
+                continue
+            product_ids.append(target.product_id)
+            embeddings.append(vector)
 
         if not embeddings:
             update_status["error"] = "No valid images to embed"
             update_status["running"] = False
             return
 
-        update_status["progress"] = f"Saving {len(embeddings)} embeddings to database..."
-        payload = {
-            "_id": "all_embeddings_multi",
-            "embeddings": embeddings,
-            "product_ids": product_ids,
-            "product_info": product_info,
-            "model_name": CLIP_MODEL_NAME,
-            "updated_at": datetime.datetime.utcnow().isoformat() + "Z",
-        }
+        update_status["progress"] = "Encoding product captions..."
+        captions, captions_encoded = None, 0
+        try:
+            captions, captions_encoded = _encode_captions(products, product_ids, incremental)
+        except Exception as exc:
+            # Captions only refine text queries; publish the image index regardless.
+            print(f"⚠️  Caption index skipped: {exc}")
+
+        products_by_id = {str(product["_id"]): product for product in products}
+        attributes = build_attributes(list(dict.fromkeys(product_ids)), products_by_id)
 
-        embeddings_collection.replace_one({"_id": "all_embeddings_multi"}, payload, upsert=True)
+        updated_at = datetime.datetime.utcnow().isoformat() + "Z"
+        update_status["progress"] = (
+            f"Building {VECTOR_INDEX_BACKEND} index and saving {len(embeddings)} embeddings "
+            f"({EMBEDDING_STORAGE_DTYPE})..."
+        )
+        _publish_embeddings(np.stack(embeddings), product_ids, product_info, updated_at, captions, attributes)
 
         update_status["last_result"] = {
             "success": True,
             "message": "Embeddings updated",
+            "mode": mode,
             "count": len(embeddings),
-            "skipped": skipped
+            "encoded": counters["encoded"],
+            "unchanged": counters["unchanged"],
+            "reused": len(plan.reuse),
+            "deleted": deleted,
+            "skipped": skipped,
+            "captions": len(captions["keys"]) if captions else 0,
+            "captions_encoded": captions_encoded
         }
         update_status["progress"] = f"Done! {len(embeddings)} embeddings saved."
         update_status["last_completed"] = datetime.datetime.utcnow().isoformat() + "Z"
@@ -202,53 +737,396 @@ def _update_embeddings_task():
         update_status["running"] = False
 
 
-@app.route('/update-embeddings', methods=['POST'])
-def update_embeddings():
-    global update_status
-
+def start_embedding_update(mode=None):
+    """Start the background re-embed; returns (payload, http status)"""
     if update_status["running"]:
-        return jsonify({
+        return {
             "success": False,
             "message": "Update already in progress",
             "progress": update_status["progress"]
-        }), 409
+        }, 409
 
     if embeddings_collection is None or products_collection is None:
-        return jsonify({
+        return {
             "success": False,
             "error": "Database not connected"
-        }), 500
+        }, 500
+
+    mode = mode or EMBEDDING_UPDATE_MODE
+    if mode not in EMBEDDING_UPDATE_MODES:
+        return {
+            "success": False,
+            "error": f"Invalid mode '{mode}', expected one of: {', '.join(EMBEDDING_UPDATE_MODES)}"
+        }, 400
 
     # Start background thread
-    thread = Thread(target=_update_embeddings_task, daemon=True)
+    thread = Thread(target=_update_embeddings_task, args=(mode,), daemon=True)
     thread.start()
 
-    return jsonify({
+    return {
         "success": True,
         "message": "Embedding update started in background. Use /update-status to check progress.",
+        "mode": mode,
         "status_url": "/update-status"
-    }), 202
+    }, 202
 
 
-@app.route('/update-status', methods=['GET'])
-def get_update_status():
-    return jsonify({
+def update_status_payload():
+    return {
         "success": True,
         "running": update_status["running"],
         "progress": update_status["progress"],
+        "counters": update_status["counters"],
         "last_started": update_status["last_started"],
         "last_completed": update_status["last_completed"],
         "last_result": update_status["last_result"],
         "error": update_status["error"]
-    })
+    }
+
+
+SERVICE_INFO = {
+    "service": "UTEShop Image Search",
+    "status": "running",
+    "version": "1.0.0"
+}
+
+
+def health_payload(mongo_ok):
+    return {
+        "status": "ok" if mongo_ok else "degraded",
+        "mongodb": "connected" if mongo_ok else "disconnected",
+        "ready": model_loader.ready and embedding_store.loaded,
+        "model": model_loader.state,
+        "model_lifecycle": model_loader.status(),
+        "embeddings": embedding_store.status(),
+        "query_cache": {
+            "image": image_query_cache.stats(),
+            "text": text_query_cache.stats()
+        },
+        "image_cache": image_cache.stats() if image_cache is not None else None,
+        "encoder": batch_encoder.stats()
+    }
+
+
+def readiness_payload():
+    """Ready once the model is warmed up and the first embedding load has finished"""
+    checks = {
+        "model": model_loader.ready,
+        "embeddings": embedding_store.loaded,
+        "mongodb": products_collection is not None,
+    }
+    ready = all(checks.values())
+    return {
+        "ready": ready,
+        "checks": checks,
+        "model": model_loader.status()
+    }, 200 if ready else 503
+
+
+class SearchError(Exception):
+    """Search failure reported to the client with an HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_query_image(data):
+    """Decode an uploaded query image close to the model input size"""
+    try:
+        return decode_image(data, min_side=EMBED_IMAGE_MIN_SIDE, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_IMAGE_PIXELS)
+    except ImageTooLarge as exc:
+        raise SearchError(str(exc), 413)
+    except (OSError, SyntaxError, ValueError) as exc:
+        raise SearchError(f"Invalid image data: {exc}", 400)
+
+
+def decode_base64_image(image_data):
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    # Reject on the encoded length, before allocating the decoded bytes.
+    try:
+        check_payload_size(len(image_data) * 3 // 4, MAX_UPLOAD_BYTES)
+    except ImageTooLarge as exc:
+        raise SearchError(str(exc), 413)
+    return decode_query_image(base64.b64decode(image_data))
+
+
+def is_raw_image_type(content_type):
+    """Raw image bodies (no multipart / base64 wrapping)"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return content_type.startswith('image/') or content_type == 'application/octet-stream'
+
+
+def batch_queries_from_json(json_data):
+    """
+    {"queries": [{"image_base64": ..., "text": ...}, ...]}
+    or {"images_base64": [...], "texts": [...]} -> (base64 payloads, texts)
+    """
+    if not isinstance(json_data, dict):
+        return [], []
+    if isinstance(json_data.get('queries'), list):
+        queries = [query for query in json_data['queries'] if isinstance(query, dict)]
+        return [query.get('image_base64') or '' for query in queries], [query.get('text') for query in queries]
+    payloads = json_data.get('images_base64') or []
+    return list(payloads), align_texts(json_data.get('texts') or [], len(payloads))
+
+
+def align_texts(texts, count):
+    texts = [str(text).strip() if text else None for text in list(texts)[:count]]
+    return texts + [None] * (count - len(texts))
+
+
+def decode_batch_images(payloads, decode):
+    """Decode query images in parallel; a bad image fails only its own query"""
+    def run(payload):
+        try:
+            return decode(payload), None
+        except SearchError as exc:
+            return None, str(exc)
+
+    with ThreadPoolExecutor(max_workers=EMBED_DOWNLOAD_WORKERS) as executor:
+        decoded = list(executor.map(run, payloads))
+    return [image for image, _ in decoded], [error for _, error in decoded]
+
+
+def rank_batch(images, texts, args, timer=None):
+    """Rank the decodable queries; returns ({position: ranked}, options)"""
+    positions = [position for position, image in enumerate(images) if image is not None]
+    if not positions:
+        return {}, _search_options(args)
+    ranked_lists, options = rank_queries([images[p] for p in positions], [texts[p] for p in positions], args, timer)
+    return dict(zip(positions, ranked_lists)), options
+
+
+def batch_payload(errors, results_by_position, start_time):
+    queries = []
+    for position, error in enumerate(errors):
+        if error is not None:
+            queries.append({"index": position, "success": False, "error": error})
+            continue
+        results = results_by_position[position]
+        results.sort(key=lambda x: -x["similarity"])
+        queries.append({"index": position, "success": True, "results": results, "count": len(results)})
+    search_time = time.time() - start_time
+    print(f"✅ Batch of {len(queries)} queries answered in {search_time:.2f}s")
+    return {
+        "success": True,
+        "queries": queries,
+        "count": len(queries),
+        "search_time": round(search_time, 2)
+    }
+
+
+def _search_options(args):
+    """Parse the ranking parameters shared by /search and /search/batch"""
+    top_k = int(args.get('top_k', 10))
+    pooling = args.get('pooling', PRODUCT_POOLING)
+    if pooling not in POOLING_MODES:
+        raise SearchError(f"Invalid pooling '{pooling}', expected one of: {', '.join(POOLING_MODES)}")
+    try:
+        min_similarity = float(args.get('min_similarity', MIN_SIMILARITY_THRESHOLD))
+    except Exception:
+        min_similarity = MIN_SIMILARITY_THRESHOLD
+    try:
+        image_weight = float(args.get('image_weight', 0.7))
+    except Exception:
+        image_weight = 0.7
+    try:
+        text_weight = float(args.get('text_weight', 0.3))
+    except Exception:
+        text_weight = 0.3
+    try:
+        filters = SearchFilters.from_args(args)
+    except ValueError as exc:
+        raise SearchError(str(exc))
+    return {
+        "top_k": top_k,
+        "pooling": pooling,
+        "min_similarity": min_similarity,
+        "image_weight": image_weight,
+        "text_weight": text_weight,
+        "filters": filters,
+        # Live re-check of the filters on hydrated documents
+        "accept": filters.accepts if filters is not None else None,
+    }
+
+
+def _require_snapshot():
+    # Get resident embeddings (rows are already L2-normalized)
+    snapshot = get_product_embeddings()
+    if snapshot is None:
+        if not embedding_store.loaded:
+            raise SearchError("Embeddings are still loading", 503)
+        raise SearchError("No embeddings available", 500)
+    return snapshot
+
+
+def _fuse_query(image_embedding, text_embedding, options, caption_share=0.0):
+    """Returns (query vector for the image index, weight of the text -> caption scores)"""
+    # Cosine similarity is linear in the normalized query, so a weighted
+    # image + text query is a single vector searched once in the index.
+    if text_embedding is None:
+        return image_embedding, 0.0
+    total_weight = options["image_weight"] + options["text_weight"]
+    if total_weight <= 0:
+        total_weight = 1.0
+    text_to_image = options["text_weight"] * (1.0 - caption_share)
+    vector = (image_embedding * options["image_weight"] + text_embedding * text_to_image) / total_weight
+    return vector, options["text_weight"] * caption_share / total_weight
+
+
+def _caption_share(snapshot):
+    return CAPTION_TEXT_SHARE if snapshot.captions is not None else 0.0
+
+
+def _product_mask(snapshot, options):
+    """Filter mask over the snapshot's products (None = no filters, or files without attribute columns)"""
+    filters = options["filters"]
+    if filters is None:
+        return None
+    if snapshot.attributes is None:
+        print("⚠️  Embedding file has no attribute columns; filters are applied after hydration only")
+        return None
+    return snapshot.attributes.mask(filters)
+
+
+def _rank_candidates(snapshot, vector_ids, vector_scores, options, caption_scores=None, product_mask=None):
+    # Score, pool per product, threshold and select top-k in one vectorized pass.
+    # A few extra products are kept in case some were deleted since the last re-embed.
+    product_ordinals, product_scores = rank_products(
+        vector_ids,
+        vector_scores,
+        snapshot.product_index,
+        grouped=snapshot.grouped,
+        pooling=options["pooling"],
+        threshold=options["min_similarity"],
+        top_k=options["top_k"] + HYDRATION_SLACK,
+        product_scores=caption_scores,
+        product_mask=product_mask,
+    )
+    return [
+        (snapshot.product_keys[int(ordinal)], float(score))
+        for ordinal, score in zip(product_ordinals, product_scores)
+    ]
+
+
+def rank_query(query_image, query_text, args, timer=None):
+    """
+    Encode the query and rank products against the resident snapshot (CPU only, no I/O).
+    args: request query parameters. Returns ([(product_id, similarity)], options).
+    """
+    timer = timer or StageTimer()
+    snapshot = _require_snapshot()
+    product_info = snapshot.product_info
+    options = _search_options(args)
+
+    with timer.stage("encode"):
+        print("🔍 Encoding query image...")
+        query_embedding = encode_query_image(query_image)
+        text_embedding = None
+        if query_text:
+            print("📝 Encoding query text...")
+            text_embedding = encode_query_text(query_text)
+        search_vector, caption_weight = _fuse_query(query_embedding, text_embedding, options, _caption_share(snapshot))
+
+    print(f"🔍 Comparing with {len(snapshot)} products ({snapshot.index.name} index)...")
+    with timer.stage("similarity"):
+        product_mask = _product_mask(snapshot, options)
+        vector_ids, vector_scores = snapshot.index.candidates(search_vector)
+        caption_scores = None
+        if caption_weight:
+            caption_scores = snapshot.captions.product_scores(text_embedding) * caption_weight
+    with timer.stage("rank"):
+        ranked = _rank_candidates(snapshot, vector_ids, vector_scores, options, caption_scores, product_mask)
+
+    # Log top candidates for debugging
+    debug_top = min(5, len(ranked))
+    print(f"🔎 Top {debug_top} products ({options['pooling']} pooling):")
+    for rank, (product_id, similarity_score) in enumerate(ranked[:debug_top], start=1):
+        name = None
+        if product_info and product_info.get(product_id):
+            name = product_info[product_id].get("name")
+        print(f"  #{rank}: {product_id} | {name or 'unknown'} | {similarity_score:.4f}")
+
+    return ranked, options
+
+
+def rank_queries(query_images, query_texts, args, timer=None):
+    """
+    Batch version of rank_query: one encode call per kind for all cache misses,
+    then the whole batch is scored with blocked matrix multiplies.
+    Returns ([[(product_id, similarity)] per query], options).
+    """
+    timer = timer or StageTimer()
+    snapshot = _require_snapshot()
+    options = _search_options(args)
+
+    with timer.stage("encode"):
+        print(f"🔍 Encoding {len(query_images)} query images...")
+        vectors = encode_query_images(query_images)
+        with_text = [position for position, text in enumerate(query_texts) if text]
+        caption_weight = 0.0
+        if with_text:
+            text_embeddings = encode_query_texts([query_texts[position] for position in with_text])
+            vectors[with_text], caption_weight = _fuse_query(
+                vectors[with_text], text_embeddings, options, _caption_share(snapshot)
+            )
+
+    print(f"🔍 Comparing {len(vectors)} queries with {len(snapshot)} products ({snapshot.index.name} index)...")
+    # Scoring and pooling interleave per query block, so they share one stage here.
+    with timer.stage("similarity"):
+        product_mask = _product_mask(snapshot, options)
+        caption_scores = {}
+        if caption_weight:
+            # Every text query against every caption in one multiply
+            scores = snapshot.captions.product_scores(text_embeddings) * caption_weight
+            caption_scores = dict(zip(with_text, scores))
+        ranked_lists = [
+            _rank_candidates(snapshot, vector_ids, vector_scores, options, caption_scores.get(position), product_mask)
+            for position, (vector_ids, vector_scores) in enumerate(snapshot.index.candidates_many(vectors))
+        ]
+    return ranked_lists, options
+
+
+def _endpoint_label():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def start_request_timer():
+    g.timer = StageTimer(stage_seconds, endpoint=_endpoint_label())
+
+
+@app.after_request
+def record_request_metrics(response):
+    timer = g.get('timer')
+    if timer is not None:
+        record_request(_endpoint_label(), response.status_code, timer)
+        if debug_timing_requested(request.headers, request.args):
+            response.headers['X-Debug-Timing'] = timer.header()
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route('/update-embeddings', methods=['POST'])
+def update_embeddings():
+    json_data = request.get_json(silent=True) or {}
+    payload, status = start_embedding_update(json_data.get('mode') or request.args.get('mode'))
+    return jsonify(payload), status
+
+
+@app.route('/update-status', methods=['GET'])
+def get_update_status():
+    return jsonify(update_status_payload())
 
 @app.route('/', methods=['GET'])
 def index():
-    return jsonify({
-        "service": "UTEShop Image Search",
-        "status": "running",
-        "version": "1.0.0"
-    })
+    return jsonify(SERVICE_INFO)
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -260,11 +1138,77 @@ def health():
     except:
         pass
     
-    return jsonify({
-        "status": "ok" if mongo_ok else "degraded",
-        "mongodb": "connected" if mongo_ok else "disconnected",
-        "model": "loaded"
-    })
+    return jsonify(health_payload(mongo_ok))
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    try:
+        start_time = time.time()
+        timer = g.timer
+
+        if 'images' in request.files or 'image' in request.files:
+            files = [f for f in request.files.getlist('images') + request.files.getlist('image') if f.filename]
+            payloads = [f.read() for f in files]
+            texts = align_texts(request.form.getlist('texts'), len(payloads))
+            decode = decode_query_image
+        else:
+            payloads, texts = batch_queries_from_json(request.get_json(silent=True))
+            decode = decode_base64_image
+
+        if not payloads:
+            return jsonify({
+                "success": False,
+                "error": "No images provided"
+            }), 400
+        if len(payloads) > MAX_BATCH_QUERIES:
+            return jsonify({
+                "success": False,
+                "error": f"Too many queries ({len(payloads)}), the limit is {MAX_BATCH_QUERIES}"
+            }), 413
+
+        with timer.stage("decode"):
+            images, errors = decode_batch_images(payloads, decode)
+        ranked_by_position, options = rank_batch(images, texts, request.args, timer)
+
+        if products_collection is None:
+            return jsonify({
+                "success": False,
+                "error": "Database not connected"
+            }), 500
+
+        # One hydration query for every product in every result list
+        positions = list(ranked_by_position)
+        with timer.stage("hydrate"):
+            result_lists = hydrate_product_batches(
+                products_collection, [ranked_by_position[p] for p in positions], category_lookup, brand_lookup,
+                options["top_k"], options["accept"]
+            )
+        with timer.stage("serialize"):
+            return jsonify(batch_payload(errors, dict(zip(positions, result_lists)), start_time))
+
+    except SearchError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
+    except RequestEntityTooLarge:
+        return jsonify({
+            "success": False,
+            "error": f"Request body over {MAX_BATCH_REQUEST_BYTES / 1048576:.1f} MB"
+        }), 413
+    except Exception as e:
+        print(f"❌ Batch search error: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    payload, status = readiness_payload()
+    return jsonify(payload), status
 
 @app.route('/search', methods=['POST'])
 def search():
@@ -272,101 +1216,49 @@ def search():
         import time
         start_time = time.time()
         
-        query_image = None
-        query_text = None
-        
-        # Check for file upload
-        if 'image' in request.files:
-            file = request.files['image']
-            if file.filename != '':
-                print(f"📸 Received file: {file.filename}")
-                query_image = Image.open(file.stream)
-                if query_image.mode != 'RGB':
-                    query_image = query_image.convert('RGB')
-        
-        # Check for base64
-        if query_image is None:
-            json_data = request.get_json(silent=True)
-            if json_data and 'image_base64' in json_data:
-                print("📸 Received base64 image")
-                image_data = json_data['image_base64']
-                if ',' in image_data:
-                    image_data = image_data.split(',')[1]
-                img_bytes = base64.b64decode(image_data)
-                query_image = Image.open(io.BytesIO(img_bytes))
-                if query_image.mode != 'RGB':
-                    query_image = query_image.convert('RGB')
-            if json_data and json_data.get('text'):
-                query_text = str(json_data.get('text')).strip()
-
-        # Check for text in form data or query args
-        if query_text is None:
-            query_text = request.form.get('text') or request.args.get('text')
-            if query_text:
-                query_text = str(query_text).strip()
-        
+        # Werkzeug enforces this while reading the body, so chunked uploads
+        # without Content-Length are cut off at the same limit.
+        request.max_content_length = MAX_REQUEST_BYTES
+
+        timer = g.timer
+        with timer.stage("decode"):
+            query_image = None
+            query_text = None
+
+            # Raw image body (Content-Type: image/* or application/octet-stream)
+            if is_raw_image_type(request.content_type):
+                print("📸 Received raw image bytes")
+                query_image = decode_query_image(request.get_data(cache=False))
+
+            # Check for file upload
+            if query_image is None and 'image' in request.files:
+                file = request.files['image']
+                if file.filename != '':
+                    print(f"📸 Received file: {file.filename}")
+                    query_image = decode_query_image(file.read())
+
+            # Check for base64
+            if query_image is None:
+                json_data = request.get_json(silent=True)
+                if json_data and 'image_base64' in json_data:
+                    print("📸 Received base64 image")
+                    query_image = decode_base64_image(json_data['image_base64'])
+                if json_data and json_data.get('text'):
+                    query_text = str(json_data.get('text')).strip()
+
+            # Check for text in form data or query args
+            if query_text is None:
+                query_text = request.form.get('text') or request.args.get('text')
+                if query_text:
+                    query_text = str(query_text).strip()
+
         if query_image is None:
             return jsonify({
                 "success": False,
                 "error": "No image provided"
             }), 400
         
-        print("🔍 Encoding query image...")
-        model = get_model()
-        query_embedding = model.encode([query_image], convert_to_numpy=True)[0]
-        query_embedding = query_embedding.astype(np.float32)
-        
-        # Get cached embeddings
-        img_embeddings, product_ids, product_info = get_product_embeddings()
-        
-        if img_embeddings is None or len(img_embeddings) == 0:
-            return jsonify({
-                "success": False,
-                "error": "No embeddings available"
-            }), 500
-        
-        print(f"🔍 Comparing with {len(img_embeddings)} products...")
-        image_similarities = util.cos_sim(query_embedding, img_embeddings)[0]
-
-        text_similarities = None
-        if query_text:
-            print("📝 Encoding query text...")
-            text_embedding = model.encode([query_text], convert_to_numpy=True)[0]
-            text_embedding = text_embedding.astype(np.float32)
-            text_similarities = util.cos_sim(text_embedding, img_embeddings)[0]
-
-        # Combine image and text similarities when text is provided
-        if text_similarities is not None:
-            try:
-                image_weight = float(request.args.get('image_weight', 0.7))
-            except Exception:
-                image_weight = 0.7
-            try:
-                text_weight = float(request.args.get('text_weight', 0.3))
-            except Exception:
-                text_weight = 0.3
-
-            total_weight = image_weight + text_weight
-            if total_weight <= 0:
-                total_weight = 1.0
-
-            similarities = (image_similarities * image_weight + text_similarities * text_weight) / total_weight
-        else:
-            similarities = image_similarities
-
-        top_k = int(request.args.get('top_k', 10))
-        top_indices = similarities.argsort(descending=True)[:min(50, len(similarities))].cpu().numpy()
-
-        # Log top candidates for debugging
-        debug_top = min(5, len(top_indices))
-        print(f"🔎 Top {debug_top} similarity candidates:")
-        for rank, idx in enumerate(top_indices[:debug_top], start=1):
-            product_id = product_ids[int(idx)]
-            similarity_score = float(similarities[int(idx)])
-            name = None
-            if product_info and product_info.get(product_id):
-                name = product_info[product_id].get("name")
-            print(f"  #{rank}: {product_id} | {name or 'unknown'} | {similarity_score:.4f}")
+        ranked, options = rank_query(query_image, query_text, request.args, timer)
         
         if products_collection is None:
             return jsonify({
@@ -374,92 +1266,34 @@ def search():
                 "error": "Database not connected"
             }), 500
         
-        results = []
-        seen_products = {}
-        for idx in top_indices:
-            product_id = product_ids[int(idx)]
-            similarity_score = float(similarities[int(idx)])
-            
-            if similarity_score < 0.3:
-                continue
-            
-            # Deduplicate by product id, keep highest similarity
-            if product_id in seen_products:
-                if similarity_score <= seen_products[product_id]:
-                    continue
-            product = products_collection.find_one({"_id": ObjectId(product_id)})
-            if product:
-                category_info = None
-                if product.get("category"):
-                    if isinstance(product["category"], ObjectId):
-                        cat = db.categories.find_one({"_id": product["category"]})
-                        if cat:
-                            category_info = {"_id": str(cat["_id"]), "name": cat.get("name", "")}
-                    else:
-                        category_info = product["category"]
-                
-                brand_info = None
-                if product.get("brand"):
-                    if isinstance(product["brand"], ObjectId):
-                        brand = db.brands.find_one({"_id": product["brand"]})
-                        if brand:
-                            brand_info = {
-                                "_id": str(brand["_id"]),
-                                "name": brand.get("name", ""),
-                                "logo": brand.get("logo", "")
-                            }
-                    else:
-                        brand_info = product["brand"]
-                
-                stock = product.get("stock", 0)
-                
-                # Process sizes - convert ObjectId to string
-                raw_sizes = product.get("sizes", [])
-                processed_sizes = []
-                for s in raw_sizes:
-                    if isinstance(s, dict):
-                        processed_sizes.append({
-                            "size": s.get("size", ""),
-                            "stock": s.get("stock", 0),
-                            "_id": str(s.get("_id", "")) if s.get("_id") else ""
-                        })
-                    else:
-                        processed_sizes.append(s)
-                
-                results.append({
-                    "_id": product_id,
-                    "productId": product_id,
-                    "similarity": similarity_score,
-                    "name": product.get("name", ""),
-                    "description": product.get("description", ""),
-                    "price": product.get("price", 0),
-                    "stock": stock,
-                    "images": product.get("images", []),
-                    "sizes": processed_sizes,
-                    "category": category_info or str(product.get("category", "")),
-                    "brand": brand_info or str(product.get("brand", "")),
-                    "discountPercentage": product.get("discountPercentage", 0),
-                    "soldCount": product.get("soldCount", 0),
-                    "isActive": product.get("isActive", True),
-                    "isInStock": stock > 0
-                })
-                
-                seen_products[product_id] = similarity_score
-                if len(results) >= top_k:
-                    break
+        with timer.stage("hydrate"):
+            results = hydrate_products(
+                products_collection, ranked, category_lookup, brand_lookup, options["top_k"], options["accept"]
+            )
         
         results.sort(key=lambda x: -x["similarity"])
         
         search_time = time.time() - start_time
         print(f"✅ Found {len(results)} results in {search_time:.2f}s")
         
-        return jsonify({
-            "success": True,
-            "results": results,
-            "count": len(results),
-            "search_time": round(search_time, 2)
-        })
+        with timer.stage("serialize"):
+            return jsonify({
+                "success": True,
+                "results": results,
+                "count": len(results),
+                "search_time": round(search_time, 2)
+            })
     
+    except SearchError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
+    except RequestEntityTooLarge:
+        return jsonify({
+            "success": False,
+            "error": f"Request body over {MAX_REQUEST_BYTES / 1048576:.1f} MB"
+        }), 413
     except Exception as e:
         print(f"❌ Error: {e}")
         import traceback
@@ -0,0 +1,310 @@
+"""
+ASGI entry point for the image search service.
+
+Serves the same `/search`, `/search/batch`, `/health`, `/ready`, `/update-embeddings` and
+`/update-status` contract as the Flask app, but on an event loop: request
+bodies are read and products are hydrated through the async MongoDB
+driver (motor) without holding a thread, so many slow uploads can be in
+flight at once. CPU-bound work (image decoding, CLIP encoding, scoring)
+runs in a bounded thread pool.
+
+The resident embedding snapshot, vector index, query caches, batch
+encoder and background update task are shared with app.py.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 7860
+"""
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import app as service
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, StageTimer
+from product_hydration import hydrate_product_batches_async, hydrate_products_async
+
+# Threads for decode + encode + scoring; the batch encoder still runs one model pass at a time
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '8'))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+mongo_client = None
+products_collection = None
+
+
+async def run_blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_executor, functools.partial(func, *args))
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    global mongo_client, products_collection
+    if service.MONGO_URI:
+        mongo_client = AsyncIOMotorClient(service.MONGO_URI, serverSelectionTimeoutMS=5000)
+        products_collection = mongo_client['test'].products
+        # The first lookup table load is synchronous; do it here rather than inside a request.
+        try:
+            await run_blocking(service.category_lookup.get)
+            await run_blocking(service.brand_lookup.get)
+        except Exception as exc:
+            print(f"⚠️  Failed to warm lookup tables: {exc}")
+    print("🚀 ASGI image search service ready")
+    yield
+    if mongo_client is not None:
+        mongo_client.close()
+    search_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="UTEShop Image Search", lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Label by route path (not raw path) so unknown URLs do not grow the label set.
+    endpoint = request.url.path if request.url.path in _route_paths() else "unmatched"
+    timer = StageTimer(service.stage_seconds, endpoint=endpoint)
+    request.state.timer = timer
+    try:
+        response = await call_next(request)
+    except Exception:
+        service.record_request(endpoint, 500, timer)
+        raise
+    service.record_request(endpoint, response.status_code, timer)
+    if service.debug_timing_requested(request.headers, request.query_params):
+        response.headers['X-Debug-Timing'] = timer.header()
+    return response
+
+
+@functools.lru_cache(maxsize=1)
+def _route_paths():
+    return frozenset(route.path for route in app.routes)
+
+
+def _error(message, status):
+    return JSONResponse({"success": False, "error": message}, status_code=status)
+
+
+async def _read_body(request, limit):
+    """Read the body, giving up as soon as it exceeds `limit` bytes"""
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise service.SearchError(f"Request body over {limit / 1048576:.1f} MB", 413)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def _read_form(request, limit):
+    """
+    Parse a form from a body capped at `limit` bytes. `request.form()` alone
+    would spool a chunked upload (no Content-Length) to disk without any limit.
+    """
+    body = await _read_body(request, limit)
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return await Request(request.scope, receive).form()
+
+
+async def _read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+@app.post('/update-embeddings')
+async def update_embeddings(request: Request):
+    json_data = await _read_json(request) or {}
+    mode = json_data.get('mode') if isinstance(json_data, dict) else None
+    payload, status = service.start_embedding_update(mode or request.query_params.get('mode'))
+    return JSONResponse(payload, status_code=status)
+
+
+@app.get('/update-status')
+async def get_update_status():
+    return service.update_status_payload()
+
+
+@app.get('/metrics')
+async def metrics():
+    return Response(service.metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get('/')
+async def index():
+    return service.SERVICE_INFO
+
+
+@app.get('/health')
+async def health():
+    mongo_ok = False
+    try:
+        if mongo_client is not None:
+            await mongo_client.admin.command('ping')
+            mongo_ok = True
+    except Exception:
+        pass
+    return service.health_payload(mongo_ok)
+
+
+@app.get('/ready')
+async def ready():
+    payload, status = service.readiness_payload()
+    return JSONResponse(payload, status_code=status)
+
+
+@app.post('/search')
+async def search(request: Request):
+    try:
+        start_time = time.time()
+        timer = request.state.timer
+
+        query_image = None
+        query_text = None
+        content_type = request.headers.get('content-type', '')
+
+        content_length = request.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > service.MAX_REQUEST_BYTES:
+            return _error(f"Request body over {service.MAX_REQUEST_BYTES / 1048576:.1f} MB", 413)
+
+        decode_started = time.perf_counter()
+        if service.is_raw_image_type(content_type):
+            print("📸 Received raw image bytes")
+            data = await _read_body(request, service.MAX_UPLOAD_BYTES)
+            query_image = await run_blocking(service.decode_query_image, data)
+        elif content_type.startswith(('multipart/form-data', 'application/x-www-form-urlencoded')):
+            form = await _read_form(request, service.MAX_REQUEST_BYTES)
+            file = form.get('image')
+            if file is not None and getattr(file, 'filename', ''):
+                print(f"📸 Received file: {file.filename}")
+                query_image = await run_blocking(service.decode_query_image, await file.read())
+            if form.get('text'):
+                query_text = str(form.get('text')).strip()
+        else:
+            body = await _read_body(request, service.MAX_REQUEST_BYTES)
+            try:
+                json_data = json.loads(body) if body else None
+            except ValueError:
+                json_data = None
+            if isinstance(json_data, dict):
+                if 'image_base64' in json_data:
+                    print("📸 Received base64 image")
+                    query_image = await run_blocking(service.decode_base64_image, json_data['image_base64'])
+                if json_data.get('text'):
+                    query_text = str(json_data.get('text')).strip()
+
+        if not query_text and request.query_params.get('text'):
+            query_text = str(request.query_params.get('text')).strip()
+        # Includes reading the body, which is where slow uploads show up.
+        timer.add("decode", time.perf_counter() - decode_started)
+
+        if query_image is None:
+            return _error("No image provided", 400)
+
+        ranked, options = await run_blocking(service.rank_query, query_image, query_text, request.query_params, timer)
+
+        if products_collection is None:
+            return _error("Database not connected", 500)
+
+        with timer.stage("hydrate"):
+            results = await hydrate_products_async(
+                products_collection, ranked, service.category_lookup, service.brand_lookup,
+                options["top_k"], options["accept"]
+            )
+
+        results.sort(key=lambda x: -x["similarity"])
+
+        search_time = time.time() - start_time
+        print(f"✅ Found {len(results)} results in {search_time:.2f}s")
+
+        with timer.stage("serialize"):
+            return JSONResponse({
+                "success": True,
+                "results": results,
+                "count": len(results),
+                "search_time": round(search_time, 2)
+            })
+
+    except service.SearchError as e:
+        return _error(str(e), e.status)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        import traceback
+        traceback.print_exc()
+        return _error(str(e), 500)
+
+
+@app.post('/search/batch')
+async def search_batch(request: Request):
+    try:
+        start_time = time.time()
+        timer = request.state.timer
+        content_type = request.headers.get('content-type', '')
+
+        content_length = request.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > service.MAX_BATCH_REQUEST_BYTES:
+            return _error(f"Request body over {service.MAX_BATCH_REQUEST_BYTES / 1048576:.1f} MB", 413)
+
+        if content_type.startswith('multipart/form-data'):
+            form = await _read_form(request, service.MAX_BATCH_REQUEST_BYTES)
+            files = [f for f in form.getlist('images') + form.getlist('image') if getattr(f, 'filename', '')]
+            payloads = [await f.read() for f in files]
+            texts = service.align_texts(form.getlist('texts'), len(payloads))
+            decode = service.decode_query_image
+        else:
+            body = await _read_body(request, service.MAX_BATCH_REQUEST_BYTES)
+            try:
+                json_data = json.loads(body) if body else None
+            except ValueError:
+                json_data = None
+            payloads, texts = service.batch_queries_from_json(json_data)
+            decode = service.decode_base64_image
+
+        if not payloads:
+            return _error("No images provided", 400)
+        if len(payloads) > service.MAX_BATCH_QUERIES:
+            return _error(f"Too many queries ({len(payloads)}), the limit is {service.MAX_BATCH_QUERIES}", 413)
+
+        with timer.stage("decode"):
+            images, errors = await run_blocking(service.decode_batch_images, payloads, decode)
+        ranked_by_position, options = await run_blocking(service.rank_batch, images, texts, request.query_params, timer)
+
+        if products_collection is None:
+            return _error("Database not connected", 500)
+
+        positions = list(ranked_by_position)
+        with timer.stage("hydrate"):
+            result_lists = await hydrate_product_batches_async(
+                products_collection, [ranked_by_position[p] for p in positions],
+                service.category_lookup, service.brand_lookup, options["top_k"], options["accept"]
+            )
+        with timer.stage("serialize"):
+            return JSONResponse(service.batch_payload(errors, dict(zip(positions, result_lists)), start_time))
+
+    except service.SearchError as e:
+        return _error(str(e), e.status)
+    except Exception as e:
+        print(f"❌ Batch search error: {e}")
+        import traceback
+        traceback.print_exc()
+        return _error(str(e), 500)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', 7860))
+    print(f"🚀 Starting ASGI server on port {port}...")
+    uvicorn.run(app, host='0.0.0.0', port=port)
@@ -0,0 +1,110 @@
+"""
+Micro-batching scheduler for CLIP inference.
+
+Concurrent /search requests submit their image or text to a queue and
+block on a Future. A single worker thread drains the queue, runs one
+`model.encode` per kind (images, texts) for everything it collected and
+hands each caller its row.
+
+When the previous batch held a single item (idle service) the worker runs
+immediately, so single-request latency is unchanged. Once concurrent
+requests show up it waits up to `max_wait_ms` to fill a batch of at most
+`max_batch_size` items.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+KINDS = ("image", "text")
+
+
+class BatchEncoder:
+    def __init__(self, get_model, max_batch_size=16, max_wait_ms=5):
+        self._get_model = get_model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._last_batch_size = 1
+        self.batches = 0
+        self.items = 0
+        self.max_observed_batch = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="clip-batch-encoder", daemon=True)
+                self._thread.start()
+
+    def submit(self, kind, item):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown encode kind: {kind!r}")
+        self.start()
+        future = Future()
+        self._queue.put((kind, item, future))
+        return future
+
+    def encode(self, kind, item, timeout=None):
+        return self.submit(kind, item).result(timeout=timeout)
+
+    def encode_many(self, kind, items, timeout=None):
+        futures = [self.submit(kind, item) for item in items]
+        return [future.result(timeout=timeout) for future in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        # Under load, give other requests a few ms to join the batch.
+        deadline = time.monotonic() + (self.max_wait if self._last_batch_size > 1 else 0.0)
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_group(self, model, group):
+        try:
+            vectors = model.encode([item for item, _ in group], batch_size=len(group), convert_to_numpy=True)
+        except Exception as exc:
+            for _, future in group:
+                future.set_exception(exc)
+            return
+        for (_, future), vector in zip(group, vectors):
+            future.set_result(vector)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._last_batch_size = len(batch)
+            self.batches += 1
+            self.items += len(batch)
+            self.max_observed_batch = max(self.max_observed_batch, len(batch))
+
+            try:
+                model = self._get_model()
+            except Exception as exc:
+                for _, _, future in batch:
+                    future.set_exception(exc)
+                continue
+
+            for kind in KINDS:
+                group = [(item, future) for item_kind, item, future in batch if item_kind == kind]
+                if group:
+                    self._run_group(model, group)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "queue_depth": self._queue.qsize(),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_observed_batch": self.max_observed_batch,
+        }
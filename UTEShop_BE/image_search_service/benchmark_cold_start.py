@@ -0,0 +1,101 @@
+"""
+Cold-start benchmark for the CLIP model lifecycle.
+
+Each run is a fresh Python process, so every run pays the real import and
+load cost. Each run reports:
+
+  import      import torch + sentence_transformers
+  load        SentenceTransformer(model) construction
+  warmup      warmup_clip() pass, as done at service startup (--warmup runs only)
+  first       first image + text query encode after load
+  steady      mean of the following queries
+
+Both variants run by default. The "first" column shows the latency the
+first shopper after a deploy pays with and without warmup.
+
+Run:
+  python benchmark_cold_start.py
+  python benchmark_cold_start.py --model clip-ViT-B-32 --runs 5 --variants warmup
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def child(args):
+    started = time.perf_counter()
+    import torch  # noqa: F401
+    from sentence_transformers import SentenceTransformer
+    from PIL import Image
+
+    from model_lifecycle import warmup_clip
+
+    timings = {"import": time.perf_counter() - started}
+
+    started = time.perf_counter()
+    model = SentenceTransformer(args.model)
+    timings["load"] = time.perf_counter() - started
+
+    timings["warmup"] = 0.0
+    if args.warmup:
+        started = time.perf_counter()
+        warmup_clip(model, args.warmup_batch_sizes)
+        timings["warmup"] = time.perf_counter() - started
+
+    image = Image.new("RGB", (640, 480), (200, 80, 40))
+    latencies = []
+    for _ in range(1 + args.queries):
+        started = time.perf_counter()
+        model.encode([image], convert_to_numpy=True)
+        model.encode(["red cotton t-shirt"], convert_to_numpy=True)
+        latencies.append(time.perf_counter() - started)
+    timings["first"] = latencies[0]
+    timings["steady"] = sum(latencies[1:]) / max(1, len(latencies) - 1)
+    print(json.dumps(timings))
+
+
+def run_once(args, warmup):
+    command = [
+        sys.executable, os.path.abspath(__file__), "--child",
+        "--model", args.model,
+        "--queries", str(args.queries),
+        "--warmup-batch-sizes", *[str(size) for size in args.warmup_batch_sizes],
+    ]
+    if warmup:
+        command.append("--warmup")
+    started = time.perf_counter()
+    output = subprocess.run(command, check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    timings = json.loads(output.stdout.strip().splitlines()[-1])
+    timings["process"] = time.perf_counter() - started
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("CLIP_MODEL_NAME", "uteshop-clip"))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=10, help="Queries after the first one")
+    parser.add_argument("--variants", nargs="+", choices=["cold", "warmup"], default=["cold", "warmup"])
+    parser.add_argument("--warmup-batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--warmup", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    columns = ["import", "load", "warmup", "first", "steady", "process"]
+    print(f"Model: {args.model}, {args.runs} runs per variant (seconds, median)")
+    print(f"{'variant':<10}" + "".join(f"{name:>10}" for name in columns))
+    for variant in args.variants:
+        runs = [run_once(args, warmup=variant == "warmup") for _ in range(args.runs)]
+        medians = {name: sorted(run[name] for run in runs)[len(runs) // 2] for name in columns}
+        print(f"{variant:<10}" + "".join(f"{medians[name]:>10.3f}" for name in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Latency / throughput benchmark for the CLIP encoder backends across CPU thread counts.
+
+For each backend and thread count the script reports:
+
+  img p50 / p95   single-image encode latency (one /search query)
+  img/s           images per second at --batch-size (embedding updates, /search/batch)
+  txt p50         single-text encode latency
+
+Run:
+  python benchmark_encoder.py
+  python benchmark_encoder.py --backends torch onnx --threads 1 2 4 8 --batch-size 32
+  python benchmark_encoder.py --backends onnx --fp32   # un-quantized ONNX files
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from model_lifecycle import warmup_clip
+from onnx_encoder import BACKENDS, load_encoder
+
+
+def timed(run, repeats):
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - started)
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("CLIP_MODEL_NAME", "uteshop-clip"))
+    parser.add_argument("--onnx-dir", default=os.getenv("CLIP_ONNX_DIR", "onnx_models/uteshop-clip"))
+    parser.add_argument("--fp32", action="store_true", help="Use the fp32 ONNX files instead of int8")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 4])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 255, (224, 224, 3), dtype=np.uint8)) for _ in range(args.batch_size)]
+    text = "áo thun cotton màu đỏ"
+
+    print(f"Model: {args.model}, batch size {args.batch_size}, {args.repeats} repeats")
+    print(f"{'backend':<12}{'threads':>8}{'img p50 ms':>12}{'img p95 ms':>12}{'img/s':>10}{'txt p50 ms':>12}")
+    for backend in args.backends:
+        for threads in sorted(set(args.threads)):
+            encoder = load_encoder(backend, args.model, onnx_dir=args.onnx_dir, quantized=not args.fp32, threads=threads)
+            warmup_clip(encoder, (1, args.batch_size))
+
+            single = timed(lambda: encoder.encode([images[0]], batch_size=1, convert_to_numpy=True), args.repeats)
+            batch = timed(lambda: encoder.encode(images, batch_size=args.batch_size, convert_to_numpy=True),
+                          max(3, args.repeats // 4))
+            texts = timed(lambda: encoder.encode([text], batch_size=1, convert_to_numpy=True), args.repeats)
+
+            print(
+                f"{backend:<12}{threads:>8}"
+                f"{np.percentile(single, 50) * 1000:>12.1f}{np.percentile(single, 95) * 1000:>12.1f}"
+                f"{args.batch_size / batch.mean():>10.1f}{np.percentile(texts, 50) * 1000:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
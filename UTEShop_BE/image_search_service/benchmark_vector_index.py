@@ -0,0 +1,96 @@
+"""
+Recall vs latency benchmark for the vector index backends.
+
+Generates clustered synthetic unit vectors (a mixture of Gaussians, which
+behaves like real CLIP embeddings far better than uniform noise), builds
+each backend and reports build time, per-query latency and recall@k
+against the exact backend.
+
+Run:
+  python benchmark_vector_index.py
+  python benchmark_vector_index.py --sizes 10000 100000 --nprobe 4 8 16 32
+
+Note: 1M x 512 float32 vectors need ~2 GB of RAM; use --dim 256 on
+smaller machines.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from embedding_store import normalize_rows
+from vector_index import ExactIndex, IVFIndex
+
+
+def make_dataset(size, dim, clusters, queries, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((clusters, dim)).astype(np.float32))
+    labels = rng.integers(0, clusters, size)
+
+    data = np.empty((size, dim), dtype=np.float32)
+    chunk = 100000
+    for start in range(0, size, chunk):
+        part = labels[start:start + chunk]
+        noise = rng.standard_normal((len(part), dim)).astype(np.float32) * 0.08
+        data[start:start + len(part)] = centers[part] + noise
+    data = normalize_rows(data)
+
+    # Queries are perturbed catalogue vectors, like a shopper photo of a listed product.
+    picked = data[rng.choice(size, queries, replace=False)]
+    query_vectors = normalize_rows(picked + rng.standard_normal(picked.shape).astype(np.float32) * 0.05)
+    return data, query_vectors
+
+
+def time_queries(search, queries):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        indices, _ = search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(indices)
+    latencies = np.array(latencies)
+    return results, float(latencies.mean()), float(np.percentile(latencies, 95))
+
+
+def recall(results, truth):
+    hits = sum(len(np.intersect1d(found, expected)) for found, expected in zip(results, truth))
+    return hits / sum(len(expected) for expected in truth)
+
+
+def run(size, args):
+    print(f"\n=== {size:,} vectors x {args.dim} dims ===")
+    data, queries = make_dataset(size, args.dim, max(16, size // 200), args.queries, seed=args.seed)
+
+    exact = ExactIndex.build(data)
+    truth, mean_ms, p95_ms = time_queries(lambda q: exact.search(q, args.k), queries)
+    print(f"{'backend':<22}{'build (s)':>10}{'mean (ms)':>11}{'p95 (ms)':>10}{'recall@' + str(args.k):>11}")
+    print(f"{'exact':<22}{0.0:>10.2f}{mean_ms:>11.2f}{p95_ms:>10.2f}{1.0:>11.3f}")
+
+    start = time.perf_counter()
+    ivf = IVFIndex.build(data, nlist=args.nlist or None, seed=args.seed)
+    build_s = time.perf_counter() - start
+
+    for nprobe in args.nprobe:
+        results, mean_ms, p95_ms = time_queries(lambda q: ivf.search(q, args.k, nprobe=nprobe), queries)
+        label = f"ivf nlist={len(ivf.centroids)} np={nprobe}"
+        print(f"{label:<22}{build_s:>10.2f}{mean_ms:>11.2f}{p95_ms:>10.2f}{recall(results, truth):>11.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = 4*sqrt(N))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        run(size, args)
+
+
+if __name__ == "__main__":
+    main()
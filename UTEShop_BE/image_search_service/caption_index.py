@@ -0,0 +1,93 @@
+"""
+Product caption index for hybrid text + image search.
+
+The embedding update encodes each product's captions (the same captions
+the CLIP fine-tune is trained on, from `export_train_data.build_captions`).
+It stores them next to the image matrix. At query time the text embedding
+is scored against every caption in one matrix multiply. The result is
+max-pooled per product with `np.maximum.reduceat` and added to the
+pooled image score:
+
+    score = (wi * image.image + wt * (1 - s) * text.image + wt * s * text.caption) / (wi + wt)
+
+where `s` is CAPTION_TEXT_SHARE. The first two terms are already a single
+fused query vector, so scoring stays one pass over each matrix.
+"""
+import hashlib
+
+import numpy as np
+
+
+def _reference_name(value, table):
+    from export_train_data import clean_text
+
+    if not value:
+        return ""
+    if isinstance(value, dict):
+        return clean_text(value.get("name", ""))
+    info = table.get(str(value))
+    return clean_text(info.get("name", "")) if info else ""
+
+
+def product_captions(product, categories, brands):
+    """Captions for one product; categories/brands are the id -> doc lookup tables"""
+    # Imported lazily: export_train_data loads .env files at import time.
+    from export_train_data import build_captions
+
+    return build_captions(
+        product,
+        _reference_name(product.get("category"), categories),
+        _reference_name(product.get("brand"), brands),
+    )
+
+
+def caption_key(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:32]
+
+
+class CaptionIndex:
+    """Caption vectors grouped by product ordinal (the snapshot's product_keys order)"""
+
+    def __init__(self, embeddings, product_ids, keys, product_ordinals, num_products):
+        ordinals = np.array([product_ordinals.get(product_id, -1) for product_id in product_ids], dtype=np.int64)
+        rows = np.flatnonzero(ordinals >= 0)
+        rows = rows[np.argsort(ordinals[rows], kind="stable")]
+        keys = np.asarray(keys)
+        if len(rows) == len(ordinals) and np.all(rows == np.arange(len(rows))):
+            # Written in product order (the normal case): keep the memory-mapped matrix.
+            self.embeddings = embeddings
+        else:
+            self.embeddings = np.asarray(embeddings[rows], dtype=np.float32)
+        self.products = ordinals[rows]
+        self.keys = keys[rows]
+        self.num_products = num_products
+
+        if len(self.products):
+            self.starts = np.flatnonzero(np.concatenate(([True], self.products[1:] != self.products[:-1])))
+        else:
+            self.starts = np.empty(0, dtype=np.int64)
+        self.run_products = self.products[self.starts]
+
+    def __len__(self):
+        return len(self.products)
+
+    def rows_by_key(self):
+        return {key.decode("ascii") if isinstance(key, bytes) else str(key): row for row, key in enumerate(self.keys)}
+
+    def product_scores(self, text_vectors):
+        """
+        text_vectors: (dim,) or (n, dim) normalized.
+        Returns best caption similarity per product: (num_products,) or (n, num_products).
+        Products without captions score 0.
+        """
+        text_vectors = np.asarray(text_vectors, dtype=np.float32)
+        single = text_vectors.ndim == 1
+        queries = text_vectors[None] if single else text_vectors
+        dense = np.zeros((self.num_products, len(queries)), dtype=np.float32)
+        if len(self.products):
+            scores = np.asarray(self.embeddings.dot(queries.T), dtype=np.float32).reshape(len(self.products), -1)
+            dense[self.run_products] = np.maximum.reduceat(scores, self.starts, axis=0)
+        return dense[:, 0] if single else np.ascontiguousarray(dense.T)
+
+    def info(self):
+        return {"captions": len(self), "products": len(self.run_products)}
@@ -1,23 +1,60 @@
 """
 Download product images referenced by training_data/train.jsonl.
 
+Downloads go through the shared image cache (IMAGE_CACHE_DIR), so images
+already fetched by an embedding update are read from local disk.
+
+- A bounded thread pool downloads and re-encodes images concurrently over
+  one pooled HTTP session. Connection errors, 429 and 5xx responses are
+  retried with exponential backoff (honoring Retry-After).
+- Every finished image is appended to training_data/images_manifest.jsonl
+  with the SHA-256 and size of the written file. A re-run skips manifest
+  entries whose file is still there with the same size, without decoding
+  it again. --verify re-hashes them instead.
+- Files are written to a temp name and renamed, so an interrupted run
+  never leaves a truncated JPEG behind.
+- Throughput counts only bytes that came over the network, against the
+  wall time during which at least one such request was in flight. Bytes
+  served by the image cache are reported separately.
+
 Run:
   python download_training_images.py
+  python download_training_images.py --workers 16 --retries 5
+  python download_training_images.py --verify
 """
+import argparse
+import hashlib
 import json
 import os
-from pathlib import Path
-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
+from pathlib import Path
 
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from image_cache import ImageCache
 
-DATA_PATH = Path("training_data/train.jsonl")
-IMAGE_DIR = Path("training_data/images")
+
+DATA_DIR = Path("training_data")
+DATA_PATH = DATA_DIR / "train.jsonl"
+IMAGE_DIR = DATA_DIR / "images"
+MANIFEST_PATH = DATA_DIR / "images_manifest.jsonl"
 TIMEOUT = 30
 
+# Body bytes received by the current worker thread's last request
+_network = threading.local()
+
+
+def count_network_bytes(response, *args, **kwargs):
+    if response.status_code == 200:
+        _network.bytes = getattr(_network, "bytes", 0) + len(response.content)
+    return response
+
 
 def iter_unique_images():
     seen = set()
@@ -32,60 +69,206 @@ def iter_unique_images():
             yield image_path, image_url
 
 
-def download_image(image_path, image_url):
-    output_path = Path("training_data") / image_path
+def build_session(workers, retries, backoff):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=workers,
+        pool_maxsize=workers,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            respect_retry_after_header=True,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(count_network_bytes)
+    return session
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest():
+    """image path -> last manifest entry"""
+    entries = {}
+    if MANIFEST_PATH.exists():
+        with MANIFEST_PATH.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A run killed mid-write can leave a partial last line.
+                    continue
+                entries[entry["image"]] = entry
+    return entries
+
+
+def is_complete(entry, image_url, verify):
+    output_path = DATA_DIR / entry["image"]
+    if entry.get("url") != image_url or not output_path.exists():
+        return False
+    if output_path.stat().st_size != entry.get("bytes"):
+        return False
+    return not verify or file_sha256(output_path) == entry.get("sha256")
+
+
+def download_image(cache, image_path, image_url):
+    """Returns (manifest entry, network bytes, network (start, end) or None, cached bytes)"""
+    output_path = DATA_DIR / image_path
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    if output_path.exists() and output_path.stat().st_size > 0:
-        try:
-            with Image.open(output_path) as image:
-                image.verify()
-            return "skipped"
-        except Exception:
-            pass
-
-    response = requests.get(
-        image_url,
-        timeout=TIMEOUT,
-        headers={"User-Agent": "Mozilla/5.0"},
-    )
-    response.raise_for_status()
+    _network.bytes = 0
+    started = time.perf_counter()
+    data = cache.fetch(image_url, timeout=TIMEOUT)
+    network_bytes = _network.bytes
+    network_span = (started, time.perf_counter()) if network_bytes else None
+    with Image.open(BytesIO(data)) as image:
+        buffer = BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=95)
+
+    encoded = buffer.getvalue()
+    tmp_path = output_path.with_name(output_path.name + ".part")
+    tmp_path.write_bytes(encoded)
+    os.replace(tmp_path, output_path)
+
+    entry = {
+        "image": image_path,
+        "url": image_url,
+        "sha256": hashlib.sha256(encoded).hexdigest(),
+        "bytes": len(encoded),
+    }
+    return entry, network_bytes, network_span, 0 if network_bytes else len(data)
+
+
+def adopt_existing(image_path, image_url):
+    """Manifest entry for a valid file written before the manifest existed, else None"""
+    output_path = DATA_DIR / image_path
+    if not output_path.exists() or output_path.stat().st_size == 0:
+        return None
+    try:
+        with Image.open(output_path) as image:
+            image.verify()
+    except Exception:
+        return None
+    return {
+        "image": image_path,
+        "url": image_url,
+        "sha256": file_sha256(output_path),
+        "bytes": output_path.stat().st_size,
+    }
+
+
+def busy_seconds(spans):
+    """Length of the union of (start, end) spans: wall time with a request in flight"""
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(spans):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
 
-    with Image.open(BytesIO(response.content)) as image:
-        image = image.convert("RGB")
-        image.save(output_path, format="JPEG", quality=95)
-    return "downloaded-jpeg"
+
+def network_rate(network_bytes, spans):
+    """MB/s over network requests only"""
+    seconds = busy_seconds(spans)
+    return network_bytes / 1024 / 1024 / seconds if seconds else 0.0
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Download training images")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=0.5,
+                        help="Exponential backoff factor in seconds (0.5 -> 0.5s, 1s, 2s, ...)")
+    parser.add_argument("--verify", action="store_true", help="Re-hash files listed in the manifest")
+    args = parser.parse_args()
+
     if not DATA_PATH.exists():
         raise FileNotFoundError(f"Missing {DATA_PATH}. Run export_train_data.py first.")
 
     IMAGE_DIR.mkdir(parents=True, exist_ok=True)
 
+    images = list(iter_unique_images())
+    manifest = load_manifest()
+    pending = [
+        (image_path, image_url)
+        for image_path, image_url in images
+        if not (image_path in manifest and is_complete(manifest[image_path], image_url, args.verify))
+    ]
+    print(f"Found {len(images)} unique images, {len(images) - len(pending)} already in the manifest")
+
+    session = build_session(args.workers, args.retries, args.backoff)
+    cache = ImageCache(session=session, headers={"User-Agent": "Mozilla/5.0"})
+
     downloaded = 0
-    skipped = 0
+    adopted = 0
     failed = 0
+    network_bytes = 0
+    network_spans = []
+    cached_bytes = 0
+    written_bytes = 0
+    started = time.perf_counter()
 
-    images = list(iter_unique_images())
-    print(f"Found {len(images)} unique images")
+    def work(image_path, image_url):
+        entry = adopt_existing(image_path, image_url) if image_path not in manifest else None
+        if entry is not None:
+            return "skipped", entry, (0, None, 0)
+        entry, *transfer = download_image(cache, image_path, image_url)
+        return "downloaded", entry, transfer
+
+    # Manifest lines are appended from this thread only.
+    with MANIFEST_PATH.open("a", encoding="utf-8") as manifest_file, \
+            ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(work, image_path, image_url): image_path for image_path, image_url in pending}
+        for index, future in enumerate(as_completed(futures), start=1):
+            image_path = futures[future]
+            try:
+                status, entry, (size, span, cached) = future.result()
+            except Exception as exc:
+                failed += 1
+                print(f"[{index}/{len(pending)}] failed: {image_path} - {exc}")
+                continue
 
-    for index, (image_path, image_url) in enumerate(images, start=1):
-        try:
-            status = download_image(image_path, image_url)
+            manifest_file.write(json.dumps(entry) + "\n")
+            manifest_file.flush()
             if status == "downloaded":
                 downloaded += 1
+                network_bytes += size
+                if span is not None:
+                    network_spans.append(span)
+                cached_bytes += cached
+                written_bytes += entry["bytes"]
             else:
-                skipped += 1
-            print(f"[{index}/{len(images)}] {status}: {image_path}")
-        except Exception as exc:
-            failed += 1
-            print(f"[{index}/{len(images)}] failed: {image_path} - {exc}")
+                adopted += 1
+            if index % 50 == 0 or index == len(pending):
+                elapsed = time.perf_counter() - started
+                print(f"[{index}/{len(pending)}] {index / elapsed:.1f} images/s, "
+                      f"network {network_rate(network_bytes, network_spans):.2f} MB/s")
 
+    elapsed = time.perf_counter() - started
     print("Done")
     print(f"Downloaded: {downloaded}")
-    print(f"Skipped: {skipped}")
+    print(f"Skipped: {len(images) - len(pending) + adopted} ({adopted} existing files added to the manifest)")
     print(f"Failed: {failed}")
+    print(f"Time: {elapsed:.1f}s, {downloaded / elapsed if elapsed else 0:.1f} images/s")
+    print(f"Network: {network_bytes / 1024 / 1024:.1f} MB in {len(network_spans)} downloads over "
+          f"{busy_seconds(network_spans):.1f}s, {network_rate(network_bytes, network_spans):.2f} MB/s")
+    print(f"From image cache: {cached_bytes / 1024 / 1024:.1f} MB, written: {written_bytes / 1024 / 1024:.1f} MB")
+    print(f"Image cache: {cache.stats()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+"""
+Per-image embedding records for incremental re-embedding.
+
+Every (product_id, image_url) pair gets one document in the
+`product_image_embeddings` collection holding its float32 vector, the
+sha256 of the downloaded image bytes and the product's `updatedAt` at the
+time it was encoded. An update diffs these records against the current
+products:
+
+- unchanged product (same updatedAt): the stored vector is reused, no download
+- changed product: the image is re-downloaded; if its content hash still
+  matches, the stored vector is kept and only the stamp is refreshed
+- new image URL: downloaded and encoded
+- records whose product was deactivated or whose image was removed are deleted
+
+Records carry the encoder tag (model name plus CLIP_BACKEND, see
+onnx_encoder.encoder_tag). Records with any other tag are never reused and
+are deleted by the next update.
+"""
+import hashlib
+
+import numpy as np
+from bson import Binary
+from pymongo import ReplaceOne, UpdateOne
+
+
+def url_hash(image_url):
+    return hashlib.sha1(image_url.encode("utf-8")).hexdigest()
+
+
+def record_key(product_id, image_url):
+    return f"{product_id}:{url_hash(image_url)[:16]}"
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def embedding_to_binary(embedding):
+    return Binary(np.asarray(embedding, dtype=np.float32).tobytes())
+
+
+def embedding_from_binary(data):
+    return np.frombuffer(data, dtype=np.float32)
+
+
+class ImageTarget:
+    __slots__ = ("key", "product_id", "image_url", "product_updated_at")
+
+    def __init__(self, key, product_id, image_url, product_updated_at):
+        self.key = key
+        self.product_id = product_id
+        self.image_url = image_url
+        self.product_updated_at = product_updated_at
+
+
+class UpdatePlan:
+    def __init__(self, targets, fetch, reuse, stale, known_hashes, missing_urls):
+        self.targets = targets            # every wanted image, in catalog order
+        self.fetch = fetch                # targets that must be downloaded
+        self.reuse = reuse                # keys whose stored vector is still valid
+        self.stale = stale                # record keys to delete
+        self.known_hashes = known_hashes  # key -> stored content hash (for fetched targets)
+        self.missing_urls = missing_urls
+
+
+def load_records(collection, model_name):
+    return {doc["_id"]: doc for doc in collection.find({"model_name": model_name})}
+
+
+def plan_update(products, records, incremental=True):
+    targets = []
+    seen = set()
+    missing_urls = 0
+
+    for product in products:
+        product_id = str(product.get("_id"))
+        updated_at = product.get("updatedAt")
+        for image_url in product.get("images", []):
+            if not image_url:
+                missing_urls += 1
+                continue
+            key = record_key(product_id, image_url)
+            if key in seen:
+                continue
+            seen.add(key)
+            targets.append(ImageTarget(key, product_id, image_url, updated_at))
+
+    fetch = []
+    reuse = set()
+    known_hashes = {}
+    for target in targets:
+        record = records.get(target.key)
+        if incremental and record is not None:
+            if updated_at_matches(record.get("product_updated_at"), target.product_updated_at):
+                reuse.add(target.key)
+                continue
+            if record.get("content_hash"):
+                known_hashes[target.key] = record["content_hash"]
+        fetch.append(target)
+
+    stale = [key for key in records if key not in seen]
+    return UpdatePlan(targets, fetch, reuse, stale, known_hashes, missing_urls)
+
+
+def updated_at_matches(stored, current):
+    # Products without timestamps can never be trusted as unchanged.
+    return stored is not None and current is not None and stored == current
+
+
+def build_record(target, embedding, digest, model_name, now):
+    return {
+        "_id": target.key,
+        "product_id": target.product_id,
+        "image_url": target.image_url,
+        "url_hash": url_hash(target.image_url),
+        "content_hash": digest,
+        "product_updated_at": target.product_updated_at,
+        "model_name": model_name,
+        "dim": int(len(embedding)),
+        "embedding": embedding_to_binary(embedding),
+        "updated_at": now,
+    }
+
+
+def save_changes(collection, targets_by_key, fetched, model_name, now, chunk_size=500):
+    """
+    fetched: [(key, embedding or None, content_hash)]; None means the image
+    bytes were unchanged and only the product stamp needs refreshing.
+    """
+    operations = []
+    for key, embedding, digest in fetched:
+        target = targets_by_key[key]
+        if embedding is None:
+            operations.append(UpdateOne(
+                {"_id": key},
+                {"$set": {"product_updated_at": target.product_updated_at, "updated_at": now}},
+            ))
+        else:
+            operations.append(ReplaceOne(
+                {"_id": key},
+                build_record(target, embedding, digest, model_name, now),
+                upsert=True,
+            ))
+
+    for start in range(0, len(operations), chunk_size):
+        collection.bulk_write(operations[start:start + chunk_size], ordered=False)
+    return len(operations)
+
+
+def delete_stale(collection, stale_keys, model_name, chunk_size=1000):
+    deleted = 0
+    for start in range(0, len(stale_keys), chunk_size):
+        result = collection.delete_many({"_id": {"$in": stale_keys[start:start + chunk_size]}})
+        deleted += result.deleted_count
+    # Vectors from a previous CLIP model or encoder backend can never be reused.
+    deleted += collection.delete_many({"model_name": {"$ne": model_name}}).deleted_count
+    return deleted
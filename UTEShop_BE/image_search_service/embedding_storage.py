@@ -0,0 +1,268 @@
+"""
+Binary storage for the published embedding matrix.
+
+The matrix is written as a single `.emb` file instead of nested BSON
+doubles:
+
+    8 bytes   magic "UTEEMB01"
+    4 bytes   little-endian header length
+    N bytes   JSON header (metadata + section table)
+    sections  raw little-endian arrays, each aligned to 64 bytes
+
+Sections: `embeddings` (float32, float16 or int8 rows), `scales` (per-row
+float32 scale for int8), `product_ids`, `product_info` (gzipped JSON),
+`index.<name>` arrays holding the persisted vector index state and the
+optional caption index (`captions.embeddings` / `.scales` / `.product_ids`
+/ `.keys`, stored with the same dtype as the image rows) and per-product
+filter columns (`attributes.<name>`).
+
+The file is uploaded to GridFS (which chunks it, so there is no 16 MB
+document limit) and cached on local disk, where it is memory-mapped on
+load: startup cost and resident memory no longer grow with the JSON size
+of the catalog.
+"""
+import gzip
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+MAGIC = b"UTEEMB01"
+ALIGN = 64
+FORMAT_VERSION = 1
+STORAGE_DTYPES = ("float32", "float16", "int8")
+
+
+class StoredMatrix:
+    """Read-only, row-normalized matrix backed by a (possibly quantized) memmap"""
+
+    normalized = True
+
+    def __init__(self, data, scales=None, chunk_rows=65536):
+        self.data = data
+        self.scales = scales
+        self.chunk_rows = chunk_rows
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        rows = np.asarray(self.data[key], dtype=np.float32)
+        if self.scales is not None:
+            scales = np.asarray(self.scales[key], dtype=np.float32)
+            rows = rows * (scales[..., None] if rows.ndim > 1 else scales)
+        return rows
+
+    def dot(self, query):
+        """query: (dim,) or (dim, n) -> scores (rows,) or (rows, n)"""
+        if self.data.dtype == np.float32 and self.scales is None:
+            return self.data @ query
+        # Dequantize block by block so scoring never materializes a float32 copy.
+        scores = np.empty((len(self.data),) + query.shape[1:], dtype=np.float32)
+        for start in range(0, len(self.data), self.chunk_rows):
+            stop = start + self.chunk_rows
+            scores[start:stop] = np.asarray(self.data[start:stop], dtype=np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales.reshape((-1,) + (1,) * (query.ndim - 1))
+        return scores
+
+
+def quantize(matrix, dtype):
+    """Returns (data, scales or None) for a normalized float32 matrix"""
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unsupported embedding storage dtype {dtype!r} (expected one of {STORAGE_DTYPES})")
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == "int8":
+        # Symmetric per-row scale keeps each row's full int8 range.
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        data = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        return data, scales.astype(np.float32)
+    return matrix.astype(dtype), None
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_embedding_file(path, matrix, product_ids, product_info=None, dtype="float16", index_state=None, meta=None,
+                         captions=None, attributes=None):
+    """
+    Write the matrix and its metadata atomically (temp file + rename).
+    captions: optional {"embeddings": normalized matrix, "product_ids": [...], "keys": [...]}
+    attributes: optional {name: array} of per-product filter columns
+    """
+    data, scales = quantize(matrix, dtype)
+    ids = np.array([str(product_id) for product_id in product_ids], dtype="S")
+
+    sections = {"embeddings": data, "product_ids": ids}
+    if scales is not None:
+        sections["scales"] = scales
+    if product_info:
+        info_bytes = gzip.compress(json.dumps(product_info, ensure_ascii=False).encode("utf-8"))
+        sections["product_info"] = np.frombuffer(info_bytes, dtype=np.uint8)
+    for key, value in (index_state or {}).items():
+        sections[f"index.{key}"] = np.ascontiguousarray(value)
+    if captions is not None and len(captions["product_ids"]):
+        caption_data, caption_scales = quantize(captions["embeddings"], dtype)
+        sections["captions.embeddings"] = caption_data
+        if caption_scales is not None:
+            sections["captions.scales"] = caption_scales
+        sections["captions.product_ids"] = np.array([str(product_id) for product_id in captions["product_ids"]], dtype="S")
+        sections["captions.keys"] = np.array([str(key) for key in captions["keys"]], dtype="S")
+    for name, value in (attributes or {}).items():
+        sections[f"attributes.{name}"] = np.ascontiguousarray(value)
+
+    header = dict(meta or {})
+    header.update({
+        "format_version": FORMAT_VERSION,
+        "dtype": dtype,
+        "rows": int(data.shape[0]),
+        "dim": int(data.shape[1]) if data.ndim > 1 else 0,
+        "sections": {},
+    })
+
+    # Section offsets depend on the header size, so lay out with a size estimate first.
+    table = {name: {"dtype": arr.dtype.str, "shape": list(arr.shape)} for name, arr in sections.items()}
+    header["sections"] = {name: dict(entry, offset=0) for name, entry in table.items()}
+    header_len = len(json.dumps(header).encode("utf-8")) + 32 * len(sections) + 64
+    offset = _aligned(len(MAGIC) + 4 + header_len)
+    for name, arr in sections.items():
+        header["sections"][name]["offset"] = offset
+        offset = _aligned(offset + arr.nbytes)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    if len(header_bytes) > header_len:
+        raise RuntimeError("Embedding file header outgrew its reserved size")
+    header_bytes = header_bytes.ljust(header_len, b" ")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", header_len))
+            f.write(header_bytes)
+            for name, arr in sections.items():
+                f.seek(header["sections"][name]["offset"])
+                f.write(np.ascontiguousarray(arr).tobytes())
+            f.truncate(offset)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+class EmbeddingFile:
+    """Memory-mapped view of a `.emb` file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an embedding file")
+            (header_len,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+
+    def section(self, name):
+        entry = self.header["sections"].get(name)
+        if entry is None:
+            return None
+        shape = tuple(entry["shape"])
+        if 0 in shape:
+            return np.empty(shape, dtype=entry["dtype"])
+        return np.memmap(self.path, dtype=entry["dtype"], mode="r", offset=entry["offset"], shape=shape)
+
+    @property
+    def matrix(self):
+        return StoredMatrix(self.section("embeddings"), self.section("scales"))
+
+    @property
+    def product_ids(self):
+        return [value.decode("utf-8") for value in self.section("product_ids")]
+
+    @property
+    def product_info(self):
+        raw = self.section("product_info")
+        if raw is None:
+            return {}
+        return json.loads(gzip.decompress(raw.tobytes()).decode("utf-8"))
+
+    def captions(self):
+        """Caption index sections, or None for files written without one"""
+        data = self.section("captions.embeddings")
+        if data is None:
+            return None
+        return {
+            "embeddings": StoredMatrix(data, self.section("captions.scales")),
+            "product_ids": [value.decode("utf-8") for value in self.section("captions.product_ids")],
+            "keys": np.asarray(self.section("captions.keys")),
+        }
+
+    def _prefixed(self, prefix):
+        return {
+            name[len(prefix):]: np.asarray(self.section(name))
+            for name in self.header["sections"]
+            if name.startswith(prefix)
+        }
+
+    def index_state(self):
+        return self._prefixed("index.")
+
+    def attributes(self):
+        """Per-product filter columns, or None for files written without them"""
+        return self._prefixed("attributes.") or None
+
+
+def upload_to_gridfs(bucket, path, filename, metadata=None):
+    with open(path, "rb") as f:
+        return bucket.upload_from_stream(filename, f, metadata=metadata or {})
+
+
+def download_from_gridfs(bucket, file_id, path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            bucket.download_to_stream(file_id, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def delete_other_gridfs_versions(bucket, filename, keep_id):
+    for grid_out in bucket.find({"filename": filename, "_id": {"$ne": keep_id}}):
+        bucket.delete(grid_out._id)
+
+
+def remove_stale_local_files(directory, keep_path, prefix):
+    """Delete older cached files; open memmaps keep their data on POSIX"""
+    keep = os.path.abspath(keep_path)
+    for name in os.listdir(directory):
+        path = os.path.abspath(os.path.join(directory, name))
+        if name.startswith(prefix) and name.endswith(".emb") and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,144 @@
+"""
+Resident embedding store for the image search service.
+
+/search reads the current snapshot from memory and never touches MongoDB.
+A background thread polls a cheap version stamp (the snapshot's
+`updated_at`) and swaps in a freshly loaded snapshot when it changes, so
+workers pick up re-embeds published by another process. The update task
+publishes its result directly after saving.
+"""
+import threading
+import time
+
+import numpy as np
+
+from caption_index import CaptionIndex
+from product_filters import ProductAttributes
+from product_ranking import build_product_index
+from vector_index import ExactIndex
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class EmbeddingSnapshot:
+    """Immutable view of one published embedding set (rows are L2-normalized)."""
+
+    def __init__(self, embeddings, product_ids, product_info=None, updated_at=None, model_name=None, index_factory=None,
+                 captions=None, attributes=None):
+        # Stored matrices are normalized at write time and stay memory-mapped.
+        self.embeddings = embeddings if getattr(embeddings, "normalized", False) else normalize_rows(embeddings)
+        self.product_ids = list(product_ids)
+        self.product_info = product_info or {}
+        self.updated_at = updated_at
+        self.model_name = model_name
+
+        if len(self.product_ids) != len(self.embeddings):
+            raise ValueError(
+                f"Embedding count ({len(self.embeddings)}) does not match product id count ({len(self.product_ids)})"
+            )
+
+        # Vector -> product ordinal map used for product-level pooling.
+        self.product_keys, self.product_index, self.grouped = build_product_index(self.product_ids)
+
+        # index_factory(normalized_matrix) -> index; the index must see this snapshot's matrix.
+        self.index = index_factory(self.embeddings) if index_factory else ExactIndex(self.embeddings)
+
+        # Optional per-product filter columns, in product_keys order.
+        self.attributes = None
+        if attributes is not None:
+            self.attributes = ProductAttributes(attributes)
+            if len(self.attributes) != len(self.product_keys):
+                print(f"⚠️  Ignoring attribute columns: {len(self.attributes)} rows for {len(self.product_keys)} products")
+                self.attributes = None
+
+        # Optional caption vectors ({"embeddings", "product_ids", "keys"}) for text -> caption scoring.
+        self.captions = None
+        if captions is not None and len(captions["product_ids"]):
+            caption_matrix = captions["embeddings"]
+            if not getattr(caption_matrix, "normalized", False):
+                caption_matrix = normalize_rows(caption_matrix)
+            ordinals = {product_id: ordinal for ordinal, product_id in enumerate(self.product_keys)}
+            self.captions = CaptionIndex(caption_matrix, captions["product_ids"], captions["keys"], ordinals,
+                                         len(self.product_keys))
+
+    def __len__(self):
+        return len(self.product_ids)
+
+
+class EmbeddingStore:
+    def __init__(self, load_snapshot, fetch_version, refresh_interval=60):
+        """
+        load_snapshot: callable returning an EmbeddingSnapshot or None.
+        fetch_version: callable returning the currently published version stamp.
+        """
+        self._load_snapshot = load_snapshot
+        self._fetch_version = fetch_version
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.loaded = False
+        self.last_checked = None
+        self.last_error = None
+
+    def get(self):
+        # Reading a single attribute is atomic, so readers never take the lock.
+        return self._snapshot
+
+    def publish(self, snapshot):
+        with self._write_lock:
+            self._snapshot = snapshot
+            self.loaded = True
+        if snapshot is not None:
+            print(f"📦 Embedding snapshot published: {len(snapshot)} vectors (updated_at={snapshot.updated_at})")
+
+    def refresh(self, force=False):
+        """Reload the snapshot if the published version differs. Returns True when swapped."""
+        try:
+            version = self._fetch_version()
+            self.last_checked = time.time()
+            current = self._snapshot
+            if not force and self.loaded and current is not None and current.updated_at == version:
+                return False
+            if not force and self.loaded and current is None and version is None:
+                return False
+
+            snapshot = self._load_snapshot()
+            self.publish(snapshot)
+            self.last_error = None
+            return True
+        except Exception as exc:
+            self.last_error = str(exc)
+            print(f"⚠️  Embedding store refresh failed: {exc}")
+            return False
+
+    def _run(self):
+        self.refresh(force=True)
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="embedding-store-refresh", daemon=True)
+        self._thread.start()
+
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            "loaded": self.loaded,
+            "count": len(snapshot) if snapshot is not None else 0,
+            "updated_at": snapshot.updated_at if snapshot is not None else None,
+            "model_name": snapshot.model_name if snapshot is not None else None,
+            "index": snapshot.index.info() if snapshot is not None else None,
+            "captions": snapshot.captions.info() if snapshot is not None and snapshot.captions is not None else None,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,250 @@
+"""
+Persistent on-disk cache for downloaded product images.
+
+Embedding updates, training export and the Qwen-VL scripts download the
+same Cloudinary images over and over. The cache keeps them on local disk:
+
+  <root>/objects/ab/abcdef...   image bytes, named by their SHA-256
+  <root>/urls/12/1234...json    url -> {sha256, etag, last_modified, checked_at}
+
+- Fresh entries (checked less than `max_age` seconds ago) are served from
+  disk without a request.
+- Older entries are revalidated with If-None-Match / If-Modified-Since; a
+  304 costs a round trip but no body. If revalidation fails, the cached
+  bytes are served.
+- Identical images behind different URLs are stored once.
+- Writes go to a temp file in the target directory and are renamed into
+  place, so concurrent threads and processes never see partial files.
+- Blob mtime is the LRU clock (touched on every hit). Once the cache grows
+  past `max_bytes`, the least recently used blobs are evicted.
+
+Run `python image_cache.py stats|prune|clear [--dir DIR]` to inspect it.
+
+This file is kept identical in UTEShop_BE/image_search_service and
+ai-training/product_description_qwen_vl/scripts, so both can point
+IMAGE_CACHE_DIR at the same directory.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import requests
+
+DEFAULT_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+DEFAULT_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+DEFAULT_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE_SECONDS", "86400"))
+
+# Evict down to this share of max_bytes so a full cache does not scan the
+# object directory on every write.
+EVICT_TO = 0.9
+
+
+def _atomic_write(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ImageCache:
+    def __init__(self, root=DEFAULT_DIR, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, max_age=DEFAULT_MAX_AGE,
+                 session=None, headers=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.session = session or requests.Session()
+        self.headers = headers or {}
+        self._lock = threading.Lock()
+        self._size = None
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _meta_path(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, "urls", key[:2], key + ".json")
+
+    def _read_meta(self, url):
+        try:
+            with open(self._meta_path(url), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get("url") == url else None
+
+    def _read_object(self, digest):
+        path = self._object_path(digest)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def _store(self, url, data, response):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        written = 0
+        if not os.path.exists(path):
+            _atomic_write(path, data)
+            written = len(data)
+        self._write_meta(url, digest, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        if written:
+            self._account(written)
+        return digest
+
+    def _write_meta(self, url, digest, etag, last_modified):
+        meta = {
+            "url": url,
+            "sha256": digest,
+            "etag": etag,
+            "last_modified": last_modified,
+            "checked_at": time.time(),
+        }
+        _atomic_write(self._meta_path(url), json.dumps(meta).encode("utf-8"))
+
+    def fetch(self, url, timeout=10, headers=None):
+        """Image bytes for `url`, from disk when possible; raises like requests on failure"""
+        meta = self._read_meta(url)
+        data = self._read_object(meta["sha256"]) if meta else None
+
+        if data is not None and time.time() - meta.get("checked_at", 0) < self.max_age:
+            self.hits += 1
+            return data
+
+        request_headers = dict(self.headers, **(headers or {}))
+        if data is not None:
+            if meta.get("etag"):
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                request_headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            response = self.session.get(url, headers=request_headers, timeout=timeout)
+            if response.status_code == 304 and data is not None:
+                self.revalidated += 1
+                self._write_meta(
+                    url,
+                    meta["sha256"],
+                    response.headers.get("ETag") or meta.get("etag"),
+                    response.headers.get("Last-Modified") or meta.get("last_modified"),
+                )
+                return data
+            response.raise_for_status()
+        except Exception as exc:
+            if data is None:
+                raise
+            self.stale += 1
+            print(f"⚠️  Serving cached image after failed revalidation: {url} ({exc})")
+            return data
+
+        self.misses += 1
+        self._store(url, response.content, response)
+        return response.content
+
+    def _account(self, written):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._objects())
+            else:
+                self._size += written
+            if self.max_bytes and self._size > self.max_bytes:
+                self._evict(int(self.max_bytes * EVICT_TO))
+
+    def _objects(self):
+        """[(path, size, mtime)] for every cached blob"""
+        objects = []
+        base = os.path.join(self.root, "objects")
+        for directory, _, names in os.walk(base):
+            for name in names:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                objects.append((path, stat.st_size, stat.st_mtime))
+        return objects
+
+    def _evict(self, target):
+        objects = sorted(self._objects(), key=lambda item: item[2])
+        size = sum(item[1] for item in objects)
+        for path, item_size, _ in objects:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= item_size
+            self.evictions += 1
+        # Metadata of evicted blobs is left behind; the next fetch of such a
+        # URL finds no object and downloads it again.
+        self._size = size
+
+    def prune(self):
+        with self._lock:
+            self._evict(self.max_bytes)
+
+    def stats(self):
+        lookups = self.hits + self.revalidated + self.misses + self.stale
+        with self._lock:
+            size = self._size
+        return {
+            "dir": self.root,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.revalidated + self.stale) / lookups, 4) if lookups else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or trim the local image cache")
+    parser.add_argument("command", choices=("stats", "prune", "clear"))
+    parser.add_argument("--dir", default=DEFAULT_DIR)
+    parser.add_argument("--max-mb", type=int, default=DEFAULT_MAX_MB)
+    args = parser.parse_args()
+
+    cache = ImageCache(args.dir, max_bytes=args.max_mb * 1024 * 1024)
+    if args.command == "clear":
+        shutil.rmtree(args.dir, ignore_errors=True)
+    elif args.command == "prune":
+        cache.prune()
+    objects = cache._objects()
+    print(f"{args.dir}: {len(objects)} images, {sum(size for _, size, _ in objects) / 1024 / 1024:.1f} MB "
+          f"(cap {args.max_mb} MB), evicted {cache.evictions}")
+
+
+if __name__ == "__main__":
+    main()
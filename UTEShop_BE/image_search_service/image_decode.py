@@ -0,0 +1,67 @@
+"""
+Image decoding helpers shared by search and embedding updates.
+
+CLIP resizes every image so its shortest side is 224px, so decoding a
+4000px phone photo at full resolution is wasted work. `decode_image`
+downscales while decoding: JPEGs use draft mode (DCT scaling inside
+libjpeg) and the result is resized so the shortest side is just above the
+model input size. Other formats are shrunk with an integer `reduce()`
+pass before the final resample (Pillow's `reducing_gap`), and RGB/L images
+are shrunk before colour conversion rather than after.
+
+Oversize payloads are rejected before any pixel is decoded: the byte
+length is checked first, then the pixel count from the image header.
+"""
+import io
+
+from PIL import Image
+
+DEFAULT_MIN_SIDE = 224
+# reduce() by an integer factor until within 3x of the target, then resample bicubically
+REDUCING_GAP = 3.0
+# Modes that can be resized before conversion to RGB
+RESIZABLE_MODES = ("RGB", "RGBA", "L", "LA")
+
+
+class ImageTooLarge(ValueError):
+    """Payload bytes or pixel count over the configured limit"""
+
+
+def check_payload_size(size, max_bytes):
+    if max_bytes and size > max_bytes:
+        raise ImageTooLarge(f"Image is {size / 1048576:.1f} MB, the limit is {max_bytes / 1048576:.1f} MB")
+
+
+def _target_size(width, height, min_side):
+    scale = min_side / float(min(width, height))
+    if scale >= 1:
+        return None
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def downscale(image, min_side=DEFAULT_MIN_SIDE):
+    """Resize so the shortest side is `min_side` (never upscales)"""
+    target = _target_size(image.width, image.height, min_side)
+    if target is None:
+        return image
+    return image.resize(target, Image.BICUBIC, reducing_gap=REDUCING_GAP)
+
+
+def decode_image(data, min_side=DEFAULT_MIN_SIDE, max_bytes=None, max_pixels=None):
+    """Decode image bytes to RGB, downscaling on decode when possible"""
+    check_payload_size(len(data), max_bytes)
+    # open() only parses the header; pixels are decoded by draft/convert/resize below.
+    image = Image.open(io.BytesIO(data))
+    if max_pixels and image.width * image.height > max_pixels:
+        raise ImageTooLarge(f"Image is {image.width}x{image.height}, the limit is {max_pixels:,} pixels")
+    if min_side:
+        target = _target_size(image.width, image.height, min_side)
+        if target is not None and image.format == "JPEG":
+            # draft() picks the largest DCT scale that keeps the image >= target.
+            image.draft("RGB", target)
+        if image.mode in RESIZABLE_MODES:
+            image = downscale(image, min_side)
+    image = image.convert("RGB")
+    if min_side:
+        image = downscale(image, min_side)
+    return image
@@ -0,0 +1,100 @@
+"""
+Explicit load / warmup lifecycle for the CLIP model.
+
+The model is loaded on a background thread at startup instead of inside
+the first /search. After loading, a warmup pass encodes a dummy image and
+text at the batch sizes the service will use. This lets the backend select
+its kernels and size its allocations before real traffic arrives. Callers
+of `get()` block until the model is ready. If the background load failed,
+`get()` retries it synchronously.
+
+    not_loaded -> loading -> warming_up -> ready
+                        \\-> failed (next get() retries)
+"""
+import datetime
+import threading
+import time
+
+from PIL import Image
+
+
+def warmup_clip(model, batch_sizes=(1,), image_size=224):
+    """One image and one text forward pass per batch size"""
+    image = Image.new("RGB", (image_size, image_size), (127, 127, 127))
+    for batch_size in batch_sizes:
+        model.encode([image] * batch_size, batch_size=batch_size, convert_to_numpy=True)
+        model.encode(["warmup query"] * batch_size, batch_size=batch_size, convert_to_numpy=True)
+
+
+class ModelLoader:
+    def __init__(self, load, warmup=None, name="model"):
+        self._load = load
+        self._warmup = warmup
+        self.name = name
+        self._model = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self.state = "not_loaded"
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.ready_at = None
+
+    @property
+    def ready(self):
+        return self._model is not None
+
+    def start(self):
+        """Load and warm up in the background"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._preload, name="model-preload", daemon=True)
+                self._thread.start()
+
+    def _preload(self):
+        try:
+            self.get()
+        except Exception as exc:
+            print(f"❌ Failed to load {self.name}: {exc}")
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load_and_warm()
+        return self._model
+
+    def _load_and_warm(self):
+        self.state = "loading"
+        self.error = None
+        print(f"🚀 Loading {self.name}...")
+        try:
+            started = time.perf_counter()
+            model = self._load()
+            self.load_seconds = time.perf_counter() - started
+
+            if self._warmup is not None:
+                self.state = "warming_up"
+                started = time.perf_counter()
+                self._warmup(model)
+                self.warmup_seconds = time.perf_counter() - started
+        except Exception as exc:
+            self.state = "failed"
+            self.error = str(exc)
+            raise
+
+        self.state = "ready"
+        self.ready_at = datetime.datetime.utcnow().isoformat() + "Z"
+        print(f"✅ {self.name} ready (load {self.load_seconds:.2f}s, warmup {self.warmup_seconds or 0.0:.2f}s)")
+        return model
+
+    def status(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            "warmup_seconds": round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+            "ready_at": self.ready_at,
+            "error": self.error,
+        }
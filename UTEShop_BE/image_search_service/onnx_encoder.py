@@ -0,0 +1,325 @@
+"""
+CPU inference backends for the CLIP encoder.
+
+CLIP_BACKEND selects how the service encodes images and text:
+
+- torch:       SentenceTransformer, eager PyTorch fp32 (default)
+- torch-int8:  the same model with dynamic int8 quantization of every nn.Linear
+- onnx:        vision and text towers exported to ONNX and run by onnxruntime,
+               fp32 or the dynamic-int8 copy (CLIP_ONNX_QUANTIZED=true)
+
+Every backend exposes the `encode(items, batch_size, convert_to_numpy)`
+subset of SentenceTransformer that the service uses. BatchEncoder, warmup
+and the embedding update task therefore work unchanged.
+
+PyTorch and sentence-transformers are only imported by the torch backends
+and by `export`, so the onnx backend runs with onnxruntime alone.
+
+Export and parity check:
+  python onnx_encoder.py export --model uteshop-clip --output onnx_models/uteshop-clip
+  python onnx_encoder.py parity --backend onnx --onnx-dir onnx_models/uteshop-clip
+
+Quantized vectors drift slightly from fp32 ones. `parity` reports the
+per-item cosine between the two backends and the overlap of their
+text -> image top-k rankings, and exits non-zero below --min-cosine. Run
+it before switching a deployment. Stored catalog vectors are tagged with
+`encoder_tag`, so switching backends re-embeds the catalog instead of
+mixing vectors from two backends.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+BACKENDS = ("torch", "torch-int8", "onnx")
+VISION_FILE = "vision.onnx"
+TEXT_FILE = "text.onnx"
+MANIFEST_FILE = "manifest.json"
+
+
+def _quantized_name(filename):
+    return filename.replace(".onnx", ".int8.onnx")
+
+
+def _clip_module(model):
+    """(transformers CLIPModel, CLIPProcessor) inside a SentenceTransformer"""
+    if len(model) != 1 or not hasattr(model[0], "processor"):
+        raise ValueError("Only single-module CLIP SentenceTransformer models can be exported")
+    return model[0].model, model[0].processor
+
+
+def _towers(clip):
+    """(vision, text) nn.Modules wrapping the CLIP feature heads for export"""
+    import torch
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, pixel_values):
+            return self.clip.get_image_features(pixel_values=pixel_values)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, input_ids, attention_mask):
+            return self.clip.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    return VisionTower(), TextTower()
+
+
+def export_onnx(model_name, output_dir, quantize=True, opset=17):
+    """Export both towers (+ processor files) and optionally their dynamic-int8 copies"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    clip, processor = _clip_module(model)
+    clip.eval()
+    os.makedirs(output_dir, exist_ok=True)
+
+    crop = processor.image_processor.crop_size
+    size = crop["height"] if isinstance(crop, dict) else int(crop)
+    tokens = processor.tokenizer(["a photo of a shirt"], return_tensors="pt", padding=True, truncation=True)
+    vision_tower, text_tower = _towers(clip)
+
+    with torch.no_grad():
+        print(f"📦 Exporting vision tower ({size}px)...")
+        torch.onnx.export(
+            vision_tower,
+            (torch.zeros(1, 3, size, size),),
+            os.path.join(output_dir, VISION_FILE),
+            input_names=["pixel_values"],
+            output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=opset,
+        )
+        print("📦 Exporting text tower...")
+        torch.onnx.export(
+            text_tower,
+            (tokens["input_ids"], tokens["attention_mask"]),
+            os.path.join(output_dir, TEXT_FILE),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["text_embeds"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "text_embeds": {0: "batch"},
+            },
+            opset_version=opset,
+        )
+    processor.save_pretrained(output_dir)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        for filename in (VISION_FILE, TEXT_FILE):
+            print(f"🗜️  Quantizing {filename} to int8...")
+            # MatMul/Gemm carry nearly all of the FLOPs; the patch Conv stays fp32.
+            quantize_dynamic(
+                os.path.join(output_dir, filename),
+                os.path.join(output_dir, _quantized_name(filename)),
+                op_types_to_quantize=["MatMul", "Gemm"],
+                weight_type=QuantType.QInt8,
+            )
+
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model_name": model_name,
+            "dim": int(clip.config.projection_dim),
+            "image_size": size,
+            "opset": opset,
+            "quantized": bool(quantize),
+        }, f, indent=2)
+    print(f"✅ Exported to {output_dir}")
+    return output_dir
+
+
+class OnnxClipEncoder:
+    """onnxruntime encoder with the SentenceTransformer.encode interface used by the service"""
+
+    def __init__(self, model_dir, quantized=True, threads=0):
+        import onnxruntime as ort
+        from transformers import CLIPProcessor
+
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.processor = CLIPProcessor.from_pretrained(model_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = int(threads)
+
+        def session(filename):
+            path = os.path.join(model_dir, _quantized_name(filename) if quantized else filename)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Missing {path}. Run: python onnx_encoder.py export --output {model_dir}")
+            return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+        self.vision = session(VISION_FILE)
+        self.text = session(TEXT_FILE)
+
+    def _encode_images(self, images):
+        pixel_values = self.processor.image_processor(images, return_tensors="np")["pixel_values"]
+        return self.vision.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+
+    def _encode_texts(self, texts):
+        tokens = self.processor.tokenizer(texts, return_tensors="np", padding=True, truncation=True)
+        return self.text.run(None, {
+            "input_ids": tokens["input_ids"].astype(np.int64),
+            "attention_mask": tokens["attention_mask"].astype(np.int64),
+        })[0]
+
+    def encode(self, items, batch_size=32, convert_to_numpy=True, **kwargs):
+        single = isinstance(items, (str, Image.Image))
+        if single:
+            items = [items]
+        items = list(items)
+        vectors = [None] * len(items)
+        groups = (
+            ([i for i, item in enumerate(items) if isinstance(item, Image.Image)], self._encode_images),
+            ([i for i, item in enumerate(items) if not isinstance(item, Image.Image)], self._encode_texts),
+        )
+        for positions, run in groups:
+            for start in range(0, len(positions), batch_size):
+                chunk = positions[start:start + batch_size]
+                for position, vector in zip(chunk, run([items[i] for i in chunk])):
+                    vectors[position] = vector
+        result = np.stack(vectors).astype(np.float32) if vectors else np.empty((0, 0), dtype=np.float32)
+        return result[0] if single else result
+
+
+def encoder_tag(backend, model_name, quantized=True):
+    """
+    Identifies the vectors a backend produces. Plain torch fp32 keeps the bare
+    model name, so vectors stored before backends were tagged stay valid.
+    """
+    if backend == "torch":
+        return model_name
+    if backend == "onnx":
+        backend = "onnx-int8" if quantized else "onnx-fp32"
+    return f"{model_name}:{backend}"
+
+
+def load_encoder(backend, model_name, onnx_dir=None, quantized=True, threads=0):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CLIP backend {backend!r} (expected one of {BACKENDS})")
+    if backend == "onnx":
+        return OnnxClipEncoder(onnx_dir, quantized=quantized, threads=threads)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        torch.set_num_threads(int(threads))
+
+    model = SentenceTransformer(model_name, device="cpu" if backend == "torch-int8" else None)
+    if backend == "torch-int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def parity_report(reference, candidate, images, texts, k=10):
+    """Cosine between backends per item, plus text -> image top-k overlap"""
+    ref_images = _normalized(reference.encode(images, batch_size=16, convert_to_numpy=True))
+    cand_images = _normalized(candidate.encode(images, batch_size=16, convert_to_numpy=True))
+    ref_texts = _normalized(reference.encode(texts, batch_size=64, convert_to_numpy=True))
+    cand_texts = _normalized(candidate.encode(texts, batch_size=64, convert_to_numpy=True))
+
+    image_cosine = np.sum(ref_images * cand_images, axis=1)
+    text_cosine = np.sum(ref_texts * cand_texts, axis=1)
+
+    k = min(k, len(images))
+    ref_top = np.argsort(-(ref_texts @ ref_images.T), axis=1)[:, :k]
+    cand_top = np.argsort(-(cand_texts @ cand_images.T), axis=1)[:, :k]
+    overlap = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(ref_top, cand_top)])
+
+    return {
+        "samples": len(images),
+        "image_cosine_min": float(image_cosine.min()),
+        "image_cosine_mean": float(image_cosine.mean()),
+        "text_cosine_min": float(text_cosine.min()),
+        "text_cosine_mean": float(text_cosine.mean()),
+        f"text_to_image_top{k}_overlap": float(overlap),
+    }
+
+
+def load_samples(data_path, limit):
+    """(images, captions) from export_train_data output, or synthetic ones if none are downloaded"""
+    from image_decode import decode_image
+
+    images, captions = [], []
+    if os.path.exists(data_path):
+        base = os.path.dirname(data_path)
+        with open(data_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if len(images) >= limit:
+                    break
+                record = json.loads(line)
+                path = os.path.join(base, record["image"])
+                if not os.path.exists(path):
+                    continue
+                with open(path, "rb") as image_file:
+                    images.append(decode_image(image_file.read()))
+                captions.append(record["caption"])
+    if not images:
+        print("⚠️  No training images found, using synthetic samples")
+        rng = np.random.default_rng(0)
+        for index in range(limit):
+            images.append(Image.fromarray(rng.integers(0, 255, (224, 224, 3), dtype=np.uint8)))
+            captions.append(f"product photo number {index}")
+    return images, captions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Export the towers to ONNX (+ dynamic int8)")
+    export.add_argument("--model", default=os.getenv("CLIP_MODEL_NAME", "uteshop-clip"))
+    export.add_argument("--output", default=os.getenv("CLIP_ONNX_DIR", "onnx_models/uteshop-clip"))
+    export.add_argument("--no-quantize", action="store_true")
+    export.add_argument("--opset", type=int, default=17)
+
+    parity = commands.add_parser("parity", help="Compare a backend against eager PyTorch fp32")
+    parity.add_argument("--model", default=os.getenv("CLIP_MODEL_NAME", "uteshop-clip"))
+    parity.add_argument("--backend", choices=[b for b in BACKENDS if b != "torch"], default="onnx")
+    parity.add_argument("--onnx-dir", default=os.getenv("CLIP_ONNX_DIR", "onnx_models/uteshop-clip"))
+    parity.add_argument("--fp32", action="store_true", help="Use the fp32 ONNX files instead of int8")
+    parity.add_argument("--data", default=os.getenv("TRAIN_DATA_PATH", "training_data/train.jsonl"))
+    parity.add_argument("--samples", type=int, default=200)
+    parity.add_argument("--k", type=int, default=10)
+    parity.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(args.model, args.output, quantize=not args.no_quantize, opset=args.opset)
+        return
+
+    images, captions = load_samples(args.data, args.samples)
+    reference = load_encoder("torch", args.model)
+    candidate = load_encoder(args.backend, args.model, onnx_dir=args.onnx_dir, quantized=not args.fp32)
+    report = parity_report(reference, candidate, images, captions, k=args.k)
+    print(json.dumps(report, indent=2))
+    if min(report["image_cosine_min"], report["text_cosine_min"]) < args.min_cosine:
+        print(f"❌ Parity below {args.min_cosine}")
+        sys.exit(1)
+    print("✅ Parity OK")
+
+
+if __name__ == "__main__":
+    main()
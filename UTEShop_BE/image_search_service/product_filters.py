@@ -0,0 +1,190 @@
+"""
+Attribute pre-filtering for vector search.
+
+The embedding update stores one row of attributes per product next to the
+matrix, in the snapshot's product ordinal order. Category and brand are
+dictionary-encoded as int32 codes, price is float32, stock is int32 and
+isActive is a bool. Vectors map to products through the snapshot's
+vector -> product index, so a row per product is enough to filter every
+vector.
+
+A filtered search turns the request's filters into one boolean product
+mask (a few vectorized comparisons). `rank_products` applies the mask
+before threshold and top-k, so ineligible products never take a top-k slot
+and a filtered query costs the same as an unfiltered one.
+
+Attributes are a snapshot of the last re-embed. Hydrated documents are
+checked again with `SearchFilters.accepts`, so a product that went out of
+stock since then is still dropped.
+"""
+import numpy as np
+from bson import ObjectId
+
+NO_CODE = -1
+
+
+def reference_id(value):
+    """Category / brand reference (ObjectId, populated dict or string) -> id string"""
+    if not value:
+        return None
+    if isinstance(value, dict):
+        value = value.get("_id")
+        return str(value) if value else None
+    return str(value)
+
+
+def build_attributes(product_keys, products_by_id):
+    """Attribute columns for `product_keys` (the snapshot's product ordinal order)"""
+    category_ids, brand_ids = {}, {}
+    size = len(product_keys)
+    category = np.full(size, NO_CODE, dtype=np.int32)
+    brand = np.full(size, NO_CODE, dtype=np.int32)
+    price = np.zeros(size, dtype=np.float32)
+    stock = np.zeros(size, dtype=np.int32)
+    is_active = np.zeros(size, dtype=bool)
+
+    for ordinal, product_id in enumerate(product_keys):
+        product = products_by_id.get(product_id) or {}
+        category_id = reference_id(product.get("category"))
+        if category_id:
+            category[ordinal] = category_ids.setdefault(category_id, len(category_ids))
+        brand_id = reference_id(product.get("brand"))
+        if brand_id:
+            brand[ordinal] = brand_ids.setdefault(brand_id, len(brand_ids))
+        price[ordinal] = float(product.get("price") or 0)
+        stock[ordinal] = int(product.get("stock") or 0)
+        is_active[ordinal] = bool(product.get("isActive", True))
+
+    return {
+        "category": category,
+        "brand": brand,
+        "price": price,
+        "stock": stock,
+        "is_active": is_active,
+        "category_ids": np.array(list(category_ids), dtype="S"),
+        "brand_ids": np.array(list(brand_ids), dtype="S"),
+    }
+
+
+class ProductAttributes:
+    def __init__(self, columns):
+        self.category = np.asarray(columns["category"])
+        self.brand = np.asarray(columns["brand"])
+        self.price = np.asarray(columns["price"])
+        self.stock = np.asarray(columns["stock"])
+        self.is_active = np.asarray(columns["is_active"], dtype=bool)
+        self.category_codes = {_text(value): code for code, value in enumerate(columns["category_ids"])}
+        self.brand_codes = {_text(value): code for code, value in enumerate(columns["brand_ids"])}
+
+    def __len__(self):
+        return len(self.price)
+
+    def mask(self, filters):
+        """Boolean mask over product ordinals"""
+        mask = np.ones(len(self), dtype=bool)
+        if filters.categories is not None:
+            codes = [self.category_codes[value] for value in filters.categories if value in self.category_codes]
+            mask &= np.isin(self.category, codes)
+        if filters.brands is not None:
+            codes = [self.brand_codes[value] for value in filters.brands if value in self.brand_codes]
+            mask &= np.isin(self.brand, codes)
+        if filters.min_price is not None:
+            mask &= self.price >= filters.min_price
+        if filters.max_price is not None:
+            mask &= self.price <= filters.max_price
+        if filters.in_stock:
+            mask &= self.stock > 0
+        if filters.is_active is not None:
+            mask &= self.is_active == filters.is_active
+        return mask
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+def _id_list(value):
+    if not value:
+        return None
+    ids = [part.strip() for part in str(value).split(",") if part.strip()]
+    for product_id in ids:
+        if not ObjectId.is_valid(product_id):
+            raise ValueError(f"Invalid id '{product_id}'")
+    return frozenset(ids) or None
+
+
+def _number(value, name):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name} '{value}'")
+
+
+def _flag(value, name):
+    if value is None or value == "":
+        return None
+    text = str(value).lower()
+    if text in ("1", "true", "yes"):
+        return True
+    if text in ("0", "false", "no"):
+        return False
+    raise ValueError(f"Invalid {name} '{value}', expected true or false")
+
+
+class SearchFilters:
+    """
+    Query parameters:
+      category=<id>[,<id>...]  brand=<id>[,<id>...]
+      min_price=<n>  max_price=<n>  in_stock=true  is_active=true|false
+    """
+
+    def __init__(self, categories=None, brands=None, min_price=None, max_price=None, in_stock=False, is_active=None):
+        self.categories = categories
+        self.brands = brands
+        self.min_price = min_price
+        self.max_price = max_price
+        self.in_stock = in_stock
+        self.is_active = is_active
+
+    @classmethod
+    def from_args(cls, args):
+        """None when the request has no filters; raises ValueError on malformed values"""
+        filters = cls(
+            categories=_id_list(args.get("category")),
+            brands=_id_list(args.get("brand")),
+            min_price=_number(args.get("min_price"), "min_price"),
+            max_price=_number(args.get("max_price"), "max_price"),
+            in_stock=bool(_flag(args.get("in_stock"), "in_stock")),
+            is_active=_flag(args.get("is_active"), "is_active"),
+        )
+        return filters if filters.active else None
+
+    @property
+    def active(self):
+        return any((
+            self.categories is not None,
+            self.brands is not None,
+            self.min_price is not None,
+            self.max_price is not None,
+            self.in_stock,
+            self.is_active is not None,
+        ))
+
+    def accepts(self, product):
+        """Same predicate on a live product document"""
+        if self.categories is not None and reference_id(product.get("category")) not in self.categories:
+            return False
+        if self.brands is not None and reference_id(product.get("brand")) not in self.brands:
+            return False
+        price = float(product.get("price") or 0)
+        if self.min_price is not None and price < self.min_price:
+            return False
+        if self.max_price is not None and price > self.max_price:
+            return False
+        if self.in_stock and int(product.get("stock") or 0) <= 0:
+            return False
+        if self.is_active is not None and bool(product.get("isActive", True)) != self.is_active:
+            return False
+        return True
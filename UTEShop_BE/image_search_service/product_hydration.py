@@ -0,0 +1,192 @@
+"""
+Product hydration for search results.
+
+Ranked product ids are resolved with a single `$in` query, and category /
+brand references are resolved from in-memory lookup tables that refresh in
+the background once their TTL expires, so a search costs one MongoDB round
+trip regardless of how many hits it returns. The `_async` variants do the
+same round trip through an async driver (motor) for the ASGI app.
+"""
+import threading
+import time
+
+from bson import ObjectId
+
+
+class LookupTable:
+    """TTL-refreshed id -> document map (stale entries are served while refreshing)"""
+
+    def __init__(self, load, ttl=300, name="lookup"):
+        self._load = load
+        self.ttl = ttl
+        self.name = name
+        self._data = None
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            data = self._load()
+            self._data = data
+            self._loaded_at = time.time()
+        except Exception as exc:
+            print(f"⚠️  Failed to refresh {self.name} lookup table: {exc}")
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        if self._data is None:
+            # First use: load synchronously so results are complete.
+            with self._lock:
+                if self._data is None:
+                    self._refreshing = True
+                    self._refresh()
+            return self._data or {}
+
+        if time.time() - self._loaded_at > self.ttl:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, daemon=True).start()
+        return self._data
+
+    def invalidate(self):
+        self._loaded_at = 0.0
+
+
+def load_categories(db):
+    return {
+        str(cat["_id"]): {"_id": str(cat["_id"]), "name": cat.get("name", "")}
+        for cat in db.categories.find({}, {"name": 1})
+    }
+
+
+def load_brands(db):
+    return {
+        str(brand["_id"]): {
+            "_id": str(brand["_id"]),
+            "name": brand.get("name", ""),
+            "logo": brand.get("logo", "")
+        }
+        for brand in db.brands.find({}, {"name": 1, "logo": 1})
+    }
+
+
+def _resolve_reference(value, table):
+    if not value:
+        return None
+    if isinstance(value, ObjectId):
+        found = table.get()
+        info = found.get(str(value))
+        if info is None:
+            # Unknown id (created after the last refresh): refresh on next access.
+            table.invalidate()
+        return info
+    return value
+
+
+def format_product(product, similarity, categories, brands):
+    product_id = str(product["_id"])
+    category_info = _resolve_reference(product.get("category"), categories)
+    brand_info = _resolve_reference(product.get("brand"), brands)
+    stock = product.get("stock", 0)
+
+    # Process sizes - convert ObjectId to string
+    processed_sizes = []
+    for s in product.get("sizes", []):
+        if isinstance(s, dict):
+            processed_sizes.append({
+                "size": s.get("size", ""),
+                "stock": s.get("stock", 0),
+                "_id": str(s.get("_id", "")) if s.get("_id") else ""
+            })
+        else:
+            processed_sizes.append(s)
+
+    return {
+        "_id": product_id,
+        "productId": product_id,
+        "similarity": similarity,
+        "name": product.get("name", ""),
+        "description": product.get("description", ""),
+        "price": product.get("price", 0),
+        "stock": stock,
+        "images": product.get("images", []),
+        "sizes": processed_sizes,
+        "category": category_info or str(product.get("category", "")),
+        "brand": brand_info or str(product.get("brand", "")),
+        "discountPercentage": product.get("discountPercentage", 0),
+        "soldCount": product.get("soldCount", 0),
+        "isActive": product.get("isActive", True),
+        "isInStock": stock > 0
+    }
+
+
+def build_results(ranked, products_by_id, categories, brands, top_k, accept=None):
+    """
+    ranked: [(product_id, similarity)] in rank order; missing products are skipped,
+    as are products rejected by `accept(product)` (live re-check of search filters).
+    """
+    results = []
+    for product_id, similarity in ranked:
+        product = products_by_id.get(product_id)
+        if product is None or (accept is not None and not accept(product)):
+            continue
+        results.append(format_product(product, similarity, categories, brands))
+        if len(results) >= top_k:
+            break
+    return results
+
+
+def _object_ids(product_ids):
+    object_ids = []
+    for product_id in product_ids:
+        try:
+            object_ids.append(ObjectId(product_id))
+        except Exception:
+            continue
+    return object_ids
+
+
+def fetch_products(products_collection, product_ids):
+    object_ids = _object_ids(product_ids)
+    if not object_ids:
+        return {}
+    return {
+        str(product["_id"]): product
+        for product in products_collection.find({"_id": {"$in": object_ids}})
+    }
+
+
+def hydrate_products(products_collection, ranked, categories, brands, top_k, accept=None):
+    products_by_id = fetch_products(products_collection, [product_id for product_id, _ in ranked])
+    return build_results(ranked, products_by_id, categories, brands, top_k, accept)
+
+
+def _batch_product_ids(ranked_lists):
+    return list(dict.fromkeys(product_id for ranked in ranked_lists for product_id, _ in ranked))
+
+
+def hydrate_product_batches(products_collection, ranked_lists, categories, brands, top_k, accept=None):
+    """One `$in` query for the union of several result lists"""
+    products_by_id = fetch_products(products_collection, _batch_product_ids(ranked_lists))
+    return [build_results(ranked, products_by_id, categories, brands, top_k, accept) for ranked in ranked_lists]
+
+
+async def fetch_products_async(products_collection, product_ids):
+    object_ids = _object_ids(product_ids)
+    if not object_ids:
+        return {}
+    cursor = products_collection.find({"_id": {"$in": object_ids}})
+    return {str(product["_id"]): product async for product in cursor}
+
+
+async def hydrate_products_async(products_collection, ranked, categories, brands, top_k, accept=None):
+    products_by_id = await fetch_products_async(products_collection, [product_id for product_id, _ in ranked])
+    return build_results(ranked, products_by_id, categories, brands, top_k, accept)
+
+
+async def hydrate_product_batches_async(products_collection, ranked_lists, categories, brands, top_k, accept=None):
+    products_by_id = await fetch_products_async(products_collection, _batch_product_ids(ranked_lists))
+    return [build_results(ranked, products_by_id, categories, brands, top_k, accept) for ranked in ranked_lists]
@@ -0,0 +1,89 @@
+"""
+Vectorized product-level ranking.
+
+The index scores individual image vectors; a product with many images
+must count once. Scores are grouped by a precomputed vector -> product
+ordinal array and pooled per product in a single NumPy pass:
+
+- max:  best matching image
+- mean: average over the product's (candidate) images
+- top2: mean of the two best images (a single lucky image counts less)
+
+An optional dense per-product score (e.g. text -> caption similarity) is
+added after pooling, and an optional product mask (attribute filters)
+removes ineligible products. The similarity threshold and top-k are then
+applied to the remaining scores directly, with no fixed candidate ceiling.
+"""
+import numpy as np
+
+from vector_index import top_k_indices
+
+POOLING_MODES = ("max", "mean", "top2")
+
+
+def build_product_index(product_ids):
+    """Returns (product_keys, product_index, grouped)"""
+    ordinals = {}
+    product_index = np.empty(len(product_ids), dtype=np.int32)
+    for position, product_id in enumerate(product_ids):
+        product_index[position] = ordinals.setdefault(product_id, len(ordinals))
+    product_keys = list(ordinals)
+    # Vectors of one product are normally stored contiguously; reduceat relies on it.
+    runs = 1 + int(np.count_nonzero(product_index[1:] != product_index[:-1])) if len(product_index) else 0
+    return product_keys, product_index, runs == len(product_keys)
+
+
+def pool_scores(products, scores, pooling="max"):
+    """
+    products/scores: per-vector arrays where each product's vectors are contiguous.
+    Returns (product ordinals, pooled scores), one entry per run.
+    """
+    if len(products) == 0:
+        return products, scores
+    starts = np.flatnonzero(np.concatenate(([True], products[1:] != products[:-1])))
+    counts = np.diff(np.append(starts, len(products)))
+    best = np.maximum.reduceat(scores, starts)
+
+    if pooling == "max":
+        pooled = best
+    elif pooling == "mean":
+        pooled = np.add.reduceat(scores, starts) / counts
+    elif pooling == "top2":
+        # Knock out the first best hit of each group, then take the max again.
+        positions = np.arange(len(scores))
+        is_best = scores == np.repeat(best, counts)
+        first_best = np.minimum.reduceat(np.where(is_best, positions, len(scores)), starts)
+        remaining = scores.copy()
+        remaining[first_best] = -np.inf
+        second = np.maximum.reduceat(remaining, starts)
+        second = np.where(counts > 1, second, best)
+        pooled = (best + second) / 2
+    else:
+        raise ValueError(f"Unknown pooling mode: {pooling!r} (expected one of {POOLING_MODES})")
+
+    return products[starts], pooled.astype(np.float32)
+
+
+def rank_products(vector_ids, scores, product_index, grouped=True, pooling="max", threshold=0.0, top_k=10,
+                  product_scores=None, product_mask=None):
+    """
+    vector_ids: positions of the scored vectors (None = every vector, in order).
+    product_scores: optional per-product-ordinal array added to the pooled scores.
+    product_mask: optional per-product-ordinal bool array; False products are never returned.
+    Returns (product ordinals, pooled scores) sorted by score, best first.
+    """
+    products = product_index if vector_ids is None else product_index[vector_ids]
+    scores = np.asarray(scores, dtype=np.float32)
+    if not grouped or (vector_ids is not None and np.any(np.diff(vector_ids) < 0)):
+        order = np.argsort(products, kind="stable")
+        products, scores = products[order], scores[order]
+
+    products, pooled = pool_scores(products, scores, pooling)
+    if product_scores is not None:
+        pooled = pooled + product_scores[products]
+    eligible = pooled >= threshold
+    if product_mask is not None:
+        eligible &= product_mask[products]
+    keep = np.flatnonzero(eligible)
+    best = keep[top_k_indices(pooled[keep], top_k)]
+    return products[best], pooled[best]
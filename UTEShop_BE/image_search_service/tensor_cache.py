@@ -0,0 +1,237 @@
+"""
+Pre-tensorized image cache for CLIP fine-tuning.
+
+Each training image is decoded, resized, center-cropped and normalized
+once, the same way the CLIP processor would. The result is stored as
+float16 pixel values in fixed-size shards:
+
+  <cache_dir>/shard-00000.npy   (shard_size, 3, H, W) float16
+  <cache_dir>/index.json        image path -> [shard, row, file size, mtime]
+                                plus the preprocessing config
+
+Training memory-maps the shards, so RAM use does not grow with the
+catalog. Each epoch reads tensors instead of decoding JPEGs. Re-running
+the build only preprocesses images that are new or changed on disk. A
+different image size or normalization starts a fresh cache.
+
+A changed image gets a new row and its old row is superseded. Once
+superseded rows reach COMPACT_DEAD_FRACTION of the cache, the live rows
+are copied into fresh shards and the old shards are deleted.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from image_decode import decode_image
+
+# openai/clip-vit-base-patch32 preprocessing
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+INDEX_FILE = "index.json"
+# Share of superseded rows that triggers a compaction
+COMPACT_DEAD_FRACTION = 0.25
+
+
+def processor_config(processor):
+    """(image_size, mean, std) from a CLIP processor, falling back to the CLIP defaults"""
+    image_processor = getattr(processor, "image_processor", processor)
+    crop = getattr(image_processor, "crop_size", None) or {}
+    size = crop.get("height", CLIP_IMAGE_SIZE) if isinstance(crop, dict) else int(crop)
+    mean = tuple(getattr(image_processor, "image_mean", None) or CLIP_MEAN)
+    std = tuple(getattr(image_processor, "image_std", None) or CLIP_STD)
+    return int(size), mean, std
+
+
+def preprocess_image(path, size=CLIP_IMAGE_SIZE, mean=CLIP_MEAN, std=CLIP_STD):
+    """(3, size, size) float16 pixel values: shortest side -> size, center crop, normalize"""
+    with open(path, "rb") as f:
+        image = decode_image(f.read(), min_side=size)
+    scale = size / float(min(image.size))
+    if scale != 1:
+        image = image.resize(
+            (max(size, round(image.width * scale)), max(size, round(image.height * scale))), Image.BICUBIC
+        )
+    left = (image.width - size) // 2
+    top = (image.height - size) // 2
+    image = image.crop((left, top, left + size, top + size))
+
+    pixels = np.asarray(image, dtype=np.float32) / 255.0
+    pixels = (pixels - np.array(mean, dtype=np.float32)) / np.array(std, dtype=np.float32)
+    return pixels.transpose(2, 0, 1).astype(np.float16)
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def _shard_path(cache_dir, number):
+    return os.path.join(cache_dir, f"shard-{number:05d}.npy")
+
+
+def _next_shard_number(index):
+    # Shard files are numbered independently of their position in the index,
+    # so shards written after a compaction never reuse a live file name.
+    numbers = [int(name[len("shard-"):-len(".npy")]) for name in index["shards"]]
+    return max(numbers) + 1 if numbers else 0
+
+
+def _write_shard(path, tensors, size):
+    array = np.lib.format.open_memmap(path + ".part", mode="w+", dtype=np.float16,
+                                      shape=(len(tensors), 3, size, size))
+    for row, tensor in enumerate(tensors):
+        array[row] = tensor
+    array.flush()
+    del array
+    os.replace(path + ".part", path)
+
+
+def load_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_tensor_cache(image_paths, cache_dir, size=CLIP_IMAGE_SIZE, mean=CLIP_MEAN, std=CLIP_STD,
+                       shard_size=1024, workers=4):
+    """
+    Preprocess `image_paths` (unique paths) into cache_dir.
+    Returns (index dict, number preprocessed now, unreadable paths).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    config = {"size": size, "mean": list(mean), "std": list(std), "dtype": "float16"}
+    index = load_index(cache_dir)
+    if index is None or index.get("config") != config:
+        index = {"config": config, "shards": [], "images": {}}
+
+    todo = []
+    for path in image_paths:
+        entry = index["images"].get(str(path))
+        if entry is None or tuple(entry[2:]) != _file_stamp(path):
+            todo.append(path)
+
+    failed = []
+    shard = len(index["shards"])
+    number = _next_shard_number(index)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(todo), shard_size):
+            chunk = todo[start:start + shard_size]
+            tensors = list(executor.map(lambda path: _try_preprocess(path, size, mean, std), chunk))
+            kept = [(path, tensor) for path, tensor in zip(chunk, tensors) if tensor is not None]
+            failed.extend(path for path, tensor in zip(chunk, tensors) if tensor is None)
+            if not kept:
+                continue
+
+            path = _shard_path(cache_dir, number)
+            _write_shard(path, [tensor for _, tensor in kept], size)
+
+            for row, (image_path, _) in enumerate(kept):
+                index["images"][str(image_path)] = [shard, row, *_file_stamp(image_path)]
+            index["shards"].append(os.path.basename(path))
+            _write_index(cache_dir, index)
+            print(f"🧊 Tensor cache: {start + len(chunk)}/{len(todo)} images preprocessed", flush=True)
+            shard += 1
+            number += 1
+
+    if not todo:
+        _write_index(cache_dir, index)
+    index = compact_tensor_cache(cache_dir, index, shard_size=shard_size)
+    return index, len(todo) - len(failed), failed
+
+
+def compact_tensor_cache(cache_dir, index, shard_size=1024, min_dead_fraction=COMPACT_DEAD_FRACTION):
+    """
+    Copy live rows into new shards once superseded rows reach `min_dead_fraction`
+    of the cache. Returns the (possibly new) index.
+    """
+    rows = [np.load(os.path.join(cache_dir, name), mmap_mode="r").shape[0] for name in index["shards"]]
+    total = sum(rows)
+    dead = total - len(index["images"])
+    if not dead or dead < total * min_dead_fraction:
+        _remove_orphan_shards(cache_dir, index)
+        return index
+
+    size = index["config"]["size"]
+    live = sorted(index["images"].items(), key=lambda item: (item[1][0], item[1][1]))
+    compacted = {"config": index["config"], "shards": [], "images": {}}
+    source = TensorCache(cache_dir, index)
+    number = _next_shard_number(index)
+    for start in range(0, len(live), shard_size):
+        chunk = live[start:start + shard_size]
+        path = _shard_path(cache_dir, number)
+        _write_shard(path, [source.read(entry[0], entry[1]) for _, entry in chunk], size)
+        for row, (image_path, entry) in enumerate(chunk):
+            compacted["images"][image_path] = [len(compacted["shards"]), row, *entry[2:]]
+        compacted["shards"].append(os.path.basename(path))
+        number += 1
+    del source
+
+    # The new index is written before the old shards go, so a crash in between
+    # only leaves orphan files that the next build removes.
+    _write_index(cache_dir, compacted)
+    _remove_orphan_shards(cache_dir, compacted)
+    print(f"🧊 Tensor cache compacted: dropped {dead} superseded rows, {len(live)} kept", flush=True)
+    return compacted
+
+
+def _remove_orphan_shards(cache_dir, index):
+    live = set(index["shards"])
+    for name in os.listdir(cache_dir):
+        if name.startswith("shard-") and name.endswith(".npy") and name not in live:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def _try_preprocess(path, size, mean, std):
+    try:
+        return preprocess_image(path, size, mean, std)
+    except Exception as exc:
+        print(f"⚠️  Skipping unreadable image {path}: {exc}")
+        return None
+
+
+def _write_index(cache_dir, index):
+    path = os.path.join(cache_dir, INDEX_FILE)
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(path + ".part", path)
+
+
+class TensorCache:
+    """Read side: lazily memory-maps shards (per process, so DataLoader workers each open their own)"""
+
+    def __init__(self, cache_dir, index=None):
+        self.cache_dir = cache_dir
+        self.index = index or load_index(cache_dir)
+        if self.index is None:
+            raise FileNotFoundError(f"No tensor cache in {cache_dir}")
+        self._shards = {}
+
+    def __contains__(self, image_path):
+        return str(image_path) in self.index["images"]
+
+    def location(self, image_path):
+        shard, row = self.index["images"][str(image_path)][:2]
+        return shard, row
+
+    def read(self, shard, row):
+        array = self._shards.get(shard)
+        if array is None:
+            array = self._shards[shard] = np.load(os.path.join(self.cache_dir, self.index["shards"][shard]),
+                                                  mmap_mode="r")
+        return array[row]
+
+    def __getstate__(self):
+        # Memory maps are reopened in each worker process rather than pickled.
+        state = dict(self.__dict__)
+        state["_shards"] = {}
+        return state
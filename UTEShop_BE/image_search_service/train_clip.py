@@ -1,18 +1,31 @@
 """
 Fine-tune CLIP for UTEShop image search using image-caption pairs.
 
+Images are preprocessed once into a sharded, memory-mapped tensor cache
+(tensor_cache.py, TRAIN_CACHE_DIR). Training streams pixel values from it
+through a multi-worker DataLoader, so RAM stays flat as the catalog grows
+and epochs do not re-decode JPEGs. The loss is the same in-batch
+MultipleNegativesRankingLoss (image -> caption, scale 20) as before.
+
 Run:
   python download_training_images.py
   python train_clip.py
+
+Env: TRAIN_CACHE_DIR, TRAIN_SHARD_SIZE, TRAIN_NUM_WORKERS, TRAIN_LEARNING_RATE
+(plus the settings below).
 """
 import json
 import os
 from pathlib import Path
 
-from PIL import Image
-from sentence_transformers import InputExample, SentenceTransformer
-from sentence_transformers.sentence_transformer import losses
-from torch.utils.data import DataLoader
+import torch
+import torch.nn.functional as F
+from sentence_transformers import SentenceTransformer
+from torch.utils.data import DataLoader, Dataset
+from tqdm.auto import tqdm
+from transformers import get_linear_schedule_with_warmup
+
+from tensor_cache import TensorCache, build_tensor_cache, processor_config
 
 
 DATA_PATH = Path(os.getenv("TRAIN_DATA_PATH", "training_data/train.jsonl"))
@@ -21,41 +34,61 @@ BASE_MODEL = os.getenv("BASE_CLIP_MODEL", "clip-ViT-B-32")
 BATCH_SIZE = int(os.getenv("TRAIN_BATCH_SIZE", "4"))
 EPOCHS = int(os.getenv("TRAIN_EPOCHS", "5"))
 MAX_TRAIN_RECORDS = int(os.getenv("MAX_TRAIN_RECORDS", "0"))
-
-
-def load_examples():
-    examples = []
+CACHE_DIR = os.getenv("TRAIN_CACHE_DIR", "training_data/tensor_cache")
+SHARD_SIZE = int(os.getenv("TRAIN_SHARD_SIZE", "1024"))
+NUM_WORKERS = int(os.getenv("TRAIN_NUM_WORKERS", str(min(4, os.cpu_count() or 1))))
+LEARNING_RATE = float(os.getenv("TRAIN_LEARNING_RATE", "2e-5"))
+# MultipleNegativesRankingLoss default
+SIMILARITY_SCALE = 20.0
+WEIGHT_DECAY = 0.01
+# SentenceTransformer.fit() exempts these parameters from weight decay
+NO_DECAY = ("bias", "LayerNorm.bias", "LayerNorm.weight")
+
+
+def load_records():
+    """[(image path, caption)] for records whose image file exists"""
+    records = []
     skipped = 0
     total = 0
 
     with DATA_PATH.open("r", encoding="utf-8") as f:
-        for line_index, line in enumerate(f, start=1):
-            if MAX_TRAIN_RECORDS and len(examples) >= MAX_TRAIN_RECORDS:
+        for line in f:
+            if MAX_TRAIN_RECORDS and len(records) >= MAX_TRAIN_RECORDS:
                 break
 
             total += 1
             record = json.loads(line)
             image_path = DATA_PATH.parent / record["image"]
-            caption = record["caption"]
-
             if not image_path.exists():
                 skipped += 1
                 continue
+            records.append((image_path, record["caption"]))
 
-            try:
-                image = Image.open(image_path).convert("RGB")
-            except Exception:
-                skipped += 1
-                continue
+    return records, skipped, total
+
+
+def optimizer_groups(module):
+    """AdamW parameter groups as built by SentenceTransformer.fit()"""
+    params = list(module.named_parameters())
+    return [
+        {"params": [p for name, p in params if not any(nd in name for nd in NO_DECAY)], "weight_decay": WEIGHT_DECAY},
+        {"params": [p for name, p in params if any(nd in name for nd in NO_DECAY)], "weight_decay": 0.0},
+    ]
+
+
+class CachedPairDataset(Dataset):
+    """(pixel_values, caption) pairs read lazily from the tensor cache"""
+
+    def __init__(self, cache, records):
+        self.cache = cache
+        self.items = [(*cache.location(path), caption) for path, caption in records if path in cache]
 
-            examples.append(InputExample(texts=[image, caption]))
-            if line_index == 1 or line_index % 100 == 0:
-                print(
-                    f"Loaded records: {line_index}, valid examples: {len(examples)}, skipped: {skipped}",
-                    flush=True,
-                )
+    def __len__(self):
+        return len(self.items)
 
-    return examples, skipped, total
+    def __getitem__(self, idx):
+        shard, row, caption = self.items[idx]
+        return torch.from_numpy(self.cache.read(shard, row).astype("float32")), caption
 
 
 def main():
@@ -63,36 +96,78 @@ def main():
         raise FileNotFoundError(f"Missing {DATA_PATH}. Run export_train_data.py first.")
 
     print(f"Using data file: {DATA_PATH.resolve()}", flush=True)
-    print("Loading image-caption examples...", flush=True)
-    train_examples, skipped, total = load_examples()
-    if not train_examples:
+    records, skipped, total = load_records()
+    if not records:
         raise RuntimeError("No valid training examples. Run download_training_images.py first.")
 
+    print("Loading base CLIP model...", flush=True)
+    model = SentenceTransformer(BASE_MODEL)
+    clip_module = model[0]
+    clip, processor = clip_module.model, clip_module.processor
+    print("Base model loaded", flush=True)
+
+    size, mean, std = processor_config(processor)
+    image_paths = list(dict.fromkeys(path for path, _ in records))
+    print(f"Preparing tensor cache in {CACHE_DIR} ({len(image_paths)} images, {size}px)...", flush=True)
+    index, preprocessed, unreadable = build_tensor_cache(
+        image_paths, CACHE_DIR, size=size, mean=mean, std=std, shard_size=SHARD_SIZE, workers=max(1, NUM_WORKERS)
+    )
+    dataset = CachedPairDataset(TensorCache(CACHE_DIR, index), records)
+    if not len(dataset):
+        raise RuntimeError("No readable training images. Run download_training_images.py first.")
+
     print(f"Base model: {BASE_MODEL}")
     print(f"Read records: {total}")
-    print(f"Training examples: {len(train_examples)}")
-    print(f"Skipped records: {skipped}")
+    print(f"Training examples: {len(dataset)}")
+    print(f"Skipped records: {skipped + len(records) - len(dataset)} ({len(unreadable)} unreadable images)")
+    print(f"Preprocessed now: {preprocessed} (cached: {len(image_paths) - preprocessed - len(unreadable)})")
     print(f"Batch size: {BATCH_SIZE}")
     print(f"Epochs: {EPOCHS}")
+    print(f"DataLoader workers: {NUM_WORKERS}")
     if MAX_TRAIN_RECORDS:
         print(f"Max train records: {MAX_TRAIN_RECORDS}")
-    print("Loading base CLIP model...", flush=True)
-
-    model = SentenceTransformer(BASE_MODEL)
-    print("Base model loaded", flush=True)
-    train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=BATCH_SIZE)
-    train_loss = losses.MultipleNegativesRankingLoss(model)
-    warmup_steps = max(1, int(len(train_dataloader) * EPOCHS * 0.1))
 
-    print("Starting training...", flush=True)
-    model.fit(
-        train_objectives=[(train_dataloader, train_loss)],
-        epochs=EPOCHS,
-        warmup_steps=warmup_steps,
-        output_path=OUTPUT_DIR,
-        show_progress_bar=True,
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    clip.to(device)
+    clip.train()
+
+    train_dataloader = DataLoader(
+        dataset,
+        batch_size=BATCH_SIZE,
+        shuffle=True,
+        num_workers=NUM_WORKERS,
+        pin_memory=device.type == "cuda",
+        persistent_workers=NUM_WORKERS > 0,
     )
+    total_steps = len(train_dataloader) * EPOCHS
+    optimizer = torch.optim.AdamW(optimizer_groups(clip), lr=LEARNING_RATE)
+    scheduler = get_linear_schedule_with_warmup(optimizer, max(1, int(total_steps * 0.1)), total_steps)
 
+    print("Starting training...", flush=True)
+    for epoch in range(EPOCHS):
+        running_loss = 0.0
+        progress = tqdm(train_dataloader, desc=f"Epoch {epoch + 1}/{EPOCHS}")
+        for step, (pixel_values, captions) in enumerate(progress, start=1):
+            tokens = processor.tokenizer(list(captions), padding=True, truncation=True, return_tensors="pt")
+            tokens = {name: value.to(device) for name, value in tokens.items()}
+            pixel_values = pixel_values.to(device, non_blocking=True)
+            image_embeds = F.normalize(clip.get_image_features(pixel_values=pixel_values), dim=-1)
+            text_embeds = F.normalize(clip.get_text_features(**tokens), dim=-1)
+
+            scores = image_embeds @ text_embeds.T * SIMILARITY_SCALE
+            loss = F.cross_entropy(scores, torch.arange(len(scores), device=device))
+
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(clip.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+
+            running_loss += loss.item()
+            progress.set_postfix(loss=f"{running_loss / step:.4f}")
+
+    clip.eval()
+    model.save(OUTPUT_DIR)
     print(f"Saved model to {OUTPUT_DIR}")
 
 
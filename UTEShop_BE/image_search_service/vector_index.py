@@ -0,0 +1,191 @@
+"""
+Vector indexes for the image search service.
+
+Both backends work on an L2-normalized matrix, so cosine similarity is a
+dot product. The matrix can be a float32 ndarray or any object with the
+same `dot` / slicing interface (e.g. a quantized, memory-mapped
+`embedding_storage.StoredMatrix`).
+
+- exact: scores every vector and selects the top-k with argpartition
+  (O(N) instead of a full argsort).
+- ivf:   inverted-file index. A spherical k-means coarse quantizer splits the
+  vectors into `nlist` lists; a query only scores the vectors in its
+  `nprobe` closest lists. Pure NumPy, no native dependencies.
+
+An index serializes to a small dict of NumPy arrays (`to_state`) so the
+update task can persist it next to the embeddings and workers can restore
+it without re-clustering.
+"""
+import math
+
+import numpy as np
+
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, sorted descending"""
+    k = min(int(k), len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(len(scores))
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+class ExactIndex:
+    name = "exact"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, embeddings, **params):
+        return cls(embeddings)
+
+    @classmethod
+    def from_state(cls, embeddings, state, **params):
+        return cls(embeddings)
+
+    def to_state(self):
+        return {}
+
+    def candidates(self, query):
+        """Return (vector indices, scores) of every vector worth ranking (None = all)"""
+        return None, self.embeddings.dot(query)
+
+    def candidates_many(self, queries, chunk_size=64):
+        """Yield candidates() for each query row, scoring a block of queries per matrix multiply"""
+        for start in range(0, len(queries), chunk_size):
+            block = queries[start:start + chunk_size]
+            scores = np.ascontiguousarray(self.embeddings.dot(block.T).T)
+            for row in scores:
+                yield None, row
+
+    def search(self, query, k):
+        indices, scores = self.candidates(query)
+        order = top_k_indices(scores, k)
+        if indices is None:
+            return order, scores[order]
+        return indices[order], scores[order]
+
+    def info(self):
+        return {"backend": self.name, "size": len(self.embeddings)}
+
+
+class IVFIndex:
+    name = "ivf"
+
+    def __init__(self, embeddings, centroids, assignments, nprobe=8):
+        self.embeddings = embeddings
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.nprobe = nprobe
+
+        # Group vector ids by list so a probe is a contiguous slice.
+        self.order = np.argsort(self.assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    @staticmethod
+    def default_nlist(size):
+        return max(1, min(4096, int(4 * math.sqrt(size))))
+
+    @staticmethod
+    def _assign(embeddings, centroids, chunk_size=65536):
+        assignments = np.empty(len(embeddings), dtype=np.int32)
+        for start in range(0, len(embeddings), chunk_size):
+            block = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, nprobe=8, iterations=10, max_train_size=65536, seed=0, **params):
+        size = len(embeddings)
+        nlist = int(nlist or cls.default_nlist(size))
+        nlist = max(1, min(nlist, size))
+        rng = np.random.default_rng(seed)
+
+        if size > max_train_size:
+            train = np.asarray(embeddings[np.sort(rng.choice(size, max_train_size, replace=False))], dtype=np.float32)
+        else:
+            train = np.asarray(embeddings, dtype=np.float32)
+
+        # Spherical k-means: centroids stay on the unit sphere.
+        centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(train @ centroids.T, axis=1)
+            counts = np.bincount(labels, minlength=nlist)
+            # Per-list sums via one reduceat over label-sorted rows (np.add.at is far slower).
+            order = np.argsort(labels, kind="stable")
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.zeros_like(centroids)
+            non_empty = counts > 0
+            sums[non_empty] = np.add.reduceat(train[order], starts[non_empty], axis=0)
+            empty = counts == 0
+            if empty.any():
+                # Re-seed empty lists with random training vectors.
+                sums[empty] = train[rng.choice(len(train), int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        return cls(embeddings, centroids, cls._assign(embeddings, centroids), nprobe=nprobe)
+
+    @classmethod
+    def from_state(cls, embeddings, state, nprobe=8, **params):
+        return cls(embeddings, state["centroids"], state["assignments"], nprobe=nprobe)
+
+    def to_state(self):
+        return {"centroids": self.centroids, "assignments": self.assignments}
+
+    def candidates(self, query, nprobe=None):
+        nprobe = min(int(nprobe or self.nprobe), len(self.centroids))
+        probe = top_k_indices(self.centroids @ query, nprobe)
+        indices = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probe])
+        indices.sort()
+        return indices, self.embeddings[indices] @ query
+
+    def candidates_many(self, queries, nprobe=None):
+        nprobe = min(int(nprobe or self.nprobe), len(self.centroids))
+        # Probe selection for the whole batch in one multiply; list scans stay per query.
+        centroid_scores = queries @ self.centroids.T
+        for query, row in zip(queries, centroid_scores):
+            probe = top_k_indices(row, nprobe)
+            indices = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probe])
+            indices.sort()
+            yield indices, self.embeddings[indices] @ query
+
+    def search(self, query, k, nprobe=None):
+        indices, scores = self.candidates(query, nprobe=nprobe)
+        order = top_k_indices(scores, k)
+        return indices[order], scores[order]
+
+    def info(self):
+        return {
+            "backend": self.name,
+            "size": len(self.embeddings),
+            "nlist": len(self.centroids),
+            "nprobe": self.nprobe,
+        }
+
+
+INDEX_BACKENDS = {
+    ExactIndex.name: ExactIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def get_backend(name):
+    try:
+        return INDEX_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown vector index backend: {name!r} (expected one of {sorted(INDEX_BACKENDS)})")
+
+
+def build_index(name, embeddings, **params):
+    return get_backend(name).build(embeddings, **params)
+
+
+def restore_index(name, embeddings, state, **params):
+    return get_backend(name).from_state(embeddings, state, **params)
@@ -163,7 +163,7 @@ export const updateEmbeddings = asyncHandler(async (req, res) => {
         console.log('🔄 Calling Python service to update embeddings...');
         const response = await axios.post(
             `${IMAGE_SEARCH_SERVICE_URL}/update-embeddings`,
-            {},
+            req.body?.mode ? { mode: req.body.mode } : {},
             {
                 timeout: 300000, // 5 minutes timeout for large datasets
                 httpAgent: httpAgent // Force IPv4
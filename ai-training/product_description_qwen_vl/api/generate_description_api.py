@@ -59,9 +59,48 @@ RUN_PUBLIC_UPLOAD_TEST = False
 # Bật/tắt kiểm tra ảnh thời trang.
 ENABLE_FASHION_IMAGE_VALIDATION = True
 
+# Cách kiểm tra ảnh thời trang:
+# - "single_pass": ảnh + phần đầu prompt chỉ encode 1 lần (KV cache dùng chung),
+#   VALID/INVALID lấy từ logit của token đầu tiên, rồi sinh mô tả tiếp trên cùng cache.
+# - "two_pass": gọi model 2 lần như cũ (validate rồi generate).
+# single_pass tự fallback về two_pass nếu phiên bản transformers không hỗ trợ.
+FASHION_VALIDATION_MODE = "single_pass"
+# Sau ngần này lần single_pass lỗi liên tiếp thì chuyển hẳn sang two_pass
+# (tránh mỗi request phải prefill rồi bỏ đi trước khi chạy lại 2 lần).
+SINGLE_PASS_MAX_FAILURES = 3
+
+# Lọc nhanh bằng CLIP trên CPU trước khi gọi Qwen-VL validate.
+# Ảnh chắc chắn là thời trang / chắc chắn không phải sẽ bỏ qua bước Qwen-VL validate.
+ENABLE_CLIP_PREFILTER = True
+CLIP_PREFILTER_MODEL = "clip-ViT-B-32"
+# Ngưỡng theo P(thời trang) từ CLIP zero-shot.
+CLIP_PREFILTER_ACCEPT = 0.90
+CLIP_PREFILTER_REJECT = 0.05
+# Logit scale của CLIP ViT-B/32.
+CLIP_PREFILTER_LOGIT_SCALE = 100.0
+
+# Gom các request /generate-description đồng thời thành batch cho model.generate.
+ENABLE_GENERATION_BATCHING = True
+GENERATION_MAX_BATCH_SIZE = 4
+# Giới hạn số request x (prompt dài nhất + max_new_tokens) của 1 batch (bộ nhớ KV cache).
+GENERATION_TOKEN_BUDGET = 8192
+# Thời gian tối đa request đầu tiên chờ để gom thêm request vào batch.
+GENERATION_MAX_WAIT_MS = 50
+
+# Cache mô tả đã sinh theo (ảnh, thông tin sản phẩm, tham số generate).
+ENABLE_RESPONSE_CACHE = True
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600
+# File sqlite để cache còn sau khi restart (vd "/kaggle/working/description_cache.sqlite3").
+# Để rỗng = chỉ cache trong RAM.
+RESPONSE_CACHE_SQLITE_PATH = ""
+
 print("BASE_MODEL_ID:", BASE_MODEL_ID)
 print("USE_4BIT:", USE_4BIT)
 print("ENABLE_FASHION_IMAGE_VALIDATION:", ENABLE_FASHION_IMAGE_VALIDATION)
+print("FASHION_VALIDATION_MODE:", FASHION_VALIDATION_MODE)
+print("ENABLE_CLIP_PREFILTER:", ENABLE_CLIP_PREFILTER)
+print("ENABLE_GENERATION_BATCHING:", ENABLE_GENERATION_BATCHING)
 
 # ============================================================
 # AUTO INSTALL / FIX PACKAGES
@@ -110,6 +149,9 @@ ensure_package("accelerate")
 ensure_package("qwen_vl_utils", "qwen-vl-utils")
 ensure_package("safetensors")
 
+if ENABLE_CLIP_PREFILTER:
+    ensure_package("sentence_transformers", "sentence-transformers")
+
 if USE_4BIT:
     print("Ensuring bitsandbytes>=0.46.1 ...")
     pip_install("bitsandbytes>=0.46.1")
@@ -126,6 +168,11 @@ import base64
 import threading
 import socket
 import gc
+import hashlib
+import json
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from io import BytesIO
 from pathlib import Path
 
@@ -136,12 +183,14 @@ from PIL import Image
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from pyngrok import ngrok
 
 from peft import PeftModel
 from transformers import (
     AutoProcessor,
+    DynamicCache,
     Qwen2_5_VLForConditionalGeneration,
 )
 
@@ -411,11 +460,186 @@ if torch.cuda.is_available():
     print("VRAM allocated:", round(torch.cuda.memory_allocated() / 1024**3, 2), "GB")
     print("VRAM reserved:", round(torch.cuda.memory_reserved() / 1024**3, 2), "GB")
 
+# ============================================================
+# CLIP ZERO-SHOT PRE-FILTER (CPU)
+# ============================================================
+#
+# Chạy trước bước kiểm duyệt bằng Qwen-VL. Ảnh được so với 2 nhóm prompt
+# (thời trang / không phải thời trang) bằng CLIP - cùng loại encoder với
+# image search service. P(thời trang) = tổng softmax của nhóm thời trang.
+# - P >= CLIP_PREFILTER_ACCEPT: nhận luôn, bỏ qua bước Qwen-VL validate.
+# - P <= CLIP_PREFILTER_REJECT: từ chối luôn, không gọi Qwen-VL.
+# - Còn lại: không chắc, để Qwen-VL quyết định như cũ.
+
+print("\n===== LOADING CLIP PRE-FILTER =====")
+
+FASHION_PROMPTS = [
+    "a product photo of a shirt",
+    "a product photo of a t-shirt",
+    "a product photo of trousers or jeans",
+    "a product photo of a dress or skirt",
+    "a product photo of a jacket or coat",
+    "a product photo of shoes or sneakers",
+    "a product photo of sandals or slippers",
+    "a product photo of a handbag or backpack",
+    "a product photo of a wallet",
+    "a product photo of a hat or cap",
+    "a product photo of a belt",
+    "a product photo of sunglasses",
+    "a person wearing fashionable clothes",
+    "a photo of sportswear",
+]
+
+NON_FASHION_PROMPTS = [
+    "a photo of a car",
+    "a photo of a motorbike",
+    "a photo of a phone or laptop",
+    "a photo of an electronic device",
+    "a photo of food",
+    "a photo of an animal",
+    "a photo of a landscape",
+    "a photo of a building",
+    "a photo of furniture",
+    "a photo of a document or screenshot",
+    "a blank or plain image",
+]
+
+clip_prefilter_model = None
+clip_prefilter_text_embeddings = None
+clip_prefilter_lock = threading.Lock()
+clip_prefilter_stats = {
+    "checked": 0,
+    "accepted": 0,
+    "rejected": 0,
+    "uncertain": 0,
+    "errors": 0,
+    "total_ms": 0.0,
+}
+
+if ENABLE_CLIP_PREFILTER:
+    try:
+        from sentence_transformers import SentenceTransformer
+
+        clip_prefilter_model = SentenceTransformer(CLIP_PREFILTER_MODEL, device="cpu")
+        clip_prefilter_text_embeddings = clip_prefilter_model.encode(
+            FASHION_PROMPTS + NON_FASHION_PROMPTS,
+            convert_to_tensor=True,
+            normalize_embeddings=True,
+        )
+        print("CLIP pre-filter loaded:", CLIP_PREFILTER_MODEL)
+    except Exception as e:
+        clip_prefilter_model = None
+        print("CLIP pre-filter disabled, load failed:", repr(e))
+
+
+@torch.inference_mode()
+def clip_fashion_probability(image):
+    image_embedding = clip_prefilter_model.encode(
+        [image],
+        convert_to_tensor=True,
+        normalize_embeddings=True,
+    )
+    logits = CLIP_PREFILTER_LOGIT_SCALE * image_embedding @ clip_prefilter_text_embeddings.T
+    probabilities = logits.softmax(dim=-1)[0]
+    return float(probabilities[: len(FASHION_PROMPTS)].sum().item())
+
+
+def clip_prefilter_decision(image):
+    """
+    Trả về "accept", "reject", "uncertain",
+    hoặc None khi pre-filter tắt / lỗi (khi đó Qwen-VL tự kiểm tra).
+    """
+    if clip_prefilter_model is None:
+        return None
+
+    started = time.perf_counter()
+    try:
+        probability = clip_fashion_probability(image)
+    except Exception as e:
+        print("CLIP pre-filter failed:", repr(e))
+        with clip_prefilter_lock:
+            clip_prefilter_stats["errors"] += 1
+        return None
+
+    if probability >= CLIP_PREFILTER_ACCEPT:
+        decision = "accept"
+    elif probability <= CLIP_PREFILTER_REJECT:
+        decision = "reject"
+    else:
+        decision = "uncertain"
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    with clip_prefilter_lock:
+        clip_prefilter_stats["checked"] += 1
+        clip_prefilter_stats[{"accept": "accepted", "reject": "rejected", "uncertain": "uncertain"}[decision]] += 1
+        clip_prefilter_stats["total_ms"] += elapsed_ms
+
+    print(f"CLIP pre-filter: P(fashion)={probability:.3f} -> {decision} ({elapsed_ms:.0f} ms)")
+    return decision
+
+
+def clip_prefilter_report():
+    with clip_prefilter_lock:
+        stats = dict(clip_prefilter_stats)
+
+    checked = stats["checked"]
+    return {
+        "enabled": clip_prefilter_model is not None,
+        "model": CLIP_PREFILTER_MODEL,
+        "accept_threshold": CLIP_PREFILTER_ACCEPT,
+        "reject_threshold": CLIP_PREFILTER_REJECT,
+        "checked": checked,
+        "accepted": stats["accepted"],
+        "rejected": stats["rejected"],
+        "uncertain": stats["uncertain"],
+        "errors": stats["errors"],
+        # Tỷ lệ request không cần gọi Qwen-VL để validate.
+        "vlm_skip_rate": round((stats["accepted"] + stats["rejected"]) / checked, 4) if checked else None,
+        "avg_ms": round(stats["total_ms"] / checked, 1) if checked else None,
+    }
+
+
 # ============================================================
 # HELPER FUNCTIONS
 # ============================================================
 
 
+def processor_max_pixels():
+    """Số pixel tối đa processor Qwen-VL giữ lại; ảnh lớn hơn sẽ bị processor thu nhỏ."""
+    image_processor = getattr(processor, "image_processor", None)
+    max_pixels = getattr(image_processor, "max_pixels", None)
+    if not max_pixels:
+        size = getattr(image_processor, "size", None)
+        if isinstance(size, dict):
+            max_pixels = size.get("longest_edge") or size.get("max_pixels")
+    return int(max_pixels) if max_pixels else None
+
+
+def decode_image_bytes(image_bytes, max_pixels=None):
+    """
+    Decode ảnh một lần, thu nhỏ ngay lúc load về max_pixels của processor.
+
+    Với JPEG, draft() cho libjpeg decode thẳng ở 1/2, 1/4, 1/8 kích thước,
+    nên ảnh upload 12MP không cần bung hết pixel ra RAM rồi mới resize.
+    """
+    if max_pixels is None:
+        max_pixels = processor_max_pixels()
+
+    image = Image.open(BytesIO(image_bytes))
+
+    if max_pixels and image.width * image.height > max_pixels:
+        scale = (max_pixels / float(image.width * image.height)) ** 0.5
+        target = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        # draft() chỉ giảm về kích thước >= target, phần còn lại resize bên dưới.
+        image.draft("RGB", target)
+        image = image.convert("RGB")
+        if image.width * image.height > max_pixels:
+            image = image.resize(target, Image.BICUBIC)
+        return image
+
+    return image.convert("RGB")
+
+
 def pil_image_from_base64(image_base64: str):
     if not image_base64:
         return None
@@ -424,8 +648,7 @@ def pil_image_from_base64(image_base64: str):
         image_base64 = image_base64.split(",", 1)[1]
 
     image_bytes = base64.b64decode(image_base64)
-    image = Image.open(BytesIO(image_bytes)).convert("RGB")
-    return image
+    return decode_image_bytes(image_bytes)
 
 
 def pil_image_from_url(image_url: str):
@@ -442,8 +665,7 @@ def pil_image_from_url(image_url: str):
     )
     response.raise_for_status()
 
-    image = Image.open(BytesIO(response.content)).convert("RGB")
-    return image
+    return decode_image_bytes(response.content)
 
 
 def safe_text(value):
@@ -553,15 +775,65 @@ def clean_generated_text(text):
     return text.strip()
 
 
-@torch.inference_mode()
-def run_qwen_vl_text_generation(
-    messages,
+def build_image_messages(image, prompt):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image", "image": image},
+                {"type": "text", "text": prompt},
+            ],
+        }
+    ]
+
+
+def messages_images(messages):
+    """Ảnh đã resize theo min/max pixels của Qwen-VL (qua qwen_vl_utils nếu có)."""
+    if process_vision_info is not None:
+        image_inputs, video_inputs = process_vision_info(messages)
+        return image_inputs, video_inputs
+
+    images = [
+        item["image"]
+        for message in messages
+        for item in message.get("content", [])
+        if isinstance(item, dict) and item.get("type") == "image"
+    ]
+    return images, None
+
+
+def build_generate_kwargs(
     max_new_tokens=220,
     do_sample=True,
     temperature=0.7,
     top_p=0.9,
     repetition_penalty=1.08,
 ):
+    generate_kwargs = {
+        "max_new_tokens": int(max_new_tokens),
+        "do_sample": bool(do_sample),
+    }
+
+    if do_sample:
+        generate_kwargs.update(
+            {
+                "temperature": float(temperature),
+                "top_p": float(top_p),
+                "repetition_penalty": float(repetition_penalty),
+            }
+        )
+
+    return generate_kwargs
+
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def prepare_generation_inputs(messages):
+    """Chat template + processor cho 1 request (CPU, chạy trên thread của request)."""
     text = processor.apply_chat_template(
         messages,
         tokenize=False,
@@ -576,74 +848,99 @@ def run_qwen_vl_text_generation(
     )
 
     if has_image:
-        if process_vision_info is not None:
-            image_inputs, video_inputs = process_vision_info(messages)
-            inputs = processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt",
-            )
-        else:
-            images = [
-                item["image"]
-                for message in messages
-                for item in message.get("content", [])
-                if isinstance(item, dict) and item.get("type") == "image"
-            ]
-            inputs = processor(
-                text=[text],
-                images=images,
-                padding=True,
-                return_tensors="pt",
-            )
-    else:
-        inputs = processor(
+        image_inputs, video_inputs = messages_images(messages)
+        return processor(
             text=[text],
+            images=image_inputs,
+            videos=video_inputs,
             padding=True,
             return_tensors="pt",
         )
 
-    inputs = inputs.to(model.device)
+    return processor(
+        text=[text],
+        padding=True,
+        return_tensors="pt",
+    )
 
-    generate_kwargs = {
-        "max_new_tokens": int(max_new_tokens),
-        "do_sample": bool(do_sample),
-    }
 
-    if do_sample:
-        generate_kwargs.update(
-            {
-                "temperature": float(temperature),
-                "top_p": float(top_p),
-                "repetition_penalty": float(repetition_penalty),
-            }
-        )
+def collate_generation_inputs(inputs_list):
+    """Gộp input của nhiều request: left-pad input_ids, nối pixel_values / image_grid_thw."""
+    if len(inputs_list) == 1:
+        return dict(inputs_list[0])
+
+    pad_token_id = processor.tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = processor.tokenizer.eos_token_id
+
+    length = max(inputs["input_ids"].shape[1] for inputs in inputs_list)
+    input_ids = torch.full((len(inputs_list), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(inputs_list), length), dtype=torch.long)
+
+    for row, inputs in enumerate(inputs_list):
+        ids = inputs["input_ids"][0]
+        input_ids[row, length - len(ids):] = ids
+        attention_mask[row, length - len(ids):] = 1
+
+    batch = {"input_ids": input_ids, "attention_mask": attention_mask}
+    for key in inputs_list[0].keys():
+        if key in batch:
+            continue
+        values = [inputs[key] for inputs in inputs_list if inputs.get(key) is not None]
+        if values and all(isinstance(value, torch.Tensor) for value in values):
+            batch[key] = torch.cat(values, dim=0)
+
+    return batch
+
+
+@torch.inference_mode()
+def generate_from_inputs(inputs_list, generate_kwargs, max_new_tokens_list=None):
+    """1 lần model.generate cho cả batch; trả về text đã làm sạch theo đúng thứ tự input."""
+    batch = collate_generation_inputs(inputs_list)
+    batch = {key: value.to(model.device) for key, value in batch.items()}
 
     generated_ids = model.generate(
-        **inputs,
+        **batch,
         **generate_kwargs,
     )
 
+    prompt_length = batch["input_ids"].shape[1]
+    if max_new_tokens_list is None:
+        max_new_tokens_list = [generate_kwargs["max_new_tokens"]] * len(inputs_list)
+
+    # Batch chạy với max_new_tokens lớn nhất; cắt lại theo giới hạn của từng request.
     generated_ids_trimmed = [
-        output_ids[len(input_ids):]
-        for input_ids, output_ids in zip(inputs.input_ids, generated_ids)
+        output_ids[prompt_length:prompt_length + int(limit)]
+        for output_ids, limit in zip(generated_ids, max_new_tokens_list)
     ]
 
-    output_text = processor.batch_decode(
+    output_texts = processor.batch_decode(
         generated_ids_trimmed,
         skip_special_tokens=True,
         clean_up_tokenization_spaces=False,
-    )[0]
+    )
 
-    output_text = clean_generated_text(output_text)
+    release_memory()
 
-    gc.collect()
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
+    return [clean_generated_text(text) for text in output_texts]
 
-    return output_text
+
+@torch.inference_mode()
+def run_qwen_vl_text_generation(
+    messages,
+    max_new_tokens=220,
+    do_sample=True,
+    temperature=0.7,
+    top_p=0.9,
+    repetition_penalty=1.08,
+):
+    generate_kwargs = build_generate_kwargs(max_new_tokens, do_sample, temperature, top_p, repetition_penalty)
+    inputs = prepare_generation_inputs(messages)
+
+    if generation_queue is not None:
+        return generation_queue.generate(inputs, generate_kwargs)
+
+    return generate_from_inputs([inputs], generate_kwargs)[0]
 
 
 @torch.inference_mode()
@@ -662,18 +959,8 @@ def validate_fashion_image(
         brand=brand,
     )
 
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": prompt},
-            ],
-        }
-    ]
-
     output_text = run_qwen_vl_text_generation(
-        messages=messages,
+        messages=build_image_messages(image, prompt),
         max_new_tokens=8,
         do_sample=False,
     )
@@ -694,6 +981,522 @@ def validate_fashion_image(
     return False, f"Không xác định được ảnh có phải sản phẩm thời trang hay không. Model trả về: {output_text}"
 
 
+# ============================================================
+# SINGLE PASS: VALIDATE + GENERATE TRÊN CÙNG KV CACHE
+# ============================================================
+#
+# Prompt validate và prompt mô tả có chung phần đầu:
+#   <system> <|im_start|>user <|vision_start|> [image tokens] <|vision_end|>
+# Phần này (gồm cả vision tower) chỉ chạy 1 lần. Sau đó:
+# 1. Chạy tiếp phần đuôi của prompt validate trên cache, so logit token đầu
+#    của "VALID" và "INVALID" (greedy bị ràng buộc vào 2 đáp án) -> không cần decode.
+# 2. Cắt cache về phần đầu chung, generate mô tả từ phần đuôi của prompt mô tả.
+
+VISION_END_TOKEN = "<|vision_end|>"
+
+
+def first_token_id(word):
+    return processor.tokenizer.encode(word, add_special_tokens=False)[0]
+
+
+def split_after_image(text):
+    if text.count(VISION_END_TOKEN) != 1:
+        raise ValueError("Prompt phải có đúng 1 ảnh để dùng single pass.")
+    prefix, suffix = text.split(VISION_END_TOKEN, 1)
+    return prefix + VISION_END_TOKEN, suffix
+
+
+def suffix_ids(text):
+    return processor.tokenizer(
+        text,
+        add_special_tokens=False,
+        return_tensors="pt",
+    ).input_ids.to(model.device)
+
+
+# Chế độ đang chạy thực tế; có thể bị hạ xuống "two_pass" khi single_pass lỗi liên tiếp.
+active_validation_mode = FASHION_VALIDATION_MODE
+single_pass_failures = 0
+single_pass_lock = threading.Lock()
+
+
+def record_single_pass_result(error=None):
+    global active_validation_mode, single_pass_failures
+
+    with single_pass_lock:
+        if error is None:
+            single_pass_failures = 0
+            return
+
+        single_pass_failures += 1
+        if active_validation_mode == "single_pass" and single_pass_failures >= SINGLE_PASS_MAX_FAILURES:
+            active_validation_mode = "two_pass"
+            print(
+                f"Single-pass validation failed {single_pass_failures} times in a row, "
+                "switching FASHION_VALIDATION_MODE to two_pass. Last error:",
+                repr(error),
+            )
+
+
+@torch.inference_mode()
+def validate_and_generate_single_pass(image, validation_prompt, generation_prompt, generate_kwargs):
+    """
+    Trả về (is_valid, valid_probability, output_text).
+    output_text là None khi ảnh bị từ chối (không tốn bước decode nào).
+    """
+    valid_id = first_token_id("VALID")
+    invalid_id = first_token_id("INVALID")
+    if valid_id == invalid_id:
+        raise ValueError("Tokenizer không phân biệt được VALID/INVALID ở token đầu.")
+
+    validation_messages = build_image_messages(image, validation_prompt)
+    validation_text = processor.apply_chat_template(validation_messages, tokenize=False, add_generation_prompt=True)
+    generation_text = processor.apply_chat_template(
+        build_image_messages(image, generation_prompt),
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+    prefix_text, validation_suffix = split_after_image(validation_text)
+    generation_prefix, generation_suffix = split_after_image(generation_text)
+    if prefix_text != generation_prefix:
+        raise ValueError("Prompt validate và prompt mô tả không có chung phần đầu.")
+
+    image_inputs, _ = messages_images(validation_messages)
+    prefix_inputs = processor(
+        text=[prefix_text],
+        images=image_inputs,
+        return_tensors="pt",
+    ).to(model.device)
+    prefix_length = prefix_inputs.input_ids.shape[1]
+    device = prefix_inputs.input_ids.device
+
+    # 1. Prefill phần chung: vision tower + system/user header.
+    #    cache_position bắt đầu từ 0 để model tính lại rope_deltas cho ảnh này.
+    #    Chỉ cần KV cache: logits_to_keep=1 để không tạo logits
+    #    (số token ảnh x ~150k vocab) cho mọi vị trí rồi bỏ đi.
+    cache = DynamicCache()
+    prefill_outputs = model(
+        **prefix_inputs,
+        past_key_values=cache,
+        use_cache=True,
+        cache_position=torch.arange(prefix_length, device=device),
+        logits_to_keep=1,
+    )
+    del prefill_outputs
+
+    # 2. Validate: chỉ 1 forward cho phần đuôi, đọc logit ở vị trí cuối.
+    validation_ids = suffix_ids(validation_suffix)
+    validation_length = prefix_length + validation_ids.shape[1]
+    outputs = model(
+        input_ids=validation_ids,
+        attention_mask=torch.ones((1, validation_length), dtype=torch.long, device=device),
+        past_key_values=cache,
+        use_cache=True,
+        cache_position=torch.arange(prefix_length, validation_length, device=device),
+        logits_to_keep=1,
+    )
+    last_logits = outputs.logits[0, -1]
+    pair = torch.stack([last_logits[valid_id], last_logits[invalid_id]]).float().softmax(dim=-1)
+    valid_probability = float(pair[0].item())
+    del outputs
+
+    if valid_probability < 0.5:
+        release_memory()
+        return False, valid_probability, None
+
+    # 3. Generate: bỏ phần validate khỏi cache, sinh mô tả tiếp từ phần đầu chung.
+    cache.crop(prefix_length)
+    input_ids = torch.cat([prefix_inputs.input_ids, suffix_ids(generation_suffix)], dim=1)
+    generated_ids = model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        image_grid_thw=prefix_inputs.get("image_grid_thw"),
+        past_key_values=cache,
+        **generate_kwargs,
+    )
+
+    output_text = processor.batch_decode(
+        generated_ids[:, input_ids.shape[1]:],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False,
+    )[0]
+
+    del cache
+    release_memory()
+
+    return True, valid_probability, clean_generated_text(output_text)
+
+
+# ============================================================
+# GENERATION QUEUE (DYNAMIC BATCHING)
+# ============================================================
+#
+# Mọi lần gọi model đi qua 1 worker thread duy nhất:
+# - Request generate được xếp hàng; worker chờ tối đa GENERATION_MAX_WAIT_MS
+#   để gom các request cùng tham số sampling thành 1 batch (left padding),
+#   giới hạn bởi GENERATION_MAX_BATCH_SIZE và GENERATION_TOKEN_BUDGET
+#   (số request x (prompt dài nhất + max_new_tokens)), rồi gọi model.generate 1 lần.
+# - Việc cần KV cache riêng (single pass validate + generate) chạy độc quyền,
+#   lần lượt giữa các batch.
+# Worker cũng là điểm tuần tự hóa GPU: model giữ trạng thái (rope_deltas)
+# giữa các bước decode nên không được gọi song song từ nhiều thread.
+
+
+class GenerationJob:
+    def __init__(self, inputs=None, generate_kwargs=None, func=None):
+        self.inputs = inputs
+        self.generate_kwargs = generate_kwargs or {}
+        self.func = func
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+        self.prompt_tokens = int(inputs["input_ids"].shape[1]) if inputs is not None else 0
+        self.max_new_tokens = int(self.generate_kwargs.get("max_new_tokens", 0))
+        # Chỉ gộp các request có cùng tham số sampling (trừ max_new_tokens).
+        self.batch_key = tuple(sorted(
+            (key, value) for key, value in self.generate_kwargs.items() if key != "max_new_tokens"
+        ))
+
+    @property
+    def exclusive(self):
+        return self.func is not None
+
+
+class GenerationQueue:
+    def __init__(self, max_batch_size=4, token_budget=8192, max_wait_ms=50):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.token_budget = int(token_budget)
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._stats = {
+            "submitted": 0,
+            "batches": 0,
+            "batched_requests": 0,
+            "largest_batch": 0,
+            "exclusive_calls": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+        self._thread = threading.Thread(target=self._worker, name="qwen-generation-queue", daemon=True)
+        self._thread.start()
+
+    def generate(self, inputs, generate_kwargs):
+        """Chờ tới khi batch chứa request này chạy xong; trả về text đã decode."""
+        return self._submit(GenerationJob(inputs=inputs, generate_kwargs=generate_kwargs))
+
+    def run_exclusive(self, func, *args, **kwargs):
+        """Chạy func trên worker, không song song với batch nào."""
+        return self._submit(GenerationJob(func=lambda: func(*args, **kwargs)))
+
+    def _submit(self, job):
+        with self._cond:
+            self._jobs.append(job)
+            self._stats["submitted"] += 1
+            self._cond.notify_all()
+        return job.future.result()
+
+    def _fits(self, batch):
+        if len(batch) == 1:
+            return True
+        longest_prompt = max(job.prompt_tokens for job in batch)
+        longest_output = max(job.max_new_tokens for job in batch)
+        return len(batch) * (longest_prompt + longest_output) <= self.token_budget
+
+    def _take_batch(self):
+        first = self._jobs.popleft()
+        if first.exclusive:
+            return [first]
+
+        batch = [first]
+        remaining = deque()
+        while self._jobs:
+            job = self._jobs.popleft()
+            if (
+                len(batch) < self.max_batch_size
+                and not job.exclusive
+                and job.batch_key == first.batch_key
+                and self._fits(batch + [job])
+            ):
+                batch.append(job)
+            else:
+                remaining.append(job)
+        self._jobs = remaining
+        return batch
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+
+                if not self._jobs[0].exclusive:
+                    # Cửa sổ gom batch ngắn tính từ lúc request đầu tiên vào hàng đợi.
+                    deadline = self._jobs[0].enqueued_at + self.max_wait
+                    while len(self._jobs) < self.max_batch_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+
+                batch = self._take_batch()
+
+            self._run(batch)
+
+    def _run(self, batch):
+        started = time.monotonic()
+        waits_ms = [(started - job.enqueued_at) * 1000 for job in batch]
+
+        with self._cond:
+            self._stats["total_wait_ms"] += sum(waits_ms)
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], *waits_ms)
+            if batch[0].exclusive:
+                self._stats["exclusive_calls"] += 1
+            else:
+                self._stats["batches"] += 1
+                self._stats["batched_requests"] += len(batch)
+                self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+        if batch[0].exclusive:
+            job = batch[0]
+            try:
+                job.future.set_result(job.func())
+            except BaseException as e:
+                job.future.set_exception(e)
+            return
+
+        generate_kwargs = dict(
+            batch[0].generate_kwargs,
+            max_new_tokens=max(job.max_new_tokens for job in batch),
+        )
+
+        try:
+            output_texts = generate_from_inputs(
+                [job.inputs for job in batch],
+                generate_kwargs,
+                [job.max_new_tokens for job in batch],
+            )
+        except BaseException as e:
+            print(f"Batch generate failed ({len(batch)} requests):", repr(e))
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        if len(batch) > 1:
+            print(f"Batched generate: {len(batch)} requests in {time.monotonic() - started:.2f}s")
+
+        for job, output_text in zip(batch, output_texts):
+            job.future.set_result(output_text)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            queue_depth = len(self._jobs)
+            oldest_wait_ms = (time.monotonic() - self._jobs[0].enqueued_at) * 1000 if self._jobs else 0.0
+
+        processed = stats["batched_requests"] + stats["exclusive_calls"]
+        return {
+            "enabled": True,
+            "queue_depth": queue_depth,
+            "oldest_wait_ms": round(oldest_wait_ms, 1),
+            "max_batch_size": self.max_batch_size,
+            "token_budget": self.token_budget,
+            "max_wait_window_ms": round(self.max_wait * 1000, 1),
+            "submitted": stats["submitted"],
+            "batches": stats["batches"],
+            "avg_batch_size": round(stats["batched_requests"] / stats["batches"], 2) if stats["batches"] else None,
+            "largest_batch": stats["largest_batch"],
+            "exclusive_calls": stats["exclusive_calls"],
+            "avg_wait_ms": round(stats["total_wait_ms"] / processed, 1) if processed else None,
+            "max_wait_ms": round(stats["max_wait_ms"], 1),
+        }
+
+
+generation_queue = None
+if ENABLE_GENERATION_BATCHING:
+    generation_queue = GenerationQueue(
+        max_batch_size=GENERATION_MAX_BATCH_SIZE,
+        token_budget=GENERATION_TOKEN_BUDGET,
+        max_wait_ms=GENERATION_MAX_WAIT_MS,
+    )
+    print("Generation queue started.")
+
+
+def run_on_model(func, *args, **kwargs):
+    """Việc cần giữ model riêng (KV cache riêng) đi qua hàng đợi khi bật batching."""
+    if generation_queue is not None:
+        return generation_queue.run_exclusive(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def raise_not_fashion_image():
+    raise HTTPException(
+        status_code=400,
+        detail=(
+            "Ảnh không phải sản phẩm thời trang. "
+            "Vui lòng chọn ảnh quần áo, giày dép, túi xách hoặc phụ kiện thời trang."
+        ),
+    )
+
+
+# ============================================================
+# RESPONSE CACHE
+# ============================================================
+#
+# Admin hay tạo lại mô tả cho cùng ảnh + tên/thương hiệu/danh mục.
+# Key = sha256(pixel ảnh đã decode + prompt dựng từ input đã chuẩn hóa
+# + tham số generate + model/adapter). Chỉ cache mô tả sinh thành công.
+# Bộ nhớ: LRU + TTL. Nếu có RESPONSE_CACHE_SQLITE_PATH thì ghi thêm
+# vào sqlite để còn dùng được sau khi restart notebook.
+# Request gửi cache="bypass" sẽ bỏ qua cache khi đọc và ghi đè kết quả mới.
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1000, ttl_seconds=86400, sqlite_path=""):
+        self.max_entries = int(max_entries)
+        self.ttl_seconds = float(ttl_seconds)
+        self.sqlite_path = sqlite_path or ""
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+        if self.sqlite_path:
+            try:
+                self._db = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS description_cache "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._db.execute("DELETE FROM description_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+                self._db.commit()
+            except Exception as e:
+                print("Response cache sqlite disabled:", repr(e))
+                self._db = None
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM description_cache WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None and now - row[1] < self.ttl_seconds:
+                    self._db.execute("UPDATE description_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO description_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                # LRU trên đĩa: giữ max_entries key được dùng gần nhất.
+                self._db.execute(
+                    "DELETE FROM description_cache WHERE key NOT IN "
+                    "(SELECT key FROM description_cache ORDER BY accessed_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                self._db.commit()
+
+    def _remember(self, key, value, created_at):
+        self._entries[key] = (value, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "sqlite_path": self.sqlite_path if self._db is not None else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+response_cache = None
+if ENABLE_RESPONSE_CACHE:
+    response_cache = ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+        sqlite_path=RESPONSE_CACHE_SQLITE_PATH,
+    )
+    print("Response cache enabled.")
+
+
+def normalize_prompt_field(value):
+    return re.sub(r"\s+", " ", safe_text(value))
+
+
+def image_fingerprint(image):
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def response_cache_key(image, generate_kwargs, **prompt_fields):
+    # Chỉ chuẩn hóa giá trị đưa vào key; model vẫn nhận nguyên văn input
+    # (old_description giữ xuống dòng / gạch đầu dòng).
+    # Key dùng prompt dựng từ field đã chuẩn hóa để đổi template prompt cũng đổi key.
+    normalized_prompt = build_prompt(
+        **{name: normalize_prompt_field(value) for name, value in prompt_fields.items()}
+    )
+    payload = json.dumps(
+        {
+            "image": image_fingerprint(image),
+            "prompt": normalized_prompt,
+            "generate": generate_kwargs,
+            "model": BASE_MODEL_ID,
+            "adapter": ADAPTER_DIR,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
 @torch.inference_mode()
 def generate_description_internal(
     product_name="",
@@ -704,10 +1507,28 @@ def generate_description_internal(
     image_base64=None,
     image_url=None,
     max_new_tokens=220,
+    cache_mode=None,
+    image=None,
+    image_bytes=None,
 ):
-    image = None
+    """
+    Ảnh nhận theo thứ tự ưu tiên: image (PIL đã decode), image_bytes (bytes
+    file ảnh), image_base64, image_url.
 
-    if image_base64:
+    Trả về (output_text, cache_status).
+    cache_status: "hit", "miss", "bypass" hoặc "disabled".
+    """
+    if image is None and image_bytes:
+        try:
+            image = decode_image_bytes(image_bytes)
+        except Exception as e:
+            print("Decode image bytes failed:", repr(e))
+            raise HTTPException(
+                status_code=400,
+                detail="File ảnh không hợp lệ hoặc không đọc được.",
+            )
+
+    if image is None and image_base64:
         try:
             image = pil_image_from_base64(image_base64)
         except Exception as e:
@@ -734,8 +1555,87 @@ def generate_description_internal(
             detail="Vui lòng cung cấp ảnh sản phẩm để tạo mô tả.",
         )
 
+    prompt = build_prompt(
+        product_name=product_name,
+        category=category,
+        brand=brand,
+        price=price,
+        old_description=old_description,
+    )
+
+    generate_kwargs = build_generate_kwargs(
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        temperature=0.7,
+        top_p=0.9,
+        repetition_penalty=1.08,
+    )
+
+    if response_cache is None:
+        return describe_image(image, prompt, product_name, category, brand, generate_kwargs), "disabled"
+
+    cache_key = response_cache_key(
+        image,
+        generate_kwargs,
+        product_name=product_name,
+        category=category,
+        brand=brand,
+        price=price,
+        old_description=old_description,
+    )
+    if safe_text(cache_mode).lower() == "bypass":
+        response_cache.record_bypass()
+        cache_status = "bypass"
+    else:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            print("Response cache hit.")
+            return cached_text, "hit"
+        cache_status = "miss"
+
+    output_text = describe_image(image, prompt, product_name, category, brand, generate_kwargs)
+    if output_text:
+        response_cache.set(cache_key, output_text)
+
+    return output_text, cache_status
+
+
+def describe_image(image, prompt, product_name, category, brand, generate_kwargs):
+    """Kiểm duyệt ảnh thời trang rồi sinh mô tả (không qua cache)."""
     # FIX 2: Validate ảnh phải là sản phẩm thời trang trước khi generate.
+    # CLIP pre-filter quyết định luôn các ca chắc chắn, chỉ ca không chắc mới gọi Qwen-VL validate.
+    needs_vlm_validation = ENABLE_FASHION_IMAGE_VALIDATION
     if ENABLE_FASHION_IMAGE_VALIDATION:
+        prefilter_decision = clip_prefilter_decision(image)
+        if prefilter_decision == "reject":
+            raise_not_fashion_image()
+        needs_vlm_validation = prefilter_decision != "accept"
+
+    if needs_vlm_validation and active_validation_mode == "single_pass":
+        try:
+            is_valid_fashion, valid_probability, output_text = run_on_model(
+                validate_and_generate_single_pass,
+                image=image,
+                validation_prompt=build_fashion_validation_prompt(
+                    product_name=product_name,
+                    category=category,
+                    brand=brand,
+                ),
+                generation_prompt=prompt,
+                generate_kwargs=generate_kwargs,
+            )
+        except Exception as e:
+            print("Single-pass validation failed, falling back to two passes:", repr(e))
+            release_memory()
+            record_single_pass_result(e)
+        else:
+            record_single_pass_result()
+            print("Fashion validation (single pass) VALID probability:", round(valid_probability, 4))
+            if not is_valid_fashion:
+                raise_not_fashion_image()
+            return output_text
+
+    if needs_vlm_validation:
         is_valid_fashion, validation_message = validate_fashion_image(
             image=image,
             product_name=product_name,
@@ -744,41 +1644,13 @@ def generate_description_internal(
         )
 
         if not is_valid_fashion:
-            raise HTTPException(
-                status_code=400,
-                detail=(
-                    "Ảnh không phải sản phẩm thời trang. "
-                    "Vui lòng chọn ảnh quần áo, giày dép, túi xách hoặc phụ kiện thời trang."
-                ),
-            )
+            raise_not_fashion_image()
 
         print("Fashion validation passed:", validation_message)
 
-    prompt = build_prompt(
-        product_name=product_name,
-        category=category,
-        brand=brand,
-        price=price,
-        old_description=old_description,
-    )
-
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": prompt},
-            ],
-        }
-    ]
-
     output_text = run_qwen_vl_text_generation(
-        messages=messages,
-        max_new_tokens=max_new_tokens,
-        do_sample=True,
-        temperature=0.7,
-        top_p=0.9,
-        repetition_penalty=1.08,
+        messages=build_image_messages(image, prompt),
+        **generate_kwargs,
     )
 
     return output_text
@@ -793,7 +1665,7 @@ print("\n===== QUICK MODEL TEST BEFORE API =====")
 try:
     # Không test text-only nữa vì API đã bắt buộc có ảnh.
     test_img = Image.new("RGB", (384, 384), color=(235, 235, 235))
-    test_description = generate_description_internal(
+    test_description, _ = generate_description_internal(
         product_name="áo thun basic",
         category="Áo",
         brand="UTEShop",
@@ -844,6 +1716,8 @@ class GenerateDescriptionRequest(BaseModel):
     image_base64: str | None = Field(default=None)
     image_url: str | None = Field(default=None)
     max_new_tokens: int = Field(default=220)
+    # "bypass" = bỏ qua response cache, luôn sinh mô tả mới.
+    cache: str | None = Field(default=None)
 
 
 @app.get("/")
@@ -872,6 +1746,12 @@ def health():
         "cuda": torch.cuda.is_available(),
         "gpu": gpu_name,
         "fashion_validation": ENABLE_FASHION_IMAGE_VALIDATION,
+        "fashion_validation_mode": active_validation_mode,
+        "fashion_validation_mode_configured": FASHION_VALIDATION_MODE,
+        "single_pass_failures": single_pass_failures,
+        "clip_prefilter": clip_prefilter_report(),
+        "generation_queue": generation_queue.stats() if generation_queue is not None else {"enabled": False},
+        "response_cache": response_cache.stats() if response_cache is not None else {"enabled": False},
     }
 
 
@@ -893,7 +1773,7 @@ def generate_description(payload: GenerateDescriptionRequest):
         product_name = payload.product_name or payload.name
         old_description = payload.old_description or payload.description
 
-        generated_description = generate_description_internal(
+        generated_description, cache_status = generate_description_internal(
             product_name=product_name,
             category=payload.category,
             brand=payload.brand,
@@ -902,6 +1782,7 @@ def generate_description(payload: GenerateDescriptionRequest):
             image_base64=payload.image_base64,
             image_url=payload.image_url,
             max_new_tokens=payload.max_new_tokens,
+            cache_mode=payload.cache,
         )
 
         return {
@@ -909,6 +1790,7 @@ def generate_description(payload: GenerateDescriptionRequest):
             "used_image_input": bool(payload.image_base64 or payload.image_url),
             "input_type": "json_base64_or_url",
             "fashion_validation": "passed" if ENABLE_FASHION_IMAGE_VALIDATION else "disabled",
+            "cache": cache_status,
         }
 
     except HTTPException:
@@ -944,6 +1826,7 @@ async def generate_description_upload(
     old_description: str = Form(default=""),
     description: str = Form(default=""),
     max_new_tokens: int = Form(default=220),
+    cache: str = Form(default=""),
 ):
     """
     Endpoint dành cho frontend upload ảnh từ máy bằng FormData.
@@ -956,12 +1839,13 @@ async def generate_description_upload(
     - price
     - old_description hoặc description
     - max_new_tokens
+    - cache: "bypass" để luôn sinh mô tả mới
     """
     try:
         product_name_final = product_name or name
         old_description_final = old_description or description
 
-        image_base64 = None
+        decoded_image = None
         used_image_input = False
         upload_filename = None
         upload_content_type = None
@@ -981,26 +1865,30 @@ async def generate_description_upload(
                         detail=f"Ảnh quá lớn. Dung lượng tối đa là {MAX_UPLOAD_SIZE_MB}MB.",
                     )
 
+                # Decode đúng một lần (đã thu nhỏ về max_pixels), truyền thẳng ảnh PIL
+                # vào generate thay vì encode lại base64 rồi decode lần nữa.
                 try:
-                    Image.open(BytesIO(image_bytes)).convert("RGB")
+                    decoded_image = await run_in_threadpool(decode_image_bytes, image_bytes)
                 except Exception as e:
                     raise HTTPException(
                         status_code=400,
                         detail=f"File upload không phải ảnh hợp lệ: {repr(e)}",
                     )
+                del image_bytes
 
-                image_base64 = base64.b64encode(image_bytes).decode("utf-8")
                 used_image_input = True
 
-        generated_description = generate_description_internal(
+        # Chạy trên threadpool: generate chờ hàng đợi batch, không được chặn event loop.
+        generated_description, cache_status = await run_in_threadpool(
+            generate_description_internal,
             product_name=product_name_final,
             category=category,
             brand=brand,
             price=price,
             old_description=old_description_final,
-            image_base64=image_base64,
-            image_url=None,
+            image=decoded_image,
             max_new_tokens=max_new_tokens,
+            cache_mode=cache,
         )
 
         return {
@@ -1011,6 +1899,7 @@ async def generate_description_upload(
             "content_type": upload_content_type,
             "upload_size_bytes": upload_size_bytes,
             "fashion_validation": "passed" if ENABLE_FASHION_IMAGE_VALIDATION else "disabled",
+            "cache": cache_status,
         }
 
     except HTTPException:
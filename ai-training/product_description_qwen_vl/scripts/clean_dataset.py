@@ -23,6 +23,7 @@ Chức năng:
 from __future__ import annotations
 
 import argparse
+import os
 import re
 import time
 from io import BytesIO
@@ -33,8 +34,18 @@ import pandas as pd
 import requests
 from PIL import Image
 
+from image_cache import ImageCache
+
 REQUIRED_COLUMNS = ["image_url", "name", "brand", "description"]
 
+IMAGE_CACHE = ImageCache(
+    os.getenv("IMAGE_CACHE_DIR", "image_cache"),
+    headers={
+        "User-Agent": "Mozilla/5.0 UteShop Dataset Cleaner/1.0",
+        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+    },
+)
+
 
 def normalize_whitespace(text: str) -> str:
     """Chuẩn hóa khoảng trắng trong text."""
@@ -69,33 +80,22 @@ def cloudinary_force_jpg_url(url: str) -> str:
 def check_image_url(url: str, timeout: int = 15, retries: int = 2) -> tuple[bool, Optional[str], Optional[int], Optional[int]]:
     """
     Tải thử ảnh và mở bằng PIL để xác nhận URL hợp lệ.
+    Ảnh tải về được giữ trong IMAGE_CACHE để bước train/inference không tải lại.
 
     Trả về:
         is_valid, error_message, width, height
     """
-    headers = {
-        "User-Agent": "Mozilla/5.0 UteShop Dataset Cleaner/1.0",
-        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-    }
-
     last_error: Optional[str] = None
     for attempt in range(retries + 1):
         try:
-            response = requests.get(url, headers=headers, timeout=timeout)
-            if response.status_code != 200:
-                last_error = f"HTTP {response.status_code}"
-                time.sleep(0.5 * (attempt + 1))
-                continue
-
-            content_type = response.headers.get("Content-Type", "")
-            if "image" not in content_type.lower():
-                last_error = f"Content-Type không phải ảnh: {content_type}"
-                time.sleep(0.5 * (attempt + 1))
-                continue
-
-            image = Image.open(BytesIO(response.content)).convert("RGB")
+            data = IMAGE_CACHE.fetch(url, timeout=timeout)
+            # PIL mở được nghĩa là nội dung là ảnh, không cần dựa vào Content-Type.
+            image = Image.open(BytesIO(data)).convert("RGB")
             width, height = image.size
             return True, None, width, height
+        except requests.HTTPError as exc:
+            last_error = f"HTTP {exc.response.status_code}"
+            time.sleep(0.5 * (attempt + 1))
         except Exception as exc:  # noqa: BLE001
             last_error = str(exc)
             time.sleep(0.5 * (attempt + 1))
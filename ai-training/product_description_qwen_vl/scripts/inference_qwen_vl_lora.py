@@ -15,17 +15,24 @@ Nếu muốn chạy base model chưa fine-tune để so sánh:
 from __future__ import annotations
 
 import argparse
+import os
 import re
 from io import BytesIO
 from pathlib import Path
 from typing import Optional
 
-import requests
 import torch
 from PIL import Image
 from peft import PeftModel
 from transformers import AutoProcessor, BitsAndBytesConfig, Qwen2_5_VLForConditionalGeneration
 
+from image_cache import ImageCache
+
+IMAGE_CACHE = ImageCache(
+    os.getenv("IMAGE_CACHE_DIR", "image_cache"),
+    headers={"User-Agent": "Mozilla/5.0 UteShop Qwen-VL Inference/1.0"},
+)
+
 
 def cloudinary_force_jpg_url(url: str) -> str:
     url = re.sub(r"\s+", " ", str(url or "")).strip()
@@ -53,13 +60,7 @@ def load_image(image_source: str, timeout: int = 20) -> Image.Image:
 
     if is_http_url(image_source):
         url = cloudinary_force_jpg_url(image_source)
-        response = requests.get(
-            url,
-            headers={"User-Agent": "Mozilla/5.0 UteShop Qwen-VL Inference/1.0"},
-            timeout=timeout,
-        )
-        response.raise_for_status()
-        return Image.open(BytesIO(response.content)).convert("RGB")
+        return Image.open(BytesIO(IMAGE_CACHE.fetch(url, timeout=timeout))).convert("RGB")
 
     path = Path(image_source)
     if not path.exists() or not path.is_file():
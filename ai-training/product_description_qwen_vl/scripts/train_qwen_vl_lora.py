@@ -25,13 +25,13 @@ from __future__ import annotations
 import argparse
 import gc
 import json
+import os
 import re
 from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
 from typing import Any
 
-import requests
 import torch
 from PIL import Image
 from torch.utils.data import Dataset
@@ -44,6 +44,8 @@ from transformers import (
 )
 from peft import LoraConfig, TaskType, get_peft_model, prepare_model_for_kbit_training
 
+from image_cache import ImageCache
+
 
 def normalize_whitespace(text: str) -> str:
     return re.sub(r"\s+", " ", str(text or "")).strip()
@@ -67,12 +69,16 @@ def cloudinary_force_jpg_url(url: str) -> str:
     return url
 
 
+# Mỗi epoch đọc lại toàn bộ ảnh: cache trên đĩa để chỉ tải từ Cloudinary lần đầu.
+IMAGE_CACHE = ImageCache(
+    os.getenv("IMAGE_CACHE_DIR", "image_cache"),
+    headers={"User-Agent": "Mozilla/5.0 UteShop Qwen-VL Trainer/1.0"},
+)
+
+
 def load_image_from_url(url: str, timeout: int = 20) -> Image.Image:
     url = cloudinary_force_jpg_url(url)
-    headers = {"User-Agent": "Mozilla/5.0 UteShop Qwen-VL Trainer/1.0"}
-    response = requests.get(url, headers=headers, timeout=timeout)
-    response.raise_for_status()
-    return Image.open(BytesIO(response.content)).convert("RGB")
+    return Image.open(BytesIO(IMAGE_CACHE.fetch(url, timeout=timeout))).convert("RGB")
 
 
 def build_prompt(name: str, brand: str) -> str: